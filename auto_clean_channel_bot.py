@@ -1,11 +1,31 @@
+"""
+Channel cleanup (as the bot): remove channel members without access.
+Members are processed page by page while the next page is fetched, and each
+page's kicks run concurrently through kick_executor (Bot API ban + unban, so a
+removed member can rejoin after renewing). Everyone still in the channel is
+saved to a member snapshot; the next run pages only until it reaches members
+already in the snapshot (the participant list comes newest first) and re-checks
+the rest from the snapshot without asking Telegram for them again. Run with
+--full to rescan the whole channel.
+
+Usage:
+  python3 auto_clean_channel_bot.py [--full] [--dry-run]
+"""
+
 import os
+import re
 import sys
+import json
 import asyncio
+from datetime import datetime, timezone
 from telethon import TelegramClient
-from telethon.tl.functions.channels import GetParticipantsRequest, EditBannedRequest
-from telethon.tl.types import ChannelParticipantsRecent, ChatBannedRights
+from telethon.tl.functions.channels import GetParticipantsRequest
+from telethon.tl.types import ChannelParticipantsRecent
 from dotenv import load_dotenv
 import db
+import kick_executor
+import telegram_client
+from bulk_sender import TokenBucket
 
 load_dotenv()
 
@@ -17,13 +37,142 @@ API_ID = 6
 API_HASH = 'eb06d4abfb49dc3eeb1aeb98ae0f581e'
 SESSION_NAME = 'bot_cleanup_session'
 
+SNAPSHOT_FILE = 'channel_members_snapshot.json'
+PAGE_SIZE = 100
+FUZZY_THRESHOLD = 0.6  # trigram similarity that still counts as the same name
+
+
+# ============================================
+# NAME MATCHING
+# ============================================
+
+def normalize_name(name: str) -> str:
+    """Lowercase, ё→е, punctuation and emoji dropped, single spaces."""
+    name = (name or "").lower().replace("ё", "е")
+    return " ".join(re.sub(r"[^\w\s]", " ", name).split())
+
+
+def _trigrams(text: str) -> set:
+    padded = f"  {text} "
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+class NameIndex:
+    """
+    Names of paid-but-unlinked GetCourse users, indexed for matching member names.
+    A member matches when one name's words are all contained in the other's
+    ("Анна" ~ "Анна Смирнова"), or when their trigram similarity is high
+    (spelling variants). Lookups only compare names sharing a word or trigram.
+    """
+
+    def __init__(self, names):
+        self.names = sorted({normalize_name(n) for n in names} - {""})
+        self._tokens = [set(n.split()) for n in self.names]
+        self._grams = [_trigrams(n) for n in self.names]
+        self._by_token = {}
+        self._by_gram = {}
+        for i, name in enumerate(self.names):
+            for token in self._tokens[i]:
+                self._by_token.setdefault(token, set()).add(i)
+            for gram in self._grams[i]:
+                self._by_gram.setdefault(gram, set()).add(i)
+
+    def __len__(self) -> int:
+        return len(self.names)
+
+    def match(self, full_name: str):
+        """The indexed name that `full_name` resembles, or None."""
+        name = normalize_name(full_name)
+        if not name:
+            return None
+        tokens = set(name.split())
+        for i in set().union(*(self._by_token.get(t, ()) for t in tokens)):
+            if tokens <= self._tokens[i] or self._tokens[i] <= tokens:
+                return self.names[i]
+
+        grams = _trigrams(name)
+        shared = {}
+        for gram in grams:
+            for i in self._by_gram.get(gram, ()):
+                shared[i] = shared.get(i, 0) + 1
+        for i, common in sorted(shared.items(), key=lambda kv: -kv[1]):
+            if common / len(grams | self._grams[i]) >= FUZZY_THRESHOLD:
+                return self.names[i]
+            break  # best candidate too far off
+        return None
+
+
+def load_unmatched_names(path: str = 'unmatched_paid_users.txt') -> NameIndex:
+    names = []
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            for line in f:
+                if line.startswith('#') or not line.strip(): continue
+                if '—' in line:
+                    name = line.split('—')[1].strip()
+                    if name and name.lower() != 'no name':
+                        names.append(name)
+        print(f"⚠️ Загружен список 'неопознанных' оплат: {len(set(names))} имен")
+    except FileNotFoundError:
+        print("⚠️ Файл unmatched_paid_users.txt не найден, пропускаем.")
+    return NameIndex(names)
+
+
+# ============================================
+# MEMBER SNAPSHOT
+# ============================================
+
+def load_snapshot(channel_id: int) -> dict:
+    """{user_id: {'name', 'bot'}} of members left in the channel by its last scan."""
+    try:
+        with open(SNAPSHOT_FILE, 'r', encoding='utf-8') as f:
+            snapshot = json.load(f)
+    except (FileNotFoundError, ValueError):
+        return {}
+    if snapshot.get('channel_id') != channel_id:
+        return {}
+    return {int(uid): member for uid, member in snapshot.get('members', {}).items()}
+
+
+def save_snapshot(channel_id: int, members: dict) -> None:
+    tmp = SNAPSHOT_FILE + '.tmp'
+    with open(tmp, 'w', encoding='utf-8') as f:
+        json.dump({
+            'channel_id': channel_id,
+            'scanned_at': datetime.now(timezone.utc).isoformat(),
+            'members': {str(uid): member for uid, member in members.items()},
+        }, f, ensure_ascii=False)
+    os.replace(tmp, SNAPSHOT_FILE)
+
+
+async def iter_member_pages(client, channel_id: int, known_ids, full: bool = False):
+    """Yield pages of channel members; stop at the first page made up only of `known_ids`."""
+    offset = 0
+    while True:
+        participants = await client(GetParticipantsRequest(
+            channel_id, ChannelParticipantsRecent(), offset, PAGE_SIZE, hash=0
+        ))
+        if not participants.users:
+            return
+        yield participants.users
+        if not full and all(u.id in known_ids for u in participants.users):
+            return  # reached members seen by the last scan
+        offset += len(participants.users)
+
+
+# ============================================
+# CLEANUP
+# ============================================
+
 async def main():
+    full = '--full' in sys.argv
+    dry_run = '--dry-run' in sys.argv
     print("🧹 Запускаем автоматическую глубокую очистку канала клуба (от имени бота)...\n")
-    
+
     if not CHANNEL_ID:
         print("❌ Ошибка: Не найден CHANNEL_ID в файле .env")
         return
-        
+
     try:
         channel_id_int = int(CHANNEL_ID)
     except ValueError:
@@ -32,101 +181,106 @@ async def main():
 
     # Keep everyone who has access (active OR grace period). Don't kick people still in grace.
     active_user_ids = db.get_access_subscriber_ids()
-    
+
     print(f"✅ В базе данных найдено подписчиков с доступом (активных + резерв): {len(active_user_ids)}")
 
     # We also keep a list of admin IDs that should never be kicked.
     admin_id_str = os.getenv("ADMIN_ID", "")
     admins = {int(admin_id_str)} if admin_id_str.isdigit() else set()
 
-    unmatched_names = set()
-    try:
-        with open('unmatched_paid_users.txt', 'r', encoding='utf-8') as f:
-            for line in f:
-                if line.startswith('#') or not line.strip(): continue
-                if '—' in line:
-                    name = line.split('—')[1].strip().lower()
-                    if name and name != 'no name':
-                        unmatched_names.add(name)
-        print(f"⚠️ Загружен список 'неопознанных' оплат: {len(unmatched_names)} имен")
-    except FileNotFoundError:
-        print("⚠️ Файл unmatched_paid_users.txt не найден, пропускаем.")
+    unmatched_names = load_unmatched_names()
+
+    snapshot = {} if full else load_snapshot(channel_id_int)
+    if snapshot:
+        print(f"📸 Снимок прошлой проверки: {len(snapshot)} участников (новые будут проверены через Telegram)")
 
     client = TelegramClient(SESSION_NAME, API_ID, API_HASH)
     # Login via Bot Token
     await client.start(bot_token=BOT_TOKEN)
-    
+
+    members = {}        # every member evaluated this run -> snapshot (minus the kicked)
+    stats = {'scanned': 0, 'from_snapshot': 0, 'safe': 0}
+    bot = telegram_client.get_bot()
+    bucket = TokenBucket()
+    to_kick = []        # targets of the page being evaluated
+    kick_tasks = []
+
+    def kick_batch() -> None:
+        """Kick the collected targets in the background (ban + unban, see kick_executor)."""
+        if to_kick and not dry_run:
+            kick_tasks.append(asyncio.create_task(
+                kick_executor.kick_many(bot, channel_id_int, list(to_kick), bucket=bucket)))
+        to_kick.clear()
+
+    def evaluate(user_id: int, full_name: str, is_bot: bool) -> None:
+        """Keep one member, or add them to the current kick batch."""
+        members[user_id] = {'name': full_name, 'bot': is_bot}
+        # Skip bots and admins; keep users with access
+        if is_bot or user_id in admins or user_id in active_user_ids:
+            stats['safe'] += 1
+            return
+
+        # Check if they closely match an unmatched paid user
+        paid_name = unmatched_names.match(full_name)
+        if paid_name:
+            print(f"⚠️ Оставлен (Имя похоже на оплатившего, но бот его не знает): {full_name} ~ {paid_name}")
+            stats['safe'] += 1
+            return
+
+        # If they don't have an active subscription, KICK THEM
+        print(f"🚫 УДАЛЕН ИЗ КАНАЛА: {full_name} (ID: {user_id}) - Нет активной подписки")
+        to_kick.append({'user_id': user_id, 'name': full_name})
+
     try:
-        print("⏳ Сбор списка всех участников канала...")
-        
-        offset = 0
-        limit = 100
-        all_participants = []
-        
-        while True:
-            participants = await client(GetParticipantsRequest(
-                channel_id_int, ChannelParticipantsRecent(), offset, limit, hash=0
-            ))
-            if not participants.users:
-                break
-            all_participants.extend(participants.users)
-            offset += len(participants.users)
-            
-        print(f"👥 Всего участников в канале: {len(all_participants)}\n")
-        
-        kicked_count = 0
-        safe_count = 0
-        
-        banned_rights = ChatBannedRights(until_date=None, view_messages=True)
-        
+        print("⏳ Проверка участников канала...")
         print("-" * 50)
-        for member in all_participants:
-            # Skip bots and admins
-            if member.bot or member.id in admins:
-                safe_count += 1
-                continue
-                
-            full_name = f"{member.first_name or ''} {member.last_name or ''}".strip()
-            
-            # Check if user has an active subscription
-            if member.id in active_user_ids:
-                # User has paid
-                safe_count += 1
-                continue
-                
-            # Check if they closely match an unmatched paid user
-            lower_name = full_name.lower()
-            is_unmatched_paid = False
-            for uname in unmatched_names:
-                if uname in lower_name or lower_name in uname:
-                    is_unmatched_paid = True
-                    break
-                    
-            if is_unmatched_paid:
-                print(f"⚠️ Оставлен (Имя похоже на оплатившего, но бот его не знает): {full_name}")
-                safe_count += 1
-                continue
-                
-            # If they don't have an active subscription, KICK THEM
-            print(f"🚫 УДАЛЕН ИЗ КАНАЛА: {full_name} (ID: {member.id}) - Нет активной подписки")
-            try:
-                # Ban and Unban to kick
-                await client(EditBannedRequest(channel_id_int, member.id, banned_rights))
-                kicked_count += 1
-            except Exception as e:
-                print(f"   [Ошибка при удалении {full_name}]: {e}")
-                
+
+        async for page in iter_member_pages(client, channel_id_int, snapshot, full):
+            for member in page:
+                if member.id in members:
+                    continue
+                stats['scanned'] += 1
+                full_name = f"{member.first_name or ''} {member.last_name or ''}".strip()
+                evaluate(member.id, full_name, bool(member.bot))
+            kick_batch()
+
+        # Members from the last scan that the pages above did not reach: re-check without Telegram.
+        # Some may have left since; ban + unban still leaves them free to rejoin after renewing.
+        for user_id, member in snapshot.items():
+            if user_id not in members:
+                stats['from_snapshot'] += 1
+                evaluate(user_id, member.get('name', ''), member.get('bot', False))
+        kick_batch()
+
+        results = [r for batch in await asyncio.gather(*kick_tasks) for r in batch]
+        for r in results:
+            if r.outcome in (kick_executor.TRANSIENT, kick_executor.FAILED):
+                print(f"   [Ошибка при удалении {r.name}]: {r.outcome}: {r.error}")
+        counts = kick_executor.count_outcomes(results)
+        kicked_ids = {r.user_id for r in results if r.removed}
+
         print("-" * 50)
-        print(f"\n📊 ИТОГИ ОЧИСТКИ:")
-        print(f"   Всего участников до чистки: {len(all_participants)}")
-        print(f"   Удалено (нет подписки):     {kicked_count}")
-        print(f"   Осталось в канале:          {safe_count}")
+        print("\n📊 ИТОГИ ОЧИСТКИ:")
+        print(f"   Проверено через Telegram:   {stats['scanned']}")
+        print(f"   Проверено по снимку:        {stats['from_snapshot']}")
+        print(f"   Удалено (нет подписки):     {counts[kick_executor.KICKED]}" + (" (dry run)" if dry_run else ""))
+        print(f"   Уже не в канале:            {counts[kick_executor.ALREADY_GONE]}")
+        print(f"   Ошибки при удалении:        {counts[kick_executor.TRANSIENT] + counts[kick_executor.FAILED]}")
+        print(f"   Осталось в канале:          {stats['safe']}")
+
+        if not dry_run:
+            # Members whose kick failed stay in the snapshot, so the next run re-checks them
+            save_snapshot(channel_id_int, {uid: m for uid, m in members.items() if uid not in kicked_ids})
+            print(f"   → Снимок участников сохранён в {SNAPSHOT_FILE}")
         print("\n✅ Готово! Бот самостоятельно очистил канал.")
 
     except Exception as e:
         print(f"❌ Критическая ошибка: {e}")
     finally:
+        for task in kick_tasks:
+            task.cancel()
         await client.disconnect()
+        await telegram_client.close()
 
 if __name__ == "__main__":
     asyncio.run(main())
@@ -1,20 +1,32 @@
 
 import os
 import re
-import json
 import logging
-import threading
 import asyncio
-from datetime import datetime, timedelta
+from datetime import datetime, timedelta, timezone
 from urllib.parse import urlencode
-from flask import Flask, request, jsonify
 from dotenv import load_dotenv
 from telegram import Update, LabeledPrice, InlineKeyboardButton, InlineKeyboardMarkup, BotCommand, BotCommandScopeChat
 from telegram.ext import Application, CommandHandler, ContextTypes, PreCheckoutQueryHandler, MessageHandler, filters, CallbackQueryHandler, ApplicationBuilder, ChatJoinRequestHandler, ConversationHandler
-from apscheduler.schedulers.background import BackgroundScheduler
+from telegram.error import TimedOut
+import uvicorn
+from starlette.applications import Starlette
+from starlette.requests import Request
+from starlette.responses import JSONResponse, PlainTextResponse, RedirectResponse
+from starlette.routing import Route
 
 # Import our database layer (Supabase)
 import db
+import db_async
+import templates
+import payment_tokens as pt
+import outbox
+import webhook_dedup
+import telegram_client
+import lifecycle
+import lifecycle_timers
+import kick_executor
+from bulk_sender import TokenBucket, call_with_retry, run_bounded
 
 # Load environment variables
 load_dotenv()
@@ -25,6 +37,7 @@ PAYMENT_PROVIDER_TOKEN = os.getenv("PAYMENT_PROVIDER_TOKEN")
 PAYMENT_PROVIDER_TOKEN_INTL = os.getenv("PAYMENT_PROVIDER_TOKEN_INTL")
 PAYMENT_LINK = os.getenv("PAYMENT_LINK") # Link to Payment Page (GetCourse)
 WAITLIST_LINK = os.getenv("WAITLIST_LINK")
+PUBLIC_URL = os.getenv("PUBLIC_URL") or os.getenv("RENDER_EXTERNAL_URL")  # base URL of our web server (for /pay links)
 CHANNEL_ID = os.getenv("CHANNEL_ID")
 ADMIN_ID = os.getenv("ADMIN_ID")
 CURRENCY = os.getenv("CURRENCY", "RUB")
@@ -119,6 +132,22 @@ def get_cabinet_text(email: str, expires_at: str, renewed_count: int, status: st
     
     return header + email_line + sub_line + payments_line + hint
 
+def _cabinet_text_from_context(user_ctx: dict, email: str = None) -> str:
+    """Render the cabinet from a db.get_user_context() result."""
+    user_record = user_ctx.get("user")
+    sub_record = user_ctx.get("access_subscription")
+
+    if not email:
+        email = user_record.get("email") if user_record else None
+    # Determine email fallback: check sub_record if user_record has none
+    if not email and sub_record:
+        email = sub_record.get("email")
+
+    expires_at = sub_record.get("expires_at") if sub_record else None
+    renewed_count = sub_record.get("renewed_count", 0) if sub_record else 0
+    status = sub_record.get("status", "none") if sub_record else "none"
+    return get_cabinet_text(email, expires_at, renewed_count, status=status)
+
 TEXT_HELP = (
     "<b>🆘 Нужна помощь?</b>\n\n"
     "Если у вас возникли вопросы по клубу, доступу или оплате:\n\n"
@@ -135,8 +164,8 @@ TEXT_SUCCESS = (
 )
 
 # --- KEYBOARDS ---
-def build_payment_url(user_id: int = None):
-    """Build a payment link that GetCourse can map back to Telegram."""
+def resolve_payment_url(user_id: int = None):
+    """Build a payment link that GetCourse can map back to Telegram (blocking: reads the user, mints a token)."""
     if not PAYMENT_LINK:
         return None
 
@@ -149,7 +178,6 @@ def build_payment_url(user_id: int = None):
     # Attach a stable one-time token so GetCourse can return it in the
     # payment callback even if UTM/session fields are unreliable.
     try:
-        import payment_tokens as pt
         params["token"] = pt.generate_token(user_id, name=user_data.get("first_name"))
     except Exception as e:
         logger.error(f"Failed to generate payment token for {user_id}: {e}")
@@ -161,6 +189,21 @@ def build_payment_url(user_id: int = None):
     return f"{PAYMENT_LINK}{separator}{urlencode(params)}"
 
 
+def deferred_payment_url(user_id: int = None):
+    """
+    Link to our /pay/<signed id> redirect, which resolves the real payment URL only when
+    the user clicks. Pure CPU; returns None when PUBLIC_URL isn't configured.
+    """
+    if not PAYMENT_LINK or not user_id or not PUBLIC_URL:
+        return None
+    return f"{PUBLIC_URL.rstrip('/')}/pay/{pt.sign_user_id(user_id)}"
+
+
+async def build_payment_url(user_id: int = None):
+    """Payment URL for a button: the deferred redirect if available, otherwise resolved now."""
+    return deferred_payment_url(user_id) or await db_async.run(resolve_payment_url, user_id)
+
+
 async def create_personal_invite_markup(bot, user_id: int, first_name: str):
     """Create a single-use invite link that expires in 24 hours."""
     if not CHANNEL_ID:
@@ -192,11 +235,11 @@ def get_about_menu():
     ]
     return InlineKeyboardMarkup(keyboard)
 
-def get_join_menu(user_id: int = None):
+async def get_join_menu(user_id: int = None):
     keyboard = []
     
     if PAYMENT_LINK:
-        tracked_url = build_payment_url(user_id)
+        tracked_url = await build_payment_url(user_id)
         keyboard.append([InlineKeyboardButton("💳 Оплатить и вступить", url=tracked_url)])
     else:
         keyboard.append([InlineKeyboardButton("🙋‍♀️ Хочу в клуб! (Лист ожидания)", callback_data="join_waitlist")])
@@ -219,13 +262,8 @@ def get_back_menu():
 
 
 def load_text(filepath):
-    """Load text from a message file."""
-    try:
-        with open(filepath, "r", encoding="utf-8") as f:
-            return f.read()
-    except Exception as e:
-        logger.error(f"Error loading text file {filepath}: {e}")
-        return ""
+    """Load text from a message file (served from the preloaded template registry)."""
+    return templates.get_text(filepath)
 
 
 # --- CONVERSATION STATES ---
@@ -243,13 +281,15 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     # Log the new user for the admin
     logger.info(f"🆕 USER INTERACTION: {user.first_name} {user.last_name} ({username}, ID: {user.id})")
 
-    # Save user to Supabase
-    db.upsert_user(user.id, {
+    # Save user to Supabase, then load their email/access in one round-trip.
+    # In that order: for a new user the read must see the row the upsert creates.
+    await db_async.upsert_user(user.id, {
         "first_name": user.first_name,
         "last_name": user.last_name or "",
         "username": username,
         "status": "lead"
     })
+    user_ctx = await db_async.get_user_context(user.id)
 
     # Check if this is a reregistration deep link or command
     is_reregister = False
@@ -258,13 +298,13 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     elif update.message and update.message.text and update.message.text.startswith('/reregister'):
         is_reregister = True
     
-    user_record = db.get_user(user.id)
+    user_record = user_ctx["user"]
     has_email = user_record and user_record.get("email")
-    has_access = db.has_channel_access(user.id)
+    has_access = user_ctx["access_subscription"] is not None
 
     if has_access:
         if has_email:
-            await _send_welcome_flow(update, context, user, username)
+            await _send_welcome_flow(update, context, user, username, has_access=True)
             return ConversationHandler.END
         else:
             context.user_data['is_reregister'] = True
@@ -276,7 +316,7 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
 
     if is_reregister:
         if has_email:
-            await _send_welcome_flow(update, context, user, username)
+            await _send_welcome_flow(update, context, user, username, has_access=False)
             return ConversationHandler.END
         else:
             # Complete stranger clicking VIP link
@@ -296,7 +336,7 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
         return AWAITING_EMAIL
         
     # Normal lead who already gave email -> standard welcome menu
-    await _send_welcome_flow(update, context, user, username)
+    await _send_welcome_flow(update, context, user, username, has_access=False)
     return ConversationHandler.END
 
 async def receive_email(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
@@ -310,55 +350,43 @@ async def receive_email(update: Update, context: ContextTypes.DEFAULT_TYPE) -> i
         return AWAITING_EMAIL
         
     # Valid email! Save it.
-    db.upsert_user(user.id, {"email": email})
+    await db_async.upsert_user(user.id, {"email": email})
     
     # ---------------------------------------------------------
     # AUTOMATIC LOST USER RECOVERY CHECK
     # ---------------------------------------------------------
     try:
-        if os.path.exists('recovery_list.json'):
-            with open('recovery_list.json', 'r', encoding='utf-8') as f:
-                recovery_data = json.load(f)
-                
-            if email in recovery_data:
-                lost_user = recovery_data[email]
-                logger.info(f"✨ RECOVERY SUCCESS: {user.first_name} ({email}) was a lost user!")
-                
-                # Grant them 30 days of active subscription
-                db.add_subscription(
-                    user_id=user.id, 
-                    email=email, 
-                    name=lost_user.get('name', user.first_name), 
-                    source='auto_recovery'
-                )
-                
-                # Remove them from the JSON so they don't abuse it
-                del recovery_data[email]
-                with open('recovery_list.json', 'w', encoding='utf-8') as fw:
-                    json.dump(recovery_data, fw, ensure_ascii=False, indent=2)
-                
-                # Send the success message and channel link!
-                await update.message.reply_text(
-                    f"🎉 <b>Ура, {lost_user.get('name', user.first_name)}! Мы вас нашли!</b>\n\n"
-                    f"Ваш email (<code>{email}</code>) успешно привязан к вашей оплате на GetCourse.\n\n"
-                    f"Добро пожаловать в Клуб! Ваша подписка активна.",
-                    parse_mode="HTML"
-                )
-                
-                # Send invite link depending on how it's styled normally
-                if CHANNEL_ID:
-                    try:
-                        reply_markup = await create_personal_invite_markup(context.bot, user.id, user.first_name)
-                        await update.message.reply_text(
-                            "Нажмите на кнопку ниже, чтобы попасть в закрытый канал.\n\n"
-                            "⚠️ <b>Важно:</b> Ссылка действует 24 часа и только для вас. Не пересылайте её другим.",
-                            reply_markup=reply_markup,
-                            parse_mode="HTML"
-                        )
-                    except Exception as e:
-                        logger.error(f"Failed to generate recovery invite link: {e}")
-                
-                return ConversationHandler.END
+        # Checks, consumes and grants in one round-trip (club_claim_recovery)
+        lost_user = await db_async.claim_recovery(email, user.id, user.first_name)
+        if lost_user and lost_user.get('result') == db.RECOVERY_HAS_ACCESS:
+            # Already paying: no free month; the normal flow below greets them as a member
+            logger.info(f"ℹ️ Recovery entry for {email} not claimed: user {user.id} already has access")
+        elif lost_user:
+            await lifecycle_timers.timers.refresh_user(user.id)
+            logger.info(f"✨ RECOVERY SUCCESS: {user.first_name} ({email}) was a lost user!")
+            
+            # Send the success message and channel link!
+            await update.message.reply_text(
+                f"🎉 <b>Ура, {lost_user.get('name') or user.first_name}! Мы вас нашли!</b>\n\n"
+                f"Ваш email (<code>{email}</code>) успешно привязан к вашей оплате на GetCourse.\n\n"
+                f"Добро пожаловать в Клуб! Ваша подписка активна.",
+                parse_mode="HTML"
+            )
+            
+            # Send invite link depending on how it's styled normally
+            if CHANNEL_ID:
+                try:
+                    reply_markup = await create_personal_invite_markup(context.bot, user.id, user.first_name)
+                    await update.message.reply_text(
+                        "Нажмите на кнопку ниже, чтобы попасть в закрытый канал.\n\n"
+                        "⚠️ <b>Важно:</b> Ссылка действует 24 часа и только для вас. Не пересылайте её другим.",
+                        reply_markup=reply_markup,
+                        parse_mode="HTML"
+                    )
+                except Exception as e:
+                    logger.error(f"Failed to generate recovery invite link: {e}")
+            
+            return ConversationHandler.END
     except Exception as e:
         logger.error(f"Error checking recovery list: {e}")
     # ---------------------------------------------------------
@@ -368,14 +396,14 @@ async def receive_email(update: Update, context: ContextTypes.DEFAULT_TYPE) -> i
     is_reregister = context.user_data.pop('is_reregister', False)
     
     # Check if they currently have access already (e.g. active or grace period)
-    has_access = db.has_channel_access(user.id)
+    has_access = await db_async.has_channel_access(user.id)
     
     if has_access or is_reregister:
-        await _send_welcome_flow(update, context, user, username)
+        await _send_welcome_flow(update, context, user, username, has_access=has_access)
         return ConversationHandler.END
     
     # Proceed to normal welcome flow if not a current subscriber and didn't use reregister link
-    await _send_welcome_flow(update, context, user, username)
+    await _send_welcome_flow(update, context, user, username, has_access=has_access)
     return ConversationHandler.END
 
 async def cancel_email(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
@@ -412,19 +440,17 @@ async def handle_email_update_message(update: Update, context: ContextTypes.DEFA
         await update.message.reply_text("❌ Неверный формат email. Введите корректный адрес:")
         _awaiting_email_update_ids.add(user_id)
         return
-    db.upsert_user(user_id, {"email": email})
-    sub_record = db.get_access_subscription(user_id)
-    expires_at = sub_record.get("expires_at") if sub_record else None
-    renewed_count = sub_record.get("renewed_count", 0) if sub_record else 0
-    status = sub_record.get("status", "none") if sub_record else "none"
-    cabinet_text = get_cabinet_text(email, expires_at, renewed_count, status=status)
+    await db_async.upsert_user(user_id, {"email": email})
+    user_ctx = await db_async.get_user_context(user_id)
+    cabinet_text = _cabinet_text_from_context(user_ctx, email=email)
     await update.message.reply_html(
         f"✅ Email обновлён.\n\n{cabinet_text}",
         reply_markup=get_cabinet_menu()
     )
 
-async def _send_welcome_flow(update: Update, context: ContextTypes.DEFAULT_TYPE, user, username) -> None:
-    """The original welcome logic moved into a helper."""
+async def _send_welcome_flow(update: Update, context: ContextTypes.DEFAULT_TYPE, user, username,
+                             has_access: bool = None) -> None:
+    """The original welcome logic moved into a helper. Pass has_access if the caller already checked it."""
     # Send Notification to Admin
     if ADMIN_ID:
         try:
@@ -443,7 +469,8 @@ async def _send_welcome_flow(update: Update, context: ContextTypes.DEFAULT_TYPE,
     march_1 = datetime(2026, 3, 1)
     
     # Check if user currently has access (active or grace period)
-    has_access = db.has_channel_access(user.id)
+    if has_access is None:
+        has_access = await db_async.has_channel_access(user.id)
     
     # message could be from update.message or update.callback_query.message if called from elsewhere
     message_target = update.message if update.message else update.callback_query.message
@@ -488,7 +515,7 @@ async def menu_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> N
     elif data == "join":
         await query.edit_message_text(
             text=TEXT_JOIN,
-            reply_markup=get_join_menu(user_id=update.effective_user.id),
+            reply_markup=await get_join_menu(user_id=update.effective_user.id),
             parse_mode="HTML"
         )
     elif data == "join_waitlist":
@@ -513,21 +540,9 @@ async def menu_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> N
             parse_mode="HTML"
         )
     elif data == "cabinet":
-        # Fetch user and subscription data
-        user_id = update.effective_user.id
-        user_record = db.get_user(user_id)
-        sub_record = db.get_access_subscription(user_id)
-        
-        email = user_record.get("email") if user_record else None
-        expires_at = sub_record.get("expires_at") if sub_record else None
-        renewed_count = sub_record.get("renewed_count", 0) if sub_record else 0
-        
-        # Determine email fallback: check sub_record if user_record has none
-        if not email and sub_record:
-             email = sub_record.get("email")
-             
-        status = sub_record.get("status", "none") if sub_record else "none"
-        text = get_cabinet_text(email, expires_at, renewed_count, status=status)
+        # Fetch user and subscription data in one request
+        user_ctx = await db_async.get_user_context(update.effective_user.id)
+        text = _cabinet_text_from_context(user_ctx)
         
         await query.edit_message_text(
             text=text,
@@ -536,7 +551,7 @@ async def menu_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> N
         )
     elif data == "cabinet_payments":
         user_id = update.effective_user.id
-        subs = db.get_all_subscriptions_for_user(user_id)
+        subs = await db_async.get_all_subscriptions_for_user(user_id)
         
         if not subs:
             await query.answer("У вас пока нет истории платежей.", show_alert=True)
@@ -590,7 +605,7 @@ async def menu_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> N
         logger.info(f"🔔 User {user.first_name} ({user.id}) opted into March 1 reminder")
         
         # Save reminder preference to Supabase
-        db.upsert_user(user.id, {
+        await db_async.upsert_user(user.id, {
             "remind_march": True,
             "remind_opted_at": datetime.now().isoformat()
         })
@@ -620,8 +635,9 @@ async def menu_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> N
             return
         user_id = int(data.split("_")[2])
         # Extend by 7 days
-        success = db.extend_subscription(user_id, 7)
+        success = await db_async.extend_subscription(user_id, 7)
         if success:
+            await lifecycle_timers.timers.refresh_user(user_id)
             await query.edit_message_text(f"✅ Продлено на 7 дней для пользователя {user_id}.")
         else:
             await query.edit_message_text(f"❌ Ошибка продления для {user_id} (подписка не найдена в активных).")
@@ -630,17 +646,18 @@ async def menu_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> N
         if str(update.effective_user.id) != str(ADMIN_ID):
             return
         user_id = int(data.split("_")[2])
-        # Kick from channel
-        if CHANNEL_ID:
-            try:
-                await context.bot.ban_chat_member(chat_id=CHANNEL_ID, user_id=user_id)
-                await context.bot.unban_chat_member(chat_id=CHANNEL_ID, user_id=user_id)
-            except Exception as e:
-                logger.error(f"Failed to kick user {user_id}: {e}")
-        db.mark_expired(user_id)
-        
-        user_data = db.get_user(user_id)
+        user_data = await db_async.get_user(user_id)
         name = user_data.get('first_name', str(user_id)) if user_data else str(user_id)
+
+        # Kick from channel
+        result, = await kick_executor.kick_many(context.bot, CHANNEL_ID, [{'user_id': user_id, 'name': name}])
+        if not result.removed:
+            await query.edit_message_text(
+                f"⚠️ Не удалось удалить {name} ({user_id}): {result.outcome}. Попробуйте ещё раз."
+            )
+            return
+        await db_async.mark_expired(user_id)
+        lifecycle_timers.timers.disarm_user(user_id)
         await query.edit_message_text(f"❌ Пользователь {name} ({user_id}) удалён из канала.")
 
 async def send_invoice(context: ContextTypes.DEFAULT_TYPE, chat_id: int) -> None:
@@ -738,7 +755,7 @@ async def subscribers_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
     if str(user_id) != str(ADMIN_ID):
         return
 
-    subs = db.get_all_access_subscribers()
+    subs = await db_async.get_all_access_subscribers()
     
     if not subs:
         await update.message.reply_text("📭 Сейчас нет пользователей с доступом.")
@@ -773,7 +790,7 @@ async def link_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         await update.message.reply_text("tg_id должен быть числом.")
         return
         
-    db.upsert_user(int(target_id), {"email": email})
+    await db_async.upsert_user(int(target_id), {"email": email})
     await update.message.reply_text(f"✅ Email {email} привязан к ID {target_id}")
 
 async def renew_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
@@ -788,7 +805,7 @@ async def renew_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
             return
         await update.message.reply_text(
             text=TEXT_JOIN,
-            reply_markup=get_join_menu(user_id=user_id),
+            reply_markup=await get_join_menu(user_id=user_id),
             parse_mode="HTML"
         )
         return
@@ -804,7 +821,7 @@ async def renew_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     if target.isdigit():
         target_id = int(target)
     else:
-        user = db.get_user_by_email(target)
+        user = await db_async.get_user_by_email(target)
         if user:
             target_id = user['id']
             
@@ -812,741 +829,628 @@ async def renew_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         await update.message.reply_text(f"❌ Пользователь {target} не найден.")
         return
         
-    success = db.add_subscription(
+    success = await db_async.add_subscription(
         user_id=target_id,
         email=target if not target.isdigit() else None,
         source='manual_admin'
     )
     
     if success:
+        await lifecycle_timers.timers.refresh_user(target_id)
         await update.message.reply_text(f"✅ Подписка успешно обновлена/добавлена для ID {target_id}")
     else:
         await update.message.reply_text(f"❌ Произошла ошибка при обновлении подписки.")
 
 # --- /kickexpired Admin Command ---
 async def kickexpired_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    """(Admin Only) Two-phase kick: Phase 1 warns, Phase 2 kicks after 24h."""
+    """(Admin Only) Run the expiry half of the lifecycle now: grace period notices and kicks."""
     user_id = update.effective_user.id
     if str(user_id) != str(ADMIN_ID):
         return
 
     await update.message.reply_text("⏳ Проверяю подписки...")
-    
-    # PHASE 1: Warn users who haven't been warned yet
-    not_warned = db.get_expired_not_warned()
-    warned_count = 0
-    
-    for sub in not_warned:
-        sub_user_id = sub['user_id']
-        try:
-            await context.bot.send_message(
-                chat_id=sub_user_id,
-                text=db.EXPIRY_WARNING_TEXT,
-                reply_markup=_renew_button(sub_user_id)
-            )
-        except Exception:
-            pass  # User may have blocked the bot
-        db.set_expiry_warning(sub_user_id)
-        warned_count += 1
-    
-    # PHASE 2: Kick users who were warned 24+ hours ago
-    ready_to_kick = db.get_warned_and_ready_to_kick(hours=24)
-    kicked = 0
-    failed = 0
-    already_gone = 0
-    
-    for sub in ready_to_kick:
-        sub_user_id = sub['user_id']
-        
-        try:
-            # Final message before kick
-            try:
-                await context.bot.send_message(
-                    chat_id=sub_user_id,
-                    text="❌ Вы не продлили подписку. Доступ закрыт.\nЧтобы вернуться — оплатите снова:",
-                    reply_markup=_renew_button(sub_user_id)
-                )
-            except Exception:
-                pass
-            
-            # Kick from channel
-            if CHANNEL_ID:
-                try:
-                    await context.bot.ban_chat_member(chat_id=CHANNEL_ID, user_id=sub_user_id)
-                    await context.bot.unban_chat_member(chat_id=CHANNEL_ID, user_id=sub_user_id)
-                    kicked += 1
-                except Exception as e:
-                    err_str = str(e).lower()
-                    if 'user not found' in err_str or 'not a member' in err_str or 'PARTICIPANT_ID_INVALID' in err_str:
-                        already_gone += 1
-                    else:
-                        failed += 1
-                        logger.error(f"Failed to kick {sub_user_id}: {e}")
-            
-            # Mark expired in DB
-            db.mark_expired(sub_user_id)
-            
-        except Exception as e:
-            failed += 1
-            logger.error(f"Error processing {sub_user_id}: {e}")
-    
+
+    counts = await run_lifecycle_pass(actions=(lifecycle.GRACE, lifecycle.KICK))
+
     report = (
         f"📊 <b>Результат /kickexpired</b>\n\n"
-        f"⚠️ <b>Фаза 1 — Предупреждения:</b>\n"
-        f"   Отправлено предупреждений: {warned_count}\n\n"
-        f"🚫 <b>Фаза 2 — Удаление (предупреждены 24ч+ назад):</b>\n"
-        f"   Удалено из канала: {kicked}\n"
-        f"   Уже не в канале: {already_gone}\n"
-        f"   Ошибки: {failed}\n"
-        f"   Всего удалено: {len(ready_to_kick)}"
+        f"⚠️ <b>Переведены в резервный доступ ({db.GRACE_DAYS} дня):</b> {counts[lifecycle.GRACE]}\n\n"
+        f"🚫 <b>Удаление (резервный доступ закончился):</b>\n"
+        f"   Удалено из канала: {counts['kicked']}\n"
+        f"   Уже не в канале: {counts['already_gone']}\n"
+        f"   Ошибки: {counts['failed']}\n"
+        f"   Всего удалено: {counts[lifecycle.KICK]}"
     )
-    
-    if warned_count > 0 and len(ready_to_kick) == 0:
-        report += "\n\n💡 Предупреждения отправлены! Запустите /kickexpired ещё раз через 24 часа чтобы удалить тех, кто не продлил."
-    elif warned_count == 0 and len(ready_to_kick) == 0:
+
+    if not counts[lifecycle.GRACE] and not counts[lifecycle.KICK] and not counts['failed']:
         report += "\n\n✅ Нет просроченных подписок. Все в порядке!"
-    
+
     await update.message.reply_html(report)
 
 # --- Global Application Reference for Scheduler ---
 bot_application = None
 
 # --- Scheduler Jobs ---
-def _renew_button(user_id: int = None):
+async def _renew_button(user_id: int = None):
     """Create the inline '✅ ПРОДЛИТЬ ПОДПИСКУ' button."""
     if PAYMENT_LINK:
-        tracked_url = build_payment_url(user_id)
+        tracked_url = await build_payment_url(user_id)
         return InlineKeyboardMarkup([[InlineKeyboardButton("✅ ПРОДЛИТЬ ПОДПИСКУ", url=tracked_url)]])
     return None
 
-async def check_reminders_job():
-    """Daily job: Send Day-27 reminders ('Ваша подписка закончится через 3 дня!')"""
-    if not bot_application:
+GRACE_NOTICE_TEXT = "⚠️ <b>Ваша подписка закончилась!</b>\n\nМы сохраняем за вами место и даем 3 дня резервного доступа (Grace Period). Пожалуйста, продлите подписку, чтобы мы не закрыли доступ."
+KICK_NOTICE_TEXT = "❌ <b>Время вышло.</b> Ваш 3-дневный резервный доступ завершен.\n\nДоступ в канал закрыт. Чтобы вернуться, оплатите подписку снова:"
+
+async def notify_admin_kicks(results, title: str) -> None:
+    """One admin message summarizing a batch of kicks (see kick_executor)."""
+    if not ADMIN_ID or not results:
         return
-        
-    logger.info("⏰ Running Day-27 reminder check...")
-    subs = db.get_subscribers_needing_reminder()
-    
-    for sub in subs:
+    try:
+        await bot_application.bot.send_message(
+            chat_id=ADMIN_ID,
+            text=kick_executor.format_summary(results, title),
+            parse_mode="HTML"
+        )
+    except Exception as e:
+        logger.error(f"Failed to send kick summary to admin: {e}")
+
+async def apply_lifecycle_plan(transitions, actions=lifecycle.ACTIONS) -> dict:
+    """
+    Carry out due lifecycle transitions (see lifecycle.py) with batched writes.
+    Returns {action: count, 'kicked'/'already_gone'/'failed': count}.
+    """
+    counts = {action: 0 for action in lifecycle.ACTIONS}
+    counts.update(kicked=0, already_gone=0, failed=0)
+    if not bot_application:
+        return counts
+
+    bot = bot_application.bot
+    plan = lifecycle.group_by_action(transitions)
+    bucket = TokenBucket()
+
+    async def notify(sub, text, parse_mode=None) -> bool:
+        user_id = sub['user_id']
+        markup = await _renew_button(user_id)
         try:
-            await bot_application.bot.send_message(
-                chat_id=sub['user_id'],
-                text=db.REMINDER_TEXT,
-                reply_markup=_renew_button(sub['user_id'])
-            )
-            db.mark_reminder_sent(sub['id'])
-            logger.info(f"📨 Day-27 reminder sent to {sub['user_id']}")
+            await call_with_retry(lambda: bot.send_message(
+                chat_id=user_id, text=text, reply_markup=markup, parse_mode=parse_mode
+            ), bucket, idempotent=False)
+            return True
+        except TimedOut as e:
+            # Possibly delivered: count it as sent rather than risk a second copy
+            logger.warning(f"Lifecycle message to {user_id} timed out, not resending: {e}")
+            return True
         except Exception as e:
-            logger.error(f"Failed to send reminder to {sub['user_id']}: {e}")
-
-async def check_tomorrow_reminder_job():
-    """Job: Send Day-29 reminders ('Ваша подписка закончится через день!')"""
-    if not bot_application:
+            logger.error(f"Failed to send lifecycle message to {user_id}: {e}")
+            return False
+
+    # Day 27 and Day 29 reminders; Day 29 also sets reminder_sent (it supersedes Day 27)
+    reminded_ids = {lifecycle.REMIND_3D: [], lifecycle.REMIND_1D: []}
+    for action, text in ((lifecycle.REMIND_3D, db.REMINDER_TEXT), (lifecycle.REMIND_1D, db.REMINDER_TOMORROW_TEXT)):
+        if action not in actions or not plan[action]:
+            continue
+        logger.info(f"⏰ Lifecycle: sending {len(plan[action])} {action} reminders...")
+
+        async def remind(sub, text=text, action=action):
+            if await notify(sub, text):
+                reminded_ids[action].append(sub['id'])
+                counts[action] += 1
+
+        await run_bounded(plan[action], remind)
+    await db_async.mark_reminders_sent_many(reminded_ids[lifecycle.REMIND_3D])
+    await db_async.mark_tomorrow_reminders_sent_many(reminded_ids[lifecycle.REMIND_1D])
+
+    # Day 30: expired -> grace_period, then tell the user
+    if lifecycle.GRACE in actions and plan[lifecycle.GRACE]:
+        logger.info(f"⏰ Lifecycle: moving {len(plan[lifecycle.GRACE])} subscriptions to grace period...")
+        # Only rows still active move (a renewal while the reminders went out wins); only they are told
+        moved = set(await db_async.set_grace_period_many([sub['id'] for sub in plan[lifecycle.GRACE]]))
+        counts[lifecycle.GRACE] = len(moved)
+        await run_bounded([sub for sub in plan[lifecycle.GRACE] if sub['id'] in moved],
+                          lambda sub: notify(sub, GRACE_NOTICE_TEXT, "HTML"))
+
+    # Day 33: grace period over -> final message, kick, expired
+    if lifecycle.KICK in actions and plan[lifecycle.KICK]:
+        logger.info(f"⏰ Lifecycle: kicking {len(plan[lifecycle.KICK])} subscriptions after grace period...")
+
+        async def final_notice(sub):
+            return {"text": KICK_NOTICE_TEXT, "parse_mode": "HTML",
+                    "reply_markup": await _renew_button(sub['user_id'])}
+
+        # Expire first, and only rows still in grace_period: a user who renewed meanwhile is never kicked
+        expired = set(await db_async.mark_subscriptions_expired_many(
+            [sub['id'] for sub in plan[lifecycle.KICK]], status="grace_period"
+        ))
+        targets = [sub for sub in plan[lifecycle.KICK] if sub['id'] in expired]
+        results = await kick_executor.kick_many(bot, CHANNEL_ID, targets, final_notice, bucket)
+        outcomes = kick_executor.count_outcomes(results)
+        counts['kicked'] = outcomes[kick_executor.KICKED] + outcomes[kick_executor.SKIPPED]
+        counts['already_gone'] = outcomes[kick_executor.ALREADY_GONE]
+        counts['failed'] = outcomes[kick_executor.TRANSIENT] + outcomes[kick_executor.FAILED]
+        # Failed kicks go back to grace_period and are retried
+        await db_async.restore_grace_period_many([r.target['id'] for r in results if not r.removed])
+        counts[lifecycle.KICK] = counts['kicked'] + counts['already_gone']
+        await notify_admin_kicks(results, "Автоматическое удаление: подписка истекла")
+
+    logger.info(f"✅ Lifecycle transitions applied: {counts}")
+    return counts
+
+async def run_lifecycle_pass(actions=lifecycle.ACTIONS) -> dict:
+    """Apply every transition that is due now (one query), without waiting for its timer."""
+    async with lifecycle_timers.timers.lock:  # never overlaps a timer batch
+        subs = await db_async.get_lifecycle_candidates(lifecycle.LOOKAHEAD_HOURS)
+        counts = await apply_lifecycle_plan(lifecycle.plan_transitions(subs), actions)
+    lifecycle_timers.timers.request_resync()  # armed timers may point at rows changed just now
+    return counts
+
+from broadcast import check_campaign_job, campaign_schedule
+
+CAMPAIGN_CONFIG_CHECK = 300  # seconds between checks of campaign_config*.json for edits
+
+def _single_flight(coro_func, lock: asyncio.Lock = None):
+    """
+    JobQueue callback for coro_func(); a tick that arrives while the previous run (or
+    anything else holding `lock`) is still going is skipped. The callback returns whether it ran.
+    """
+    lock = lock or asyncio.Lock()
+
+    async def callback(context: ContextTypes.DEFAULT_TYPE) -> bool:
+        if lock.locked():
+            logger.warning(f"⏭️ {coro_func.__name__} is still running, skipping this tick")
+            return False
+        async with lock:
+            await coro_func()
+        return True
+
+    return callback
+
+_campaign_lock = asyncio.Lock()  # held by a campaign run or a schedule refresh, never both
+_run_campaign_job = _single_flight(check_campaign_job, _campaign_lock)
+
+def arm_campaign_wakeup(job_queue) -> None:
+    """(Re)schedule the campaign job for the earliest pending send_time_utc, replacing the old wake-up."""
+    for job in job_queue.get_jobs_by_name("campaign_wakeup"):
+        job.schedule_removal()
+    due = campaign_schedule.next_due()
+    if due is None:
         return
-        
-    logger.info("⏰ Running Day-29 (tomorrow) reminder check...")
-    subs = db.get_subscribers_expiring_tomorrow()
+    delay = max(0.0, (due - datetime.now(timezone.utc)).total_seconds())
+    job_queue.run_once(_campaign_wakeup, when=delay, name="campaign_wakeup")
+    logger.info(f"📅 Next campaign message at {due.isoformat()} (in {delay:.0f}s)")
+
+async def _campaign_wakeup(context: ContextTypes.DEFAULT_TYPE) -> None:
+    # A skipped wake-up leaves re-arming to the run that is still going
+    if await _run_campaign_job(context):
+        arm_campaign_wakeup(context.job_queue)
+
+async def _campaign_config_check(context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Recompile the campaign schedule when a config file changed (no database work otherwise)."""
+    if _campaign_lock.locked():
+        return  # a run is sending: it refreshes first and re-arms the wake-up when done
+    async with _campaign_lock:
+        changed = await campaign_schedule.refresh()
+    if changed:
+        arm_campaign_wakeup(context.job_queue)
+
+def schedule_jobs(application: Application) -> None:
+    """Register the periodic jobs on the Application's JobQueue (runs on the bot's event loop)."""
+    job_queue = application.job_queue
+    if job_queue is None:
+        logger.error("❌ JobQueue unavailable: install python-telegram-bot[job-queue]")
+        return
+
+    # --- CAMPAIGN AUTOPILOT ---
+    # The campaign job wakes up at the next send_time_utc (arm_campaign_wakeup); this job
+    # only notices edited config files and re-arms the wake-up
+    job_queue.run_repeating(
+        _campaign_config_check, interval=CAMPAIGN_CONFIG_CHECK, first=5, name="campaign_config_check",
+        job_kwargs={"coalesce": True},
+    )
+    # Day 27/29 reminders, Day 30 grace period and Day 33 kicks run on lifecycle timers (see serve)
+    logger.info("📅 Jobs scheduled (Campaign at its send times, lifecycle on timers)")
+
+
+# --- CHANNEL JOIN REQUESTS ---
+async def approve_join_request(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Auto-approves join requests for paid subscribers."""
+    chat_join_request = update.chat_join_request
+    user_id = chat_join_request.from_user.id
+    chat_id = chat_join_request.chat.id
+    
+    logger.info(f"🔔 Received join request from {user_id} for chat {chat_id}")
+    
+    # Check if user currently has channel access in Supabase
+    is_valid = await db_async.has_channel_access(user_id)
     
-    for sub in subs:
+    if is_valid:
+        logger.info(f"✅ Auto-approving {user_id} (Found in Supabase)")
         try:
-            await bot_application.bot.send_message(
-                chat_id=sub['user_id'],
-                text=db.REMINDER_TOMORROW_TEXT,
-                reply_markup=_renew_button(sub['user_id'])
-            )
-            logger.info(f"📨 Day-29 reminder sent to {sub['user_id']}")
+            await context.bot.approve_chat_join_request(chat_id=chat_id, user_id=user_id)
+            await context.bot.send_message(chat_id=user_id, text="✅ Ваша заявка одобрена! Добро пожаловать в клуб.")
         except Exception as e:
-            logger.error(f"Failed to send tomorrow reminder to {sub['user_id']}: {e}")
+            logger.error(f"Failed to approve request for {user_id}: {e}")
+    else:
+        logger.info(f"⏳ User {user_id} not found/active in Supabase. Ignoring request.")
 
-async def check_exact_expiry_job():
-    """Job: Send exact expiry notice and move to grace period."""
-    if not bot_application:
-        return
+
+# --- WEBHOOK SERVER (ASGI, served in the bot's event loop) ---
+PAID_STATUSES = ['completed', 'paid', 'оплачен', 'завершен', 'success']
+ENDED_STATUSES = ['expired', 'завершена', 'cancelled', 'canceled', 'отменен', 'отменена']
+
+# Side effects of webhooks run through the durable outbox (outbox.py): the handler
+# enqueues them and returns, the worker in this event loop delivers and retries.
+
+@outbox.handler("notify_admin")
+async def _notify_admin_job(payload: dict) -> None:
+    if ADMIN_ID:
+        await bot_application.bot.send_message(
+            chat_id=ADMIN_ID,
+            text=payload["text"],
+            parse_mode=payload.get("parse_mode")
+        )
+
+
+@outbox.handler("send_invite")
+async def _send_invite_job(payload: dict) -> None:
+    chat_id, name = payload["chat_id"], payload.get("name")
+    reply_markup = await create_personal_invite_markup(
+        bot_application.bot,
+        chat_id,
+        name or str(chat_id)
+    )
+    await bot_application.bot.send_message(
+        chat_id=chat_id,
+        text=TEXT_SUCCESS,
+        parse_mode="HTML",
+        reply_markup=reply_markup
+    )
+    logger.info(f"✅ Invite link sent to {chat_id}")
+
+
+@outbox.handler("expiry_notice")
+async def _expiry_notice_job(payload: dict) -> None:
+    # Send clean expiry message with renew button
+    await bot_application.bot.send_message(
+        chat_id=payload["chat_id"],
+        text=db.EXPIRY_WARNING_TEXT,
+        reply_markup=await _renew_button(payload["chat_id"])
+    )
+
+
+@outbox.handler("kick")
+async def _kick_job(payload: dict) -> None:
+    chat_id, name = payload["chat_id"], payload.get("name")
+    # Kick from channel
+    results = await kick_executor.kick_many(bot_application.bot, CHANNEL_ID, [{'user_id': chat_id, 'name': name}])
+    if results[0].outcome == kick_executor.TRANSIENT:
+        raise RuntimeError(f"kick of {chat_id} failed transiently: {results[0].error}")  # outbox retries
+    logger.info(f"🚫 Webhook kick of {chat_id}: {results[0].outcome}")
+
+    # Notify Admin
+    await db_async.run(outbox.enqueue, "notify_admin", {
+        "text": kick_executor.format_summary(results, "Удаление (вебхук GC)"),
+        "parse_mode": "HTML",
+    }, f"notify_admin:{payload['key']}")
+
+
+async def _webhook_data(request: Request) -> dict:
+    """GetCourse sends GET or POST; data can be in URL params, form body, or JSON. Merge all sources."""
+    data = dict(request.query_params)
+    if request.method == "POST":
+        if "application/json" in request.headers.get("content-type", ""):
+            try:
+                body = await request.json()
+            except ValueError:
+                body = None
+            if isinstance(body, dict):
+                data.update(body)
+        else:
+            data.update(await request.form())
+    return data
+
+
+async def payment_webhook(request: Request):
+    """Handle incoming GetCourse payment callbacks."""
+    event_key = None
+    completed = False  # the key is marked done; from then on it is never released
+    try:
+        data = await _webhook_data(request)
         
-    logger.info("⏰ Running exact expiry check (moving to grace period)...")
-    subs = db.get_newly_expired_subscribers()
-    
-    for sub in subs:
-        user_id = sub['user_id']
-        db.set_grace_period(sub['id'])
-        try:
-            await bot_application.bot.send_message(
-                chat_id=user_id,
-                text="⚠️ <b>Ваша подписка закончилась!</b>\n\nМы сохраняем за вами место и даем 3 дня резервного доступа (Grace Period). Пожалуйста, продлите подписку, чтобы мы не закрыли доступ.",
-                reply_markup=_renew_button(user_id),
-                parse_mode="HTML"
+        logger.info(f"📥 GetCourse webhook received: {dict(data)}")
+        
+        # Empty request (e.g. GET health check) - return OK
+        if not data and request.method == 'GET':
+            return JSONResponse({"status": "ok", "message": "Webhook endpoint ready"})
+        
+        def _raw(val):
+            if val is None: return None
+            s = (val if isinstance(val, str) else str(val)).strip()
+            return s or None
+        def _substituted(val):
+            raw = _raw(val)
+            if not raw: return None
+            if "{{" in str(raw) and "}}" in str(raw):
+                return None  # unsubstituted GetCourse template
+            return raw
+        
+        def get_val(*keys):
+            """Try multiple key names (GetCourse uses object.user.email, etc.)."""
+            for k in keys:
+                v = data.get(k)
+                if v is not None:
+                    return _substituted(v)
+            return None
+        
+        # Email (object.user.email, user_email, mail, email)
+        email = (get_val('email', 'user_email', 'mail', 'object_user_email') or '').lower() or None
+        name = get_val('name', 'first_name', 'object_user_first_name', 'user_name')
+        status_raw = get_val('status', 'order_status', 'object_status')
+        status = (status_raw or '').lower() or None
+
+        # Repeated callback for the same order event (GetCourse retries, GET + POST pairs):
+        # answer right away. The claim is a single SQLite statement, so two copies never both win.
+        status_class = 'paid' if status in PAID_STATUSES else 'ended' if status in ENDED_STATUSES else (status or 'none')
+        event_key = webhook_dedup.event_key(data, status_class)
+        if not await db_async.run(webhook_dedup.claim, event_key):
+            logger.info(f"♻️ Duplicate GetCourse webhook ignored ({status_class}, key {event_key})")
+            return JSONResponse({"status": "ok", "duplicate": True})
+        
+        # METHOD 1: Token-based lookup
+        token = get_val('token')
+        chat_id = None
+        if token and str(token).startswith('tok_'):
+            try:
+                chat_id = await db_async.run(pt.lookup_token, token)
+                if chat_id:
+                    logger.info(f"🎫 Token resolved to user {chat_id}")
+            except Exception as e:
+                logger.error(f"Token lookup failed for {token}: {e}")
+        
+        # METHOD 2: Telegram ID (GetCourse may pass utm_tg_id from payment link)
+        if not chat_id:
+            for key in ('tg_id', 'utm_tg_id', 'telegram_id', 'user_id', 
+                        'create_session_utm_tg_id'):
+                v = get_val(key)
+                if v:
+                    try:
+                        chat_id = int(v)
+                        logger.info(f"🎫 Found tg_id from {key}")
+                        break
+                    except (TypeError, ValueError):
+                        pass
+        
+        if any("{{" in str(v) and "}}" in str(v) for v in data.values()):
+            logger.warning(
+                "⚠️ GetCourse sent unsubstituted template vars. "
+                "In GetCourse process: use {object.user.email}, {object.status}, "
+                "and pass utm_tg_id via payment link UTM. URL: api_url/?tg_id={object.user.telegram_id}&email={object.user.email}&status={object.status}"
             )
-            logger.info(f"📨 Exact expiry notice sent to {user_id} (Moved to grace_period)")
-        except Exception as e:
-            logger.error(f"Failed to send exact expiry notice to {sub['user_id']}: {e}")
-
-async def check_expiries_job():
-    """Job: Final kick after grace period ends."""
-    if not bot_application:
-        return
         
-    logger.info("⏰ Running grace period expiry check (auto-kick)...")
-    expired = db.get_expired_subscribers()
-    
-    for sub in expired:
-        try:
-            user_id = sub['user_id']
-            name = sub.get('name') or sub.get('email') or str(user_id)
-            
-            # Send final kick message
-            await bot_application.bot.send_message(
-                chat_id=user_id,
-                text="❌ <b>Время вышло.</b> Ваш 3-дневный резервный доступ завершен.\n\nДоступ в канал закрыт. Чтобы вернуться, оплатите подписку снова:",
-                reply_markup=_renew_button(user_id),
-                parse_mode="HTML"
+        # METHOD 3: Email matching via Supabase (critical fallback)
+        if not chat_id and email:
+            user = await db_async.get_user_by_email(email)
+            if user:
+                chat_id = user['id']
+                logger.info(f"🔄 Matched payment to user {chat_id} by email: {email}")
+        
+        # Coerce chat_id to int if it came as string
+        if chat_id is not None:
+            try:
+                chat_id = int(chat_id)
+            except (TypeError, ValueError):
+                chat_id = None
+        
+        logger.info(f"💰 Parsed: token={token}, tg_id={chat_id}, status={status}, email={email}")
+        
+        if not chat_id:
+            if status in PAID_STATUSES and (email or name):
+                logger.warning(f"⚠️ UNLINKED PAYMENT: status={status} email={email} name={name} — no tg_id and no match by email. Ask user to /start and enter this email, then use /renew.")
+                if ADMIN_ID:
+                    await db_async.run(outbox.enqueue, "notify_admin", {
+                        "text": f"⚠️ <b>Оплата без привязки к Telegram</b>\n\n"
+                                f"GetCourse прислал оплату, но не передал tg_id и в базе нет пользователя с этим email.\n\n"
+                                f"Email: <code>{email or '—'}</code>\nИмя: {name or '—'}\n\n"
+                                f"Попросите клиента написать боту /start и ввести этот email, затем выдайте доступ: /renew email",
+                        "parse_mode": "HTML",
+                    }, f"unlinked:{email or name}:{datetime.now():%Y-%m-%d}")
+            await db_async.run(webhook_dedup.complete, event_key)
+            return JSONResponse({"status": "ignored", "reason": "no token or tg_id"})
+        
+        logger.info(f"💰 Payment Webhook: ID={chat_id} Status={status} Email={email}")
+        # Any payment event may change access; never answer from a stale cache entry
+        db.invalidate_access(chat_id)
+        
+        if status in PAID_STATUSES:
+            # 1. Add subscription to Supabase
+            sub = await db_async.add_subscription(
+                user_id=chat_id,
+                email=email,
+                name=name,
+                source='getcourse'
             )
-            
-            kick_succeeded = True
+            if not sub:
+                raise RuntimeError(f"subscription for {chat_id} was not recorded")
+            # The subscription exists now: a retry of this event must not add it a second time
+            await db_async.run(webhook_dedup.complete, event_key)
+            completed = True
+            await lifecycle_timers.timers.refresh_user(chat_id)  # the old row's timers are void
+            # 2. Queue the Telegram invite and admin notice (one per subscription row)
+            ref = sub['id']
+            await db_async.run(outbox.enqueue, "send_invite",
+                               {"chat_id": chat_id, "name": name}, f"send_invite:{ref}")
+            await db_async.run(outbox.enqueue, "notify_admin",
+                               {"text": f"💰 New Payment!\n{name}\nID: {chat_id}"}, f"notify_admin:payment:{ref}")
+
+        elif status in ENDED_STATUSES:
+            await db_async.mark_expired(chat_id)
+            lifecycle_timers.timers.disarm_user(chat_id)
+            logger.info(f"🚫 Webhook: User {chat_id} subscription expired/cancelled")
+            ref = f"{chat_id}:{datetime.now():%Y-%m-%d}"
+            await db_async.run(outbox.enqueue, "expiry_notice", {"chat_id": chat_id}, f"expiry_notice:{ref}")
+            await db_async.run(outbox.enqueue, "kick", {"chat_id": chat_id, "name": name, "key": ref}, f"kick:{ref}")
+
+        # Everything above is recorded: only now do copies of this event count as duplicates
+        if not completed:
+            await db_async.run(webhook_dedup.complete, event_key)
+        return JSONResponse({"status": "ok"})
 
-            # Kick from channel
-            if CHANNEL_ID:
-                try:
-                    await bot_application.bot.ban_chat_member(chat_id=CHANNEL_ID, user_id=user_id)
-                    await bot_application.bot.unban_chat_member(chat_id=CHANNEL_ID, user_id=user_id)
-                    logger.info(f"🚫 Auto-kicked expired user {user_id} from channel")
-                except Exception as e:
-                    kick_succeeded = False
-                    logger.error(f"Failed to kick {user_id} from channel: {e}")
-            
-            if kick_succeeded or not CHANNEL_ID:
-                db.mark_subscription_expired(sub['id'])
-            
-            # Notify Admin
-            if ADMIN_ID and (kick_succeeded or not CHANNEL_ID):
-                await bot_application.bot.send_message(
-                    chat_id=ADMIN_ID,
-                    text=f"🚫 <b>Автоматическое удаление</b>\n\n👤 {name} (ID: <code>{user_id}</code>)\nПодписка истекла → удалён из канала.",
-                    parse_mode="HTML"
-                )
-                
-        except Exception as e:
-            logger.error(f"Failed to process expiry for {sub['user_id']}: {e}")
+    except Exception as e:
+        logger.error(f"Webhook error: {e}")
+        if event_key and not completed:
+            await db_async.run(webhook_dedup.release, event_key)  # let GetCourse's retry through
+        return JSONResponse({"status": "error"}, status_code=500)
 
-def main() -> None:
-    """Run the bot."""
-    global bot_application
-    
-    if not BOT_TOKEN:
-        print("Error: BOT_TOKEN is not set.")
-        return
-        
-    application = Application.builder().token(BOT_TOKEN).build()
-    bot_application = application  # Store reference for scheduler
-
-    # Set bot command menu ("burger menu") for users
-    async def setup_commands(app: Application) -> None:
-        from telegram import BotCommand
-        commands = [
-            BotCommand("start", "Запустить бота / главное меню"),
-            BotCommand("help", "Получить помощь"),
-            BotCommand("renew", "Оплатить / продлить подписку"),
-        ]
-        admin_commands = [
-            BotCommand("subscribers", "Показать активных подписчиков"),
-            BotCommand("kickexpired", "Проверить и удалить просроченных"),
-            BotCommand("renew", "Ручное продление подписки"),
-            BotCommand("link", "Привязать email к tg_id"),
-        ]
-        # Global user commands
-        await app.bot.set_my_commands(commands, scope=None)
-        # Admin‑only menu (shown in chat with admin)
-        if ADMIN_ID:
-            from telegram import BotCommandScopeChat
-            await app.bot.set_my_commands(commands + admin_commands, scope=BotCommandScopeChat(int(ADMIN_ID)))
 
-    # Run command setup once on startup
-    application.post_init = setup_commands
+async def pay_redirect(request: Request):
+    """Deferred payment link: mint the token and resolve the email only on click."""
+    signed_id = request.path_params["signed_id"]
+    user_id = pt.verify_signed_user_id(signed_id)
+    if not user_id:
+        logger.warning(f"⚠️ Invalid /pay signature: {signed_id}")
+    url = await db_async.run(resolve_payment_url, user_id)
+    if not url:
+        return PlainTextResponse("Payment link is not configured", status_code=404)
+    return RedirectResponse(url, status_code=302)
+
 
-    # Handlers
-    application.add_handler(CommandHandler("start", start))
+async def health_check(request: Request):
+    """Just a health check endpoint."""
+    return PlainTextResponse("Bot is running")
+
+
+async def subscribers_api(request: Request):
+    """API: Get subscriber IDs for broadcast filtering."""
+    try:
+        subscriber_ids = list(await db_async.get_access_subscriber_ids())
+        return JSONResponse({
+            "count": len(subscriber_ids),
+            "subscriber_ids": subscriber_ids
+        })
+    except Exception as e:
+        logger.error(f"API error: {e}")
+        return JSONResponse({"error": str(e)}, status_code=500)
+
+
+def build_web_app() -> Starlette:
+    return Starlette(routes=[
+        Route('/webhook/payment', payment_webhook, methods=['GET', 'POST']),
+        Route('/pay/{signed_id}', pay_redirect, methods=['GET']),
+        Route('/', health_check, methods=['GET']),
+        Route('/api/subscribers', subscribers_api, methods=['GET']),
+    ])
+
+
+# --- STARTUP ---
+def build_application() -> Application:
+    # Pool sized for broadcasts + outbox + handlers; shared with every job via telegram_client
+    application = ApplicationBuilder().token(BOT_TOKEN).request(telegram_client.build_request()).build()
+
+    # --- HANDLERS ---
+    conv_handler = ConversationHandler(
+        entry_points=[CommandHandler("start", start), CommandHandler("reregister", start)],
+        states={
+            AWAITING_EMAIL: [
+                MessageHandler(filters.TEXT & ~filters.COMMAND, receive_email)
+            ],
+        },
+        fallbacks=[CommandHandler("cancel", cancel_email)],
+    )
+    application.add_handler(conv_handler)
+
+    application.add_handler(CommandHandler("help", help_cmd))
+    application.add_handler(CommandHandler("link", link_cmd))
+    application.add_handler(CommandHandler("renew", renew_cmd))
+    application.add_handler(CommandHandler("kickexpired", kickexpired_cmd))
+    application.add_handler(CommandHandler("subscribers", subscribers_cmd))
     application.add_handler(CommandHandler("leads", leads))
-    application.add_handler(CommandHandler("subscribers", subscribers_cmd))  # NEW
-    application.add_handler(CallbackQueryHandler(menu_callback))
     application.add_handler(CommandHandler("testpay", testpay))
-    
-    # Payment Handlers
+    # Handle "Изменить email" text reply (when user clicked that in cabinet)
+    application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND & _AwaitingEmailUpdateFilter(), handle_email_update_message))
+
     application.add_handler(PreCheckoutQueryHandler(precheckout_callback))
     application.add_handler(MessageHandler(filters.SUCCESSFUL_PAYMENT, successful_payment_callback))
+    application.add_handler(CallbackQueryHandler(menu_callback))
+    application.add_handler(ChatJoinRequestHandler(approve_join_request))
+    # ----------------
+    return application
 
-    print("Bot is running with Menus...")
-    
-    # Start Web Server for Render (Health Check + Webhook)
-    app = Flask(__name__)
-
-    @app.route('/')
-    def health_check():
-        return "Bot is alive!", 200
-
-    @app.route('/api/subscribers', methods=['GET'])
-    def get_subscribers_api():
-        """Return list of subscriber IDs for broadcast filtering."""
-        try:
-            subscribers = db.get_all_access_subscribers()
-            subscriber_ids = [s['user_id'] for s in subscribers]
-            return jsonify({
-                "status": "ok",
-                "count": len(subscriber_ids),
-                "subscriber_ids": subscriber_ids
-            }), 200
-        except Exception as e:
-            logger.error(f"Error getting subscribers: {e}")
-            return jsonify({"status": "error", "message": str(e)}), 500
 
-    @app.route('/webhook/payment', methods=['POST'])
-    def payment_webhook():
-        """Receive payment notifications from GetCourse."""
-        try:
-            data = request.json or {}
-            logger.info(f"📥 Received webhook: {data}")
-            
-            parsed = db.parse_getcourse_webhook(data)
-            
-            if not parsed or not parsed.get('chat_id'):
-                logger.warning("Webhook missing chat_id, cannot link to Telegram user")
-                return jsonify({"status": "ok", "note": "no chat_id"}), 200
-            
-            # Check payment status
-            status = str(parsed.get('status', '')).lower()
-            if status in ['completed', 'paid', 'оплачен', 'завершен', 'success']:
-                db.add_subscription(
-                    user_id=parsed['chat_id'],
-                    email=parsed.get('email'),
-                    name=parsed.get('name'),
-                    source='getcourse'
-                )
-                logger.info(f"✅ Payment recorded for {parsed['chat_id']}")
-                
-                # Schedule async tasks to run on the main event loop
-                chat_id = parsed['chat_id']
-                user_name = parsed.get('name') or parsed.get('email') or str(chat_id)
-                
-                # We'll use a simple approach: store tasks to run later
-                # For now, log and return - the user will get access via the channel
-                logger.info(f"🎫 User {chat_id} should receive invite link")
-                
-                # Try to send messages using threading
-                import threading
-                def send_messages():
-                    import asyncio
-                    async def do_send():
-                        try:
-                            if CHANNEL_ID and bot_application:
-                                # Create invite link
-                                reply_markup = await create_personal_invite_markup(
-                                    bot_application.bot,
-                                    int(chat_id),
-                                    user_name
-                                )
-                                # Send success message with invite link
-                                await bot_application.bot.send_message(
-                                    chat_id=chat_id,
-                                    text=TEXT_SUCCESS,
-                                    parse_mode="HTML",
-                                    reply_markup=reply_markup
-                                )
-                                logger.info(f"✅ Invite link sent to {chat_id}")
-                            
-                            if ADMIN_ID and bot_application:
-                                await bot_application.bot.send_message(
-                                    chat_id=ADMIN_ID,
-                                    text=f"💰 Новая оплата!\n{user_name}"
-                                )
-                                logger.info(f"✅ Admin notified about {chat_id}")
-                        except Exception as e:
-                            logger.error(f"Failed to send messages: {e}")
-                            
-                    try:
-                        asyncio.run(do_send())
-                    except Exception as e:
-                        logger.error(f"Asyncio run failed in thread: {e}")
-                
-                thread = threading.Thread(target=send_messages)
-                thread.start()
-            
-            return jsonify({"status": "ok"}), 200
-            
-        except Exception as e:
-            logger.error(f"Webhook error: {e}")
-            return jsonify({"status": "error", "message": str(e)}), 500
+async def set_bot_commands(application: Application) -> None:
+    """Set bot command menu (burger menu) so users/admins see /start and /help etc."""
+    user_commands = [
+        BotCommand("start", "Запустить бота / главное меню"),
+        BotCommand("help", "Помощь"),
+        BotCommand("renew", "Оплатить / продлить подписку"),
+    ]
+    await application.bot.set_my_commands(user_commands, scope=None)
+    if ADMIN_ID:
+        admin_commands = user_commands + [
+            BotCommand("subscribers", "Активные подписчики"),
+            BotCommand("kickexpired", "Удалить просроченных"),
+            BotCommand("renew", "Продлить подписку вручную"),
+            BotCommand("link", "Привязать email к tg_id"),
+        ]
+        await application.bot.set_my_commands(admin_commands, scope=BotCommandScopeChat(int(ADMIN_ID)))
 
-    def run_flask():
-        port = int(os.environ.get("PORT", 10000))
-        app.run(host="0.0.0.0", port=port)
 
-from broadcast import check_campaign_job
+async def serve(port: str = None) -> None:
+    """Bot polling and (on Render) the webhook server, both in this one event loop."""
+    global bot_application
+    bot_application = build_application()
+    telegram_client.set_bot(bot_application.bot)
 
-# ... (Logging config usually here, but keeping file structure)
+    logger.info("🤖 Starting Telegram Bot Polling...")
+    await bot_application.initialize()
+    await bot_application.start()
+    outbox_task = timers_task = None
+    try:
+        await set_bot_commands(bot_application)
+        await bot_application.updater.start_polling(allowed_updates=Update.ALL_TYPES)
+        logger.info("✅ Bot polling started successfully!")
+        schedule_jobs(bot_application)
+        outbox_task = asyncio.create_task(outbox.worker.run())
+        timers_task = asyncio.create_task(lifecycle_timers.timers.run(apply_lifecycle_plan))
+
+        if port:
+            # ON RENDER: serve the webhook endpoints until SIGTERM
+            logger.info(f"🚀 Starting webhook server on port {port}")
+            server = uvicorn.Server(uvicorn.Config(
+                build_web_app(), host="0.0.0.0", port=int(port), lifespan="off", log_level="info"
+            ))
+            await server.serve()
+        else:
+            # LOCAL: Just wait forever
+            logger.warning("⚠️ No PORT found. Running locally. Press Ctrl+C to stop.")
+            await asyncio.Event().wait()
+    except Exception as e:
+        logger.error(f"❌ FATAL ERROR in Bot: {e}", exc_info=True)
+        raise
+    finally:
+        for task in (outbox_task, timers_task):
+            if task:
+                task.cancel()
+        if bot_application.updater.running:
+            await bot_application.updater.stop()
+        await bot_application.stop()
+        await bot_application.shutdown()
 
-# --- WEBHOOK SERVER (Remote) ---
-# ... (Existing code)
 
 def run():
     """Runs the bot."""
     # Check if we are on Render (PORT exists)
     port = os.environ.get("PORT")
-    
-    # Setup Scheduler for daily checks (using BackgroundScheduler)
-    scheduler = BackgroundScheduler()
-    
-    # Wrapper to run async jobs from background scheduler
-    def run_async_job(coro_func):
-        def wrapper():
-            asyncio.run(coro_func())
-        return wrapper
-    
-    scheduler.add_job(run_async_job(check_reminders_job), 'interval', hours=4)  # Every 4 hours (Day 27)
-    scheduler.add_job(run_async_job(check_tomorrow_reminder_job), 'interval', hours=4)  # Every 4 hours (Day 29)
-    scheduler.add_job(run_async_job(check_exact_expiry_job), 'interval', hours=4)  # Every 4 hours (Day 30 - Grace Period)
-    scheduler.add_job(run_async_job(check_expiries_job), 'interval', hours=4)  # Every 4 hours (Day 33 - Kick)
-    
-    # --- CAMPAIGN AUTOPILOT ---
-    # Check for scheduled broadcast messages every minute
-    scheduler.add_job(run_async_job(check_campaign_job), 'interval', minutes=1)
-    
-    scheduler.start()
-    logger.info("📅 Scheduler started (Reminders 10:00, Expiries 10:30, Campaign every 1min)")
-
-    # Define Bot Polling Function
-    def run_telegram_bot():
-        loop = asyncio.new_event_loop()
-        asyncio.set_event_loop(loop)
-        logger.info("🤖 Starting Telegram Bot Polling...")
-        
-        # Initialize Application (shared with scheduler jobs and webhook)
-        global application
-        global bot_application
-        application = ApplicationBuilder().token(BOT_TOKEN).build()
-        bot_application = application
-
-        async def approve_join_request(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-            """Auto-approves join requests for paid subscribers."""
-            chat_join_request = update.chat_join_request
-            user_id = chat_join_request.from_user.id
-            chat_id = chat_join_request.chat.id
-            
-            logger.info(f"🔔 Received join request from {user_id} for chat {chat_id}")
-            
-            # Check if user currently has channel access in Supabase
-            is_valid = db.has_channel_access(user_id)
-            
-            if is_valid:
-                logger.info(f"✅ Auto-approving {user_id} (Found in Supabase)")
-                try:
-                    await context.bot.approve_chat_join_request(chat_id=chat_id, user_id=user_id)
-                    await context.bot.send_message(chat_id=user_id, text="✅ Ваша заявка одобрена! Добро пожаловать в клуб.")
-                except Exception as e:
-                    logger.error(f"Failed to approve request for {user_id}: {e}")
-            else:
-                logger.info(f"⏳ User {user_id} not found/active in Supabase. Ignoring request.")
-
-        # --- HANDLERS ---
-        conv_handler = ConversationHandler(
-            entry_points=[CommandHandler("start", start), CommandHandler("reregister", start)],
-            states={
-                AWAITING_EMAIL: [
-                    MessageHandler(filters.TEXT & ~filters.COMMAND, receive_email)
-                ],
-            },
-            fallbacks=[CommandHandler("cancel", cancel_email)],
-        )
-        application.add_handler(conv_handler)
-
-        application.add_handler(CommandHandler("help", help_cmd))
-        application.add_handler(CommandHandler("link", link_cmd))
-        application.add_handler(CommandHandler("renew", renew_cmd))
-        application.add_handler(CommandHandler("kickexpired", kickexpired_cmd))
-        application.add_handler(CommandHandler("subscribers", subscribers_cmd))
-        application.add_handler(CommandHandler("leads", leads))
-        application.add_handler(CommandHandler("testpay", testpay))
-        # Handle "Изменить email" text reply (when user clicked that in cabinet)
-        application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND & _AwaitingEmailUpdateFilter(), handle_email_update_message))
-
-        application.add_handler(PreCheckoutQueryHandler(precheckout_callback))
-        application.add_handler(MessageHandler(filters.SUCCESSFUL_PAYMENT, successful_payment_callback))
-        application.add_handler(CallbackQueryHandler(menu_callback))
-        application.add_handler(ChatJoinRequestHandler(approve_join_request))
-        # ----------------
-
-        async def start_bot():
-            """Async function to properly start the bot without signal handlers."""
-            await application.initialize()
-            await application.start()
-            # Set bot command menu (burger menu) so users/admins see /start and /help etc.
-            user_commands = [
-                BotCommand("start", "Запустить бота / главное меню"),
-                BotCommand("help", "Помощь"),
-                BotCommand("renew", "Оплатить / продлить подписку"),
-            ]
-            await application.bot.set_my_commands(user_commands, scope=None)
-            if ADMIN_ID:
-                admin_commands = user_commands + [
-                    BotCommand("subscribers", "Активные подписчики"),
-                    BotCommand("kickexpired", "Удалить просроченных"),
-                    BotCommand("renew", "Продлить подписку вручную"),
-                    BotCommand("link", "Привязать email к tg_id"),
-                ]
-                await application.bot.set_my_commands(admin_commands, scope=BotCommandScopeChat(int(ADMIN_ID)))
-            await application.updater.start_polling(allowed_updates=Update.ALL_TYPES)
-            logger.info("✅ Bot polling started successfully!")
-            # Keep running forever
-            while True:
-                await asyncio.sleep(3600)  # Sleep 1 hour, repeat
-
-        try:
-            loop.run_until_complete(start_bot())
-        except Exception as e:
-            logger.error(f"❌ FATAL ERROR in Bot Polling: {e}", exc_info=True)
 
-    # Start Telegram Bot in a separate thread
-    bot_thread = threading.Thread(target=run_telegram_bot, daemon=True)
-    bot_thread.start()
-    
-    if port:
-        # ON RENDER: Run Flask in Main Thread (Blocking)
-        logger.info(f"🚀 STARTING FLASK ON MAIN THREAD PORT: {port}")
-        
-        app = Flask(__name__)
-        
-        @app.route('/webhook/payment', methods=['GET', 'POST'])
-        def webhook():
-             """Handle incoming GetCourse payment callbacks."""
-             try:
-                # GetCourse sends GET or POST; data can be in URL params, form body, or JSON
-                # Merge all sources into one dict (args first, then form, then json)
-                data = {}
-                if request.args:
-                    data.update({k: v for k, v in request.args.items()})
-                if request.form:
-                    data.update({k: v for k, v in request.form.items()})
-                if request.is_json and request.get_json(silent=True):
-                    data.update(request.get_json())
-                
-                logger.info(f"📥 GetCourse webhook received: {dict(data)}")
-                
-                # Empty request (e.g. GET health check) - return OK
-                if not data and request.method == 'GET':
-                    return jsonify({"status": "ok", "message": "Webhook endpoint ready"}), 200
-                
-                def _raw(val):
-                    if val is None: return None
-                    s = (val if isinstance(val, str) else str(val)).strip()
-                    return s or None
-                def _substituted(val):
-                    raw = _raw(val)
-                    if not raw: return None
-                    if "{{" in str(raw) and "}}" in str(raw):
-                        return None  # unsubstituted GetCourse template
-                    return raw
-                
-                def get_val(*keys):
-                    """Try multiple key names (GetCourse uses object.user.email, etc.)."""
-                    for k in keys:
-                        v = data.get(k)
-                        if v is not None:
-                            return _substituted(v)
-                    return None
-                
-                # METHOD 1: Token-based lookup
-                token = get_val('token')
-                chat_id = None
-                if token and str(token).startswith('tok_'):
-                    try:
-                        import payment_tokens as pt
-                        chat_id = pt.lookup_token(token)
-                        if chat_id:
-                            logger.info(f"🎫 Token resolved to user {chat_id}")
-                    except ImportError:
-                        pass
-                
-                # METHOD 2: Telegram ID (GetCourse may pass utm_tg_id from payment link)
-                if not chat_id:
-                    for key in ('tg_id', 'utm_tg_id', 'telegram_id', 'user_id', 
-                                'create_session_utm_tg_id'):
-                        v = get_val(key)
-                        if v:
-                            try:
-                                chat_id = int(v)
-                                logger.info(f"🎫 Found tg_id from {key}")
-                                break
-                            except (TypeError, ValueError):
-                                pass
-                
-                # Email (object.user.email, user_email, mail, email)
-                email = (get_val('email', 'user_email', 'mail', 'object_user_email') or '').lower() or None
-                name = get_val('name', 'first_name', 'object_user_first_name', 'user_name')
-                status_raw = get_val('status', 'order_status', 'object_status')
-                status = (status_raw or '').lower() or None
-                
-                if any("{{" in str(v) and "}}" in str(v) for v in data.values()):
-                    logger.warning(
-                        "⚠️ GetCourse sent unsubstituted template vars. "
-                        "In GetCourse process: use {object.user.email}, {object.status}, "
-                        "and pass utm_tg_id via payment link UTM. URL: api_url/?tg_id={object.user.telegram_id}&email={object.user.email}&status={object.status}"
-                    )
-                
-                # METHOD 3: Email matching via Supabase (critical fallback)
-                if not chat_id and email:
-                    user = db.get_user_by_email(email)
-                    if user:
-                        chat_id = user['id']
-                        logger.info(f"🔄 Matched payment to user {chat_id} by email: {email}")
-                
-                # Coerce chat_id to int if it came as string
-                if chat_id is not None:
-                    try:
-                        chat_id = int(chat_id)
-                    except (TypeError, ValueError):
-                        chat_id = None
-                
-                logger.info(f"💰 Parsed: token={token}, tg_id={chat_id}, status={status}, email={email}")
-                
-                if not chat_id:
-                    if status in ['completed', 'paid', 'оплачен', 'завершен', 'success'] and (email or name):
-                        logger.warning(f"⚠️ UNLINKED PAYMENT: status={status} email={email} name={name} — no tg_id and no match by email. Ask user to /start and enter this email, then use /renew.")
-                        if ADMIN_ID:
-                            try:
-                                from telegram import Bot
-                                bot = Bot(token=BOT_TOKEN)
-                                asyncio.run(bot.send_message(
-                                    ADMIN_ID,
-                                    f"⚠️ <b>Оплата без привязки к Telegram</b>\n\n"
-                                    f"GetCourse прислал оплату, но не передал tg_id и в базе нет пользователя с этим email.\n\n"
-                                    f"Email: <code>{email or '—'}</code>\nИмя: {name or '—'}\n\n"
-                                    f"Попросите клиента написать боту /start и ввести этот email, затем выдайте доступ: /renew email",
-                                    parse_mode="HTML"
-                                ))
-                            except Exception as e:
-                                logger.error(f"Failed to notify admin of unlinked payment: {e}")
-                    return jsonify({"status": "ignored", "reason": "no token or tg_id"}), 200
-                
-                logger.info(f"💰 Payment Webhook: ID={chat_id} Status={status} Email={email}")
-                
-                if status in ['completed', 'paid', 'оплачен', 'завершен', 'success']:
-                    # 1. Add subscription to Supabase
-                    db.add_subscription(
-                        user_id=int(chat_id),
-                        email=email,
-                        name=name,
-                        source='getcourse'
-                    )
+    if not BOT_TOKEN:
+        print("Error: BOT_TOKEN is not set.")
+        return
 
-                    # 2. Send Telegram Invite (use bot_application set by run_telegram_bot)
-                    async def send_invite():
-                        app = bot_application or application
-                        if not app:
-                            logger.error("Bot not ready yet, invite not sent")
-                            return
-                        try:
-                            reply_markup = await create_personal_invite_markup(
-                                app.bot,
-                                int(chat_id),
-                                name or str(chat_id)
-                            )
-                            await app.bot.send_message(
-                                chat_id=chat_id,
-                                text=TEXT_SUCCESS,
-                                parse_mode="HTML",
-                                reply_markup=reply_markup
-                            )
-                            # Notify Admin
-                            if ADMIN_ID:
-                                await app.bot.send_message(
-                                    chat_id=ADMIN_ID,
-                                    text=f"💰 New Payment!\n{name}\nID: {chat_id}"
-                                )
-                        except Exception as e:
-                            logger.error(f"Failed to send invite: {e}")
-
-                    # Run the async function in the running bot's event loop
-                    try:
-                        loop = asyncio.get_running_loop()
-                    except RuntimeError:
-                        # If no running loop in this thread, find the bot application's loop
-                        # Assuming the bot is running in its own thread with an active loop
-                        loop = None
-                        
-                    # We will use another approach instead of creating a fresh loop which
-                    # causes issues with python-telegram-bot
-                    import threading
-                    def send_in_background():
-                        asyncio.run(send_invite())
-                        
-                    threading.Thread(target=send_in_background).start()
-
-                elif status in ['expired', 'завершена', 'cancelled', 'canceled', 'отменен', 'отменена']:
-                    db.mark_expired(int(chat_id))
-                    logger.info(f"🚫 Webhook: User {chat_id} subscription expired/cancelled")
-                    
-                    app = bot_application or application
-                    async def send_kick():
-                        if not app:
-                            return
-                        try:
-                            # Send clean expiry message with renew button
-                            await app.bot.send_message(
-                                chat_id=chat_id,
-                                text=db.EXPIRY_WARNING_TEXT,
-                                reply_markup=_renew_button(int(chat_id))
-                            )
-                            # Kick from channel
-                            if CHANNEL_ID:
-                                await app.bot.ban_chat_member(chat_id=CHANNEL_ID, user_id=chat_id)
-                                await app.bot.unban_chat_member(chat_id=CHANNEL_ID, user_id=chat_id)
-                                logger.info(f"🚫 Auto-kicked {chat_id} from channel via Webhook")
-                                
-                            # Notify Admin
-                            if ADMIN_ID:
-                                name_str = name or str(chat_id)
-                                await app.bot.send_message(
-                                    chat_id=ADMIN_ID,
-                                    text=f"🚫 <b>Удаление (вебхук GC)</b>\n👤 {name_str} (ID: <code>{chat_id}</code>)",
-                                    parse_mode="HTML"
-                                )
-                        except Exception as e:
-                            logger.error(f"Failed to process kick: {e}")
-
-                    import threading
-                    def kick_in_background():
-                        asyncio.run(send_kick())
-                        
-                    threading.Thread(target=kick_in_background).start()
-
-                return jsonify({"status": "ok"}), 200
-
-             except Exception as e:
-                logger.error(f"Webhook error: {e}")
-                return jsonify({"status": "error"}), 500
-             
-        # Just a health check endpoint
-        @app.route("/", methods=['GET'])
-        def health_check():
-            return "Bot is running", 200
-
-        # API: Get subscriber IDs for broadcast filtering
-        @app.route('/api/subscribers', methods=['GET'])
-        def get_subscribers_api():
-            """Return list of subscriber IDs for broadcast filtering."""
-            try:
-                subscriber_ids = list(db.get_access_subscriber_ids())
-                return jsonify({
-                    "count": len(subscriber_ids),
-                    "subscriber_ids": subscriber_ids
-                }), 200
-            except Exception as e:
-                logger.error(f"API error: {e}")
-                return jsonify({"error": str(e)}), 500
+    # Preload and validate all message templates: broken HTML fails the deploy here
+    templates.registry.load_all()
 
-        # Run Flask (Blocks forever)
-        app.run(host="0.0.0.0", port=int(port), debug=False, use_reloader=False)
-    else:
-        # LOCAL: Just wait forever (since bot is in thread)
-        logger.warning("⚠️ No PORT found. Running locally. Press Ctrl+C to stop.")
-        bot_thread.join()
+    # Purge expired payment tokens in the background
+    pt.start_expiry_thread()
+    
+    asyncio.run(serve(port))
 
 if __name__ == "__main__":
     run()
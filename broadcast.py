@@ -4,13 +4,21 @@ import asyncio
 import json
 import logging
 import glob
-from datetime import datetime, timezone
+import time
+import heapq
+import itertools
+from datetime import datetime, timedelta, timezone
 from dotenv import load_dotenv
-from telegram import Bot, InlineKeyboardButton, InlineKeyboardMarkup
-from telegram.error import Forbidden, BadRequest
+from telegram import InlineKeyboardButton, InlineKeyboardMarkup
+from telegram.error import Forbidden, TimedOut
 
-# Import our database layer
-import db
+import media_cache
+import telegram_client
+import templates
+from bulk_sender import TokenBucket, call_with_retry, run_bounded, BROADCAST_RATE, BROADCAST_CONCURRENCY
+
+# Import our database layer (async wrapper, this runs inside scheduler jobs)
+import db_async
 
 # Configuration
 load_dotenv()
@@ -27,30 +35,67 @@ logger = logging.getLogger(__name__)
 # TARGET LOADING FUNCTIONS
 # ============================================
 
-def get_target_users_for_campaign(target_type):
+async def get_target_users_for_campaign(target_type):
     """Get target users based on campaign target type."""
     if target_type == "non_subscribers":
-        return db.get_non_subscriber_ids()
+        return await db_async.get_non_subscriber_ids()
     elif target_type == "reminded":
-        return db.get_reminded_user_ids()
+        return await db_async.get_reminded_user_ids()
     elif target_type == "active_subscribers_not_renewed":
-        return db.get_subscribers_not_renewed()
+        return await db_async.get_subscribers_not_renewed()
     else:
         logger.warning(f"Unknown target type: {target_type}, falling back to non_subscribers")
-        return db.get_non_subscriber_ids()
+        return await db_async.get_non_subscriber_ids()
+
+
+# ============================================
+# DELIVERY LEDGER
+# ============================================
+
+LEDGER_BATCH_SIZE = 50
+# Never retried when a broadcast resumes; "unconfirmed" sends timed out and may have been delivered
+FINAL_DELIVERY_STATUSES = {"sent", "unconfirmed", "blocked"}
+
+
+class DeliveryLedger:
+    """Buffers per-recipient outcomes and writes them to club_campaign_deliveries in batches."""
+
+    def __init__(self, campaign_id: str, message_id: str, batch_size: int = LEDGER_BATCH_SIZE):
+        self.campaign_id = campaign_id
+        self.message_id = message_id
+        self.batch_size = batch_size
+        self._pending = []
+
+    async def record(self, user_id: int, status: str, error: str = None) -> None:
+        self._pending.append({
+            "campaign_id": self.campaign_id,
+            "message_id": self.message_id,
+            "user_id": user_id,
+            "status": status,
+            "error": error,
+        })
+        if len(self._pending) >= self.batch_size:
+            await self.flush()
+
+    async def flush(self) -> None:
+        rows, self._pending = self._pending, []
+        if rows and not await db_async.record_campaign_deliveries(rows):
+            # Keep them for the next flush rather than losing track of who got the message
+            self._pending = rows + self._pending
 
 
 # ============================================
 # BROADCAST LOGIC
 # ============================================
 
-async def broadcast_message(message_config, target_users):
-    """Send a specific message to target users."""
+async def broadcast_message(message_config, target_users, ledger: DeliveryLedger = None):
+    """Send a specific message to target users, recording each outcome in `ledger` if given."""
     if not BOT_TOKEN:
         logger.error("BOT_TOKEN missing")
         return 0, 0
 
-    bot = Bot(token=BOT_TOKEN)
+    # Shared long-lived client: its connection pool stays warm between broadcasts
+    bot = telegram_client.get_bot()
     
     if not target_users:
         logger.info("No target users for broadcast.")
@@ -59,11 +104,9 @@ async def broadcast_message(message_config, target_users):
     # Load Text
     text_content = ""
     if "text_file" in message_config:
-        try:
-            with open(message_config["text_file"], "r", encoding="utf-8") as f:
-                text_content = f.read()
-        except Exception as e:
-            logger.error(f"Could not read message file: {e}")
+        text_content = templates.registry.get(message_config["text_file"])
+        if text_content is None:
+            logger.error(f"Could not read message file: {message_config['text_file']}")
             return 0, 0
 
     # Prepare Buttons
@@ -79,110 +122,202 @@ async def broadcast_message(message_config, target_users):
     
     success_count = 0
     fail_count = 0
+    unconfirmed_count = 0
+    bucket = TokenBucket(BROADCAST_RATE)
 
-    for user_id in target_users:
-        try:
-            # Build keyboard
-            current_markup = None
-            keyboard_rows = []
-            
-            if btn_text and base_url:
-                # Use the same utm_tg_id convention as in the main bot,
-                # so GetCourse can reliably link payments to Telegram IDs.
-                separator = "&" if "?" in base_url else "?"
-                tracked_url = f"{base_url}{separator}utm_tg_id={user_id}"
-                keyboard_rows.append([InlineKeyboardButton(btn_text, url=tracked_url)])
-            
-            if has_support_button:
-                keyboard_rows.append([InlineKeyboardButton("Написать в поддержку", url="https://t.me/tymuron")])
-            
-            if keyboard_rows:
-                current_markup = InlineKeyboardMarkup(keyboard_rows)
-
-            # Send Media or Text
-            if "video_file" in message_config:
-                with open(message_config["video_file"], "rb") as video:
-                    await bot.send_video(chat_id=user_id, video=video, caption=text_content, parse_mode="HTML", reply_markup=current_markup)
-            elif "audio_file" in message_config:
-                with open(message_config["audio_file"], "rb") as audio:
-                    await bot.send_audio(chat_id=user_id, audio=audio, caption=text_content, parse_mode="HTML", reply_markup=current_markup)
-            else:
-                 await bot.send_message(chat_id=user_id, text=text_content, parse_mode="HTML", reply_markup=current_markup)
+    def build_markup(user_id):
+        keyboard_rows = []
+        
+        if btn_text and base_url:
+            # Use the same utm_tg_id convention as in the main bot,
+            # so GetCourse can reliably link payments to Telegram IDs.
+            separator = "&" if "?" in base_url else "?"
+            tracked_url = f"{base_url}{separator}utm_tg_id={user_id}"
+            keyboard_rows.append([InlineKeyboardButton(btn_text, url=tracked_url)])
+        
+        if has_support_button:
+            keyboard_rows.append([InlineKeyboardButton("Написать в поддержку", url="https://t.me/tymuron")])
+        
+        return InlineKeyboardMarkup(keyboard_rows) if keyboard_rows else None
+
+    async def send_one(user_id):
+        current_markup = build_markup(user_id)
 
+        # Send Media or Text
+        # (media is uploaded once, then re-sent by Telegram file_id)
+        if "video_file" in message_config:
+            await media_cache.send_video(bot, user_id, message_config["video_file"], caption=text_content, parse_mode="HTML", reply_markup=current_markup)
+        elif "audio_file" in message_config:
+            await media_cache.send_audio(bot, user_id, message_config["audio_file"], caption=text_content, parse_mode="HTML", reply_markup=current_markup)
+        else:
+            await bot.send_message(chat_id=user_id, text=text_content, parse_mode="HTML", reply_markup=current_markup)
+
+    async def deliver(user_id):
+        nonlocal success_count, fail_count, unconfirmed_count
+        status, error = "sent", None
+        try:
+            await call_with_retry(lambda: send_one(user_id), bucket, idempotent=False)
             success_count += 1
-            await asyncio.sleep(0.05) # Rate limit
-            
+        except TimedOut as e:
+            # Possibly delivered: resending could show the message twice
+            logger.warning(f"Send to {user_id} timed out, not resending: {e}")
+            unconfirmed_count += 1
+            status, error = "unconfirmed", str(e)[:500]
         except Forbidden:
             # User blocked bot — mark in DB
-            db.upsert_user(user_id, {"status": "blocked"})
+            await db_async.upsert_user(user_id, {"status": "blocked"})
             fail_count += 1
+            status = "blocked"
         except Exception as e:
             logger.error(f"Failed to send to {user_id}: {e}")
             fail_count += 1
+            status, error = "failed", str(e)[:500]
+        if ledger:
+            await ledger.record(user_id, status, error)
 
-    logger.info(f"✅ Finished Msg #{message_config['id']}. Success: {success_count}, Failed: {fail_count}")
+    try:
+        await run_bounded(target_users, deliver, BROADCAST_CONCURRENCY)
+    finally:
+        if ledger:
+            await ledger.flush()
+
+    logger.info(f"✅ Finished Msg #{message_config['id']}. Success: {success_count}, Failed: {fail_count}"
+                + (f", Unconfirmed (timed out): {unconfirmed_count}" if unconfirmed_count else ""))
     return success_count, fail_count
 
 
-async def process_campaign(config_file):
-    """Process a single campaign config file."""
-    try:
-        with open(config_file, "r", encoding="utf-8") as f:
-            config = json.load(f)
-    except Exception as e:
-        logger.error(f"Error loading config {config_file}: {e}")
-        return
-    
-    campaign_id = config.get("campaign_id", os.path.basename(config_file))
-    target_type = config.get("target", "non_subscribers")
-    
-    # Get already-sent messages from Supabase
-    sent_ids = db.get_sent_campaign_messages(campaign_id)
-    
-    now_utc = datetime.now(timezone.utc)
+async def send_campaign_message(campaign_id, target_type, msg):
+    """Broadcast one due campaign message and record it as sent. Raises on failure."""
+    msg_id = msg["id"]
+    logger.info(f"⏰ Time to send Msg #{msg_id} from campaign '{campaign_id}'!")
+
+    # Get target users fresh for each message
+    target_users = await get_target_users_for_campaign(target_type)
+
+    # Skip everyone the ledger already has (resume after a restart mid-broadcast)
+    deliveries = await db_async.get_campaign_deliveries(campaign_id, msg_id)
+    pending = sorted(u for u in target_users if deliveries.get(u) not in FINAL_DELIVERY_STATUSES)
+    if deliveries:
+        logger.info(f"↩️ Resuming Msg #{msg_id}: {len(target_users) - len(pending)} already done, {len(pending)} left")
+
+    started = time.monotonic()
+    success, fail = await broadcast_message(msg, pending, ledger=DeliveryLedger(campaign_id, msg_id))
+    elapsed = time.monotonic() - started
+    rate = (success + fail) / elapsed if elapsed > 0 else 0.0
+    logger.info(f"📈 Msg #{msg_id}: {success + fail} sends in {elapsed:.1f}s ({rate:.1f} msg/s)")
     
-    for msg in config.get("messages", []):
-        msg_id = msg["id"]
-        
-        # Parse sending time
-        try:
-            send_time = datetime.fromisoformat(msg["send_time_utc"]).replace(tzinfo=timezone.utc)
-        except Exception as e:
-            logger.error(f"Invalid date format for msg {msg_id}: {e}")
-            continue
-        
-        if msg_id not in sent_ids and now_utc >= send_time:
-            logger.info(f"⏰ Time to send Msg #{msg_id} from campaign '{campaign_id}'!")
+    # Mark as sent in Supabase, with exact totals across every run of this message
+    success_total = await db_async.count_campaign_deliveries(campaign_id, msg_id, status="sent")
+    await db_async.mark_campaign_message_sent(
+        campaign_id=campaign_id,
+        message_id=msg_id,
+        target_count=len(set(target_users) | set(deliveries)),
+        success_count=success_total
+    )
+
+
+# ============================================
+# CAMPAIGN SCHEDULE
+# ============================================
+
+CAMPAIGN_CONFIG_PATTERN = "campaign_config*.json"
+RETRY_DELAY = timedelta(minutes=1)  # when a broadcast crashes, the wake-up is re-armed this much later
+
+
+class CampaignSchedule:
+    """
+    All campaign configs compiled into one heap of unsent messages ordered by send time.
+    Configs are re-read (and sent state re-fetched from Supabase) only when the set of
+    config files or their mtimes change. The bot wakes the campaign job at next_due()
+    (bot.arm_campaign_wakeup), so between sends nothing touches the database.
+    """
+
+    def __init__(self, pattern: str = CAMPAIGN_CONFIG_PATTERN):
+        self.pattern = pattern
+        self._mtimes = None  # {path: mtime} the heap was compiled from
+        self._heap = []      # (send_time, seq, campaign_id, target_type, msg)
+        self._seq = itertools.count()  # tie-breaker so equal send times never compare dicts
+
+    def _config_files(self) -> dict:
+        mtimes = {}
+        for path in glob.glob(self.pattern):
+            # Skip backup files
+            if path.endswith('.bak'):
+                continue
             try:
-                # Get target users fresh for each message
-                target_users = get_target_users_for_campaign(target_type)
-                success, fail = await broadcast_message(msg, target_users)
-                
-                # Mark as sent in Supabase
-                db.mark_campaign_message_sent(
-                    campaign_id=campaign_id,
-                    message_id=msg_id,
-                    target_count=len(target_users),
-                    success_count=success
-                )
+                mtimes[path] = os.path.getmtime(path)
+            except OSError:
+                continue
+        return mtimes
+
+    async def refresh(self) -> bool:
+        """Recompile if any config file was added, removed or modified. Returns True if it did."""
+        mtimes = self._config_files()
+        if mtimes == self._mtimes:
+            return False
+
+        heap = []
+        for path in sorted(mtimes):
+            try:
+                with open(path, "r", encoding="utf-8") as f:
+                    config = json.load(f)
             except Exception as e:
-                logger.error(f"💥 Crashed sending Msg #{msg_id}: {e}", exc_info=True)
+                logger.error(f"Error loading config {path}: {e}")
+                continue
+
+            campaign_id = config.get("campaign_id", os.path.basename(path))
+            target_type = config.get("target", "non_subscribers")
+            sent_ids = await db_async.get_sent_campaign_messages(campaign_id)
+
+            for msg in config.get("messages", []):
+                if msg["id"] in sent_ids:
+                    continue
+                try:
+                    send_time = datetime.fromisoformat(msg["send_time_utc"]).replace(tzinfo=timezone.utc)
+                except Exception as e:
+                    logger.error(f"Invalid date format for msg {msg['id']}: {e}")
+                    continue
+                heap.append((send_time, next(self._seq), campaign_id, target_type, msg))
+
+        heapq.heapify(heap)
+        self._heap = heap
+        self._mtimes = mtimes
+        logger.info(f"📅 Campaign schedule compiled: {len(heap)} pending messages from {len(mtimes)} configs"
+                    + (f", next at {heap[0][0].isoformat()}" if heap else ""))
+        return True
+
+    def next_due(self):
+        """Send time of the earliest pending message, or None."""
+        return self._heap[0][0] if self._heap else None
+
+    def pop_due(self, now):
+        """Remove and return (campaign_id, target_type, msg) for every message due at `now`."""
+        due = []
+        while self._heap and self._heap[0][0] <= now:
+            _, _, campaign_id, target_type, msg = heapq.heappop(self._heap)
+            due.append((campaign_id, target_type, msg))
+        return due
+
+    def retry_later(self, campaign_id, target_type, msg, when) -> None:
+        """Put a message back on the heap after a failed broadcast."""
+        heapq.heappush(self._heap, (when, next(self._seq), campaign_id, target_type, msg))
+
+
+campaign_schedule = CampaignSchedule()
 
 
 async def check_campaign_job():
-    """Scheduled job to check if any messages need sending across ALL campaigns."""
+    """Scheduled job: send every campaign message that is due, across ALL campaigns."""
     try:
-        # Find all campaign config files
-        config_files = glob.glob("campaign_config*.json")
+        await campaign_schedule.refresh()
         
-        if not config_files:
-            return
-        
-        for config_file in config_files:
-            # Skip backup files
-            if config_file.endswith('.bak'):
-                continue
-            await process_campaign(config_file)
+        now_utc = datetime.now(timezone.utc)
+        for campaign_id, target_type, msg in campaign_schedule.pop_due(now_utc):
+            try:
+                await send_campaign_message(campaign_id, target_type, msg)
+            except Exception as e:
+                logger.error(f"💥 Crashed sending Msg #{msg['id']}: {e}", exc_info=True)
+                campaign_schedule.retry_later(campaign_id, target_type, msg, now_utc + RETRY_DELAY)
 
     except Exception as e:
         logger.error(f"💥 CRITICAL ERROR in check_campaign_job: {e}", exc_info=True)
@@ -0,0 +1,118 @@
+"""
+Bulk Sender — rate-limited, concurrent Telegram API calls
+Used for campaign broadcasts: keeps several requests in flight at once while a
+token bucket holds the overall rate under Telegram's bulk limit (~30 msg/s).
+Flood-control errors (RetryAfter) pause and retry; transient network errors
+retry with exponential backoff; everything else is raised to the caller.
+Sends are not idempotent: a TimedOut request may still have been delivered,
+so with idempotent=False it is raised instead of retried.
+"""
+
+import os
+import time
+import random
+import asyncio
+import logging
+from datetime import timedelta
+
+from telegram.error import RetryAfter, TimedOut, NetworkError, BadRequest
+
+logger = logging.getLogger(__name__)
+
+BROADCAST_RATE = float(os.getenv("BROADCAST_RATE", "25"))          # messages per second
+BROADCAST_CONCURRENCY = int(os.getenv("BROADCAST_CONCURRENCY", "10"))
+MAX_ATTEMPTS = 4
+BACKOFF_BASE = 1.0  # seconds, doubled after each transient failure
+
+
+class TokenBucket:
+    """Async token bucket: `rate` tokens per second, bursts up to `capacity`."""
+
+    def __init__(self, rate: float = BROADCAST_RATE, capacity: float = None):
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else max(1.0, rate)
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    async def acquire(self) -> None:
+        """Wait until one token is available and take it."""
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+
+    def pause(self, seconds: float) -> None:
+        """Drain the bucket so nobody sends for `seconds` (after a flood-control error)."""
+        self._tokens = -seconds * self.rate
+        self._updated = time.monotonic()
+
+
+def retry_after_seconds(error: RetryAfter) -> float:
+    """RetryAfter.retry_after is an int in older PTB versions and a timedelta in newer ones."""
+    value = error.retry_after
+    if isinstance(value, timedelta):
+        return value.total_seconds()
+    return float(value)
+
+
+async def call_with_retry(make_call, bucket: TokenBucket = None, max_attempts: int = MAX_ATTEMPTS,
+                          idempotent: bool = True):
+    """
+    Await make_call() (a zero-argument coroutine factory) under the rate limit.
+    Retries RetryAfter and transient network errors; BadRequest, Forbidden and
+    anything else propagate immediately. Pass idempotent=False for sends: TimedOut
+    then propagates too, since Telegram may have delivered the message anyway.
+    """
+    for attempt in range(1, max_attempts + 1):
+        if bucket:
+            await bucket.acquire()
+        try:
+            return await make_call()
+        except RetryAfter as e:
+            delay = retry_after_seconds(e)
+            logger.warning(f"⏳ Flood control: retrying in {delay:.0f}s (attempt {attempt}/{max_attempts})")
+            if bucket:
+                bucket.pause(delay)
+            if attempt == max_attempts:
+                raise
+            await asyncio.sleep(delay)
+        except BadRequest:
+            raise  # BadRequest is a NetworkError subclass but never transient
+        except TimedOut:
+            if not idempotent or attempt == max_attempts:
+                raise
+            delay = BACKOFF_BASE * 2 ** (attempt - 1) + random.uniform(0, 0.5)
+            logger.warning(f"🌐 Timed out; retrying in {delay:.1f}s (attempt {attempt}/{max_attempts})")
+            await asyncio.sleep(delay)
+        except NetworkError as e:
+            if attempt == max_attempts:
+                raise
+            delay = BACKOFF_BASE * 2 ** (attempt - 1) + random.uniform(0, 0.5)
+            logger.warning(f"🌐 Transient error ({e}); retrying in {delay:.1f}s (attempt {attempt}/{max_attempts})")
+            await asyncio.sleep(delay)
+
+
+async def run_bounded(items, worker, concurrency: int = BROADCAST_CONCURRENCY) -> None:
+    """Run `await worker(item)` for every item with at most `concurrency` in flight."""
+    queue = asyncio.Queue()
+    for item in items:
+        queue.put_nowait(item)
+
+    async def consume():
+        while True:
+            try:
+                item = queue.get_nowait()
+            except asyncio.QueueEmpty:
+                return
+            try:
+                await worker(item)
+            except Exception as e:
+                logger.error(f"Bulk worker failed on {item}: {e}")
+
+    await asyncio.gather(*(consume() for _ in range(max(1, min(concurrency, queue.qsize())))))
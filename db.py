@@ -6,9 +6,11 @@ Replaces all JSON file operations with Supabase queries.
 import os
 import logging
 from datetime import datetime, timedelta
-from typing import Optional, Dict, List, Set
+from typing import Optional, Dict, List, Set, Iterable
 from dotenv import load_dotenv
 
+from ttl_cache import TTLCache
+
 load_dotenv()
 logger = logging.getLogger(__name__)
 
@@ -35,6 +37,41 @@ def get_client():
     return _client
 
 
+BULK_CHUNK_SIZE = 200  # keeps the in.(...) filter well under URL length limits
+PAGE_SIZE = 1000  # PostgREST's default max rows per response
+
+
+def _chunks(items: List, size: int = BULK_CHUNK_SIZE):
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+
+# ============================================
+# ACCESS CACHE
+# ============================================
+
+# Access-subscription cache (user_id -> newest access-bearing row, or None).
+# Every write below that can change a user's access invalidates its entry,
+# so the TTL only bounds staleness from writes made by other processes.
+ACCESS_CACHE_TTL = int(os.getenv("ACCESS_CACHE_TTL", "60"))
+ACCESS_CACHE_SIZE = int(os.getenv("ACCESS_CACHE_SIZE", "2048"))
+
+_access_cache = TTLCache(maxsize=ACCESS_CACHE_SIZE, ttl=ACCESS_CACHE_TTL)
+_NO_ACCESS = object()  # cached negative result
+
+
+def invalidate_access(user_id: int) -> None:
+    """Forget the cached access state of one user."""
+    _access_cache.invalidate(user_id)
+
+
+def _invalidate_access_rows(rows: Optional[Iterable[Dict]]) -> None:
+    """Invalidate every user touched by an update that returned its rows."""
+    for row in rows or []:
+        if row.get("user_id") is not None:
+            invalidate_access(row["user_id"])
+
+
 # ============================================
 # USER OPERATIONS
 # ============================================
@@ -66,19 +103,81 @@ def get_user(user_id: int) -> Optional[Dict]:
         return None
 
 
+def normalize_email(email: Optional[str]) -> Optional[str]:
+    """Same normalization as the email_lower generated columns (supabase_migration_email_lower.sql)."""
+    email = (email or "").strip().lower()
+    return email or None
+
+
 def get_user_by_email(email: str) -> Optional[Dict]:
-    """Find a user by email (for GetCourse fallback matching)."""
+    """Find a user by email (for GetCourse fallback matching). Uses the email_lower index."""
     client = get_client()
+    email = normalize_email(email)
     if not client or not email:
         return None
     try:
-        result = client.table("club_users").select("*").ilike("email", email.strip()).maybe_single().execute()
-        return result.data
+        # Avoid maybe_single() - it sends Accept that causes 406 when 0 rows
+        result = client.table("club_users").select("*").eq("email_lower", email).limit(1).execute()
+        rows = result.data or []
+        return rows[0] if rows else None
     except Exception as e:
         logger.error(f"Error finding user by email: {e}")
         return None
 
 
+def get_users_by_emails(emails: Iterable[str]) -> Dict[str, Dict]:
+    """Resolve many emails at once. Returns {normalized email: user row} for the ones that exist."""
+    client = get_client()
+    # Characters that would break PostgREST's in.(...) list syntax can't be in a real address anyway
+    wanted = sorted({e for e in map(normalize_email, emails)
+                     if e and not any(c in e for c in ',()"')})
+    if not client or not wanted:
+        return {}
+    users = {}
+    try:
+        for chunk in _chunks(wanted):
+            result = client.table("club_users").select("*").in_("email_lower", chunk).execute()
+            users.update({u["email_lower"]: u for u in (result.data or [])})
+        return users
+    except Exception as e:
+        logger.error(f"Error resolving {len(wanted)} emails: {e}")
+        return users
+
+
+def get_user_context(user_id: int) -> Dict:
+    """
+    Get everything one bot screen needs about a user in a single request:
+    {"user": row or None, "access_subscription": row or None}.
+    Uses a PostgREST embedded select over the club_subscriptions foreign key.
+    """
+    context = {"user": None, "access_subscription": None}
+    client = get_client()
+    if not client:
+        return context
+    try:
+        # Avoid maybe_single() - it sends Accept that causes 406 when 0 rows
+        result = client.table("club_users") \
+            .select("*, club_subscriptions(*)") \
+            .eq("id", user_id) \
+            .limit(1) \
+            .execute()
+        rows = result.data or []
+        if not rows:
+            return context  # not cached: the row may be about to be created
+
+        user = dict(rows[0])
+        subs = user.pop("club_subscriptions", None) or []
+        access_subs = [s for s in subs if s.get("status") in ("active", "grace_period")]
+        access_sub = max(access_subs, key=lambda s: s.get("paid_at") or "") if access_subs else None
+
+        _access_cache.set(user_id, access_sub if access_sub is not None else _NO_ACCESS)
+        context.update(user=user, access_subscription=access_sub)
+        return context
+    except Exception as e:
+        logger.error(f"Error getting user context for {user_id}: {e}")
+        return context
+
+
 def get_all_users() -> List[Dict]:
     """Get all users."""
     client = get_client()
@@ -102,56 +201,69 @@ GRACE_DAYS = 3  # 3 days grace after expiry before kicking (awaiting late recurr
 
 
 def add_subscription(user_id: int, email: str = None, name: str = None, 
-                     source: str = "getcourse") -> bool:
-    """Add a new subscription (payment received)."""
+                     source: str = "getcourse") -> Optional[Dict]:
+    """
+    Add a new subscription (payment received). Returns the new row, or None on error.
+    Runs the club_add_subscription RPC (supabase_migration_add_subscription_rpc.sql),
+    which upserts the user, expires previous access rows and inserts the new row
+    in one transaction, so duplicate webhooks can't race each other.
+    """
     client = get_client()
     if not client:
-        return False
+        return None
     try:
-        now = datetime.now()
-        expires = now + timedelta(days=EXPIRY_DAYS)
-        
-        # First ensure user exists
-        upsert_user(user_id, {
-            "status": "lead",
-            "email": email,
-        })
-        
-        # Expire any previous access-bearing subscription before inserting a fresh one.
-        # This prevents stale grace_period rows from later kicking renewed users.
-        client.table("club_subscriptions") \
-            .update({"status": "expired"}) \
-            .eq("user_id", user_id) \
-            .in_("status", ["active", "grace_period"]) \
-            .execute()
-        
-        # Count previous subscriptions for renewed_count
-        prev = client.table("club_subscriptions") \
-            .select("id", count="exact") \
-            .eq("user_id", user_id) \
-            .execute()
-        renewed_count = (prev.count or 0) + 1
-        
-        # Insert new subscription
-        client.table("club_subscriptions").insert({
-            "user_id": user_id,
-            "paid_at": now.isoformat(),
-            "expires_at": expires.isoformat(),
-            "status": "active",
-            "reminder_sent": False,
-            "payment_source": source,
-            "renewed_count": renewed_count,
-            "email": email,
-            "name": name,
+        result = client.rpc("club_add_subscription", {
+            "p_user_id": user_id,
+            "p_email": email,
+            "p_name": name,
+            "p_source": source,
+            "p_expiry_days": EXPIRY_DAYS,
         }).execute()
+        invalidate_access(user_id)
+
+        row = result.data[0] if isinstance(result.data, list) else result.data
+        if not row:
+            logger.error(f"Error adding subscription for {user_id}: RPC returned no row")
+            return None
         
-        logger.info(f"✅ Subscription added: user {user_id} (renewal #{renewed_count})")
-        return True
+        logger.info(f"✅ Subscription added: user {user_id} (renewal #{row.get('renewed_count')})")
+        return row
     except Exception as e:
+        invalidate_access(user_id)
         logger.error(f"Error adding subscription for {user_id}: {e}")
-        return False
+        return None
 
 
+def add_subscriptions_many(entries: List[Dict], source: str = "getcourse_sync") -> List[Dict]:
+    """
+    Batched add_subscription for many users: entries are {user_id, email, name}.
+    Runs the club_add_subscriptions RPC (supabase_migration_bulk_add_subscriptions.sql)
+    once per chunk. Returns the new rows; a failed chunk is logged and skipped.
+    """
+    client = get_client()
+    if not client or not entries:
+        return []
+    rows = []
+    for chunk in _chunks(entries):
+        try:
+            result = client.rpc("club_add_subscriptions", {
+                "p_entries": [
+                    {"user_id": e["user_id"], "email": e.get("email"), "name": e.get("name")}
+                    for e in chunk
+                ],
+                "p_source": source,
+                "p_expiry_days": EXPIRY_DAYS,
+            }).execute()
+            rows.extend(result.data or [])
+        except Exception as e:
+            logger.error(f"Error adding subscriptions (bulk, {len(chunk)} users): {e}")
+        finally:
+            for entry in chunk:
+                invalidate_access(entry["user_id"])
+    if rows:
+        logger.info(f"✅ Subscriptions added (bulk): {len(rows)}")
+    return rows
+
 def get_active_subscription(user_id: int) -> Optional[Dict]:
     """Get user's current active subscription."""
     client = get_client()
@@ -173,7 +285,10 @@ def get_active_subscription(user_id: int) -> Optional[Dict]:
 
 
 def get_access_subscription(user_id: int) -> Optional[Dict]:
-    """Get the newest subscription that still grants channel access."""
+    """Get the newest subscription that still grants channel access (cached)."""
+    cached = _access_cache.get(user_id)
+    if cached is not None:
+        return None if cached is _NO_ACCESS else cached
     client = get_client()
     if not client:
         return None
@@ -187,7 +302,9 @@ def get_access_subscription(user_id: int) -> Optional[Dict]:
             .limit(1) \
             .execute()
         rows = result.data or []
-        return rows[0] if rows else None
+        sub = rows[0] if rows else None
+        _access_cache.set(user_id, sub if sub is not None else _NO_ACCESS)
+        return sub
     except Exception as e:
         logger.error(f"Error getting access subscription for {user_id}: {e}")
         return None
@@ -247,10 +364,11 @@ def mark_reminder_sent(subscription_id: int) -> None:
     if not client:
         return
     try:
-        client.table("club_subscriptions") \
+        result = client.table("club_subscriptions") \
             .update({"reminder_sent": True}) \
             .eq("id", subscription_id) \
             .execute()
+        _invalidate_access_rows(result.data)
     except Exception as e:
         logger.error(f"Error marking reminder sent: {e}")
 
@@ -297,10 +415,11 @@ def set_grace_period(subscription_id: int) -> None:
     if not client:
         return
     try:
-        client.table("club_subscriptions") \
+        result = client.table("club_subscriptions") \
             .update({"status": "grace_period"}) \
             .eq("id", subscription_id) \
             .execute()
+        _invalidate_access_rows(result.data)
     except Exception as e:
         logger.error(f"Error setting grace period: {e}")
 
@@ -354,6 +473,7 @@ def set_expiry_warning(user_id: int) -> None:
             .eq("user_id", user_id) \
             .eq("status", "active") \
             .execute()
+        invalidate_access(user_id)
     except Exception as e:
         logger.error(f"Error setting expiry warning for {user_id}: {e}")
 
@@ -398,6 +518,50 @@ def get_expired_not_warned() -> List[Dict]:
         return []
 
 
+def get_lifecycle_candidates(lookahead_hours: int = 48, reminder_lookahead_hours: int = 0) -> List[Dict]:
+    """
+    Every active/grace_period subscription that may have a lifecycle transition due:
+    expiring within `lookahead_hours` (or already expired), or reaching REMINDER_DAY
+    within `reminder_lookahead_hours` without a reminder. One query (see lifecycle.py).
+    """
+    client = get_client()
+    if not client:
+        return []
+    try:
+        now = datetime.now()
+        horizon = (now + timedelta(hours=lookahead_hours)).isoformat()
+        reminder_cutoff = (now - timedelta(days=REMINDER_DAY, hours=-reminder_lookahead_hours)).isoformat()
+        result = client.table("club_subscriptions") \
+            .select("*") \
+            .in_("status", ["active", "grace_period"]) \
+            .or_(f'expires_at.lte."{horizon}",and(reminder_sent.eq.false,paid_at.lte."{reminder_cutoff}")') \
+            .execute()
+        return result.data or []
+    except Exception as e:
+        logger.error(f"Error getting lifecycle candidates: {e}")
+        return []
+
+
+def get_subscriptions_by_ids(subscription_ids: Iterable[int]) -> List[Dict]:
+    """Current rows of many subscriptions (missing ids are left out)."""
+    client = get_client()
+    ids = list(dict.fromkeys(subscription_ids))
+    if not client or not ids:
+        return []
+    try:
+        rows = []
+        for chunk in _chunks(ids):
+            result = client.table("club_subscriptions") \
+                .select("*") \
+                .in_("id", chunk) \
+                .execute()
+            rows.extend(result.data or [])
+        return rows
+    except Exception as e:
+        logger.error(f"Error getting subscriptions by id: {e}")
+        return []
+
+
 def extend_subscription(user_id: int, days: int) -> bool:
     """Extend the expiration date of the current access-bearing subscription."""
     client = get_client()
@@ -415,6 +579,7 @@ def extend_subscription(user_id: int, days: int) -> bool:
             .update({"expires_at": new_expires.isoformat()}) \
             .eq("id", sub['id']) \
             .execute()
+        invalidate_access(user_id)
             
         logger.info(f"✅ Subscription extended by {days} days for user {user_id}")
         return True
@@ -434,6 +599,7 @@ def mark_expired(user_id: int) -> None:
             .in_("status", ["active", "grace_period"]) \
             .eq("user_id", user_id) \
             .execute()
+        invalidate_access(user_id)
         logger.info(f"🔴 Subscription expired for user {user_id}")
     except Exception as e:
         logger.error(f"Error marking expired: {e}")
@@ -445,10 +611,11 @@ def mark_subscription_expired(subscription_id: int) -> None:
     if not client:
         return
     try:
-        client.table("club_subscriptions") \
+        result = client.table("club_subscriptions") \
             .update({"status": "expired"}) \
             .eq("id", subscription_id) \
             .execute()
+        _invalidate_access_rows(result.data)
     except Exception as e:
         logger.error(f"Error marking subscription {subscription_id} expired: {e}")
 
@@ -469,19 +636,36 @@ def get_all_active_subscribers() -> List[Dict]:
         return []
 
 
-def get_all_access_subscribers() -> List[Dict]:
-    """Get all subscriptions that currently grant channel access."""
+def get_all_access_subscribers(strict: bool = False) -> List[Dict]:
+    """
+    Get all subscriptions that currently grant channel access (paged past PostgREST's row cap).
+    With strict=True a failed query raises instead of returning [], for callers that
+    would treat "nobody has access" as a reason to act (sync_getcourse.py).
+    """
     client = get_client()
     if not client:
+        if strict:
+            raise RuntimeError("Supabase is not configured")
         return []
+    subs = []
     try:
-        result = client.table("club_subscriptions") \
-            .select("*") \
-            .in_("status", ["active", "grace_period"]) \
-            .execute()
-        return result.data or []
+        offset = 0
+        while True:
+            result = client.table("club_subscriptions") \
+                .select("*") \
+                .in_("status", ["active", "grace_period"]) \
+                .order("id") \
+                .range(offset, offset + PAGE_SIZE - 1) \
+                .execute()
+            rows = result.data or []
+            subs.extend(rows)
+            if len(rows) < PAGE_SIZE:
+                return subs
+            offset += PAGE_SIZE
     except Exception as e:
         logger.error(f"Error getting access subs: {e}")
+        if strict:
+            raise
         return []
 
 
@@ -507,6 +691,91 @@ def get_access_subscription_emails() -> Set[str]:
     return emails
 
 
+# ============================================
+# BULK STATE TRANSITIONS (one request per chunk of rows)
+# ============================================
+
+def _update_subscriptions_where_in(values: dict, column: str, keys: Iterable,
+                                   status: str = None) -> List[int]:
+    """
+    Apply one update to every subscription whose `column` is in `keys` (and whose
+    status is `status`, if given). Returns the ids of the rows actually updated.
+    """
+    client = get_client()
+    keys = list(dict.fromkeys(keys))
+    if not client or not keys:
+        return []
+    updated = []
+    for chunk in _chunks(keys):
+        query = client.table("club_subscriptions") \
+            .update(values) \
+            .in_(column, chunk)
+        if status:
+            query = query.eq("status", status)
+        result = query.execute()
+        _invalidate_access_rows(result.data)
+        updated.extend(row["id"] for row in result.data or [])
+    return updated
+
+
+def set_grace_period_many(subscription_ids: Iterable[int]) -> List[int]:
+    """
+    Move many subscriptions from active to grace_period. Rows that are no longer
+    active (renewed or changed since they were read) are left alone.
+    Returns the ids that moved.
+    """
+    try:
+        return _update_subscriptions_where_in(
+            {"status": "grace_period"}, "id", subscription_ids, status="active"
+        )
+    except Exception as e:
+        logger.error(f"Error setting grace period (bulk): {e}")
+        return []
+
+
+def restore_grace_period_many(subscription_ids: Iterable[int]) -> List[int]:
+    """Put expired rows back into grace_period (their kick failed and will be retried)."""
+    try:
+        return _update_subscriptions_where_in(
+            {"status": "grace_period"}, "id", subscription_ids, status="expired"
+        )
+    except Exception as e:
+        logger.error(f"Error restoring grace period (bulk): {e}")
+        return []
+
+
+def mark_reminders_sent_many(subscription_ids: Iterable[int]) -> int:
+    """Mark the Day-27 reminder as sent for many subscriptions."""
+    try:
+        return len(_update_subscriptions_where_in({"reminder_sent": True}, "id", subscription_ids))
+    except Exception as e:
+        logger.error(f"Error marking reminders sent (bulk): {e}")
+        return 0
+
+
+def mark_tomorrow_reminders_sent_many(subscription_ids: Iterable[int]) -> int:
+    """Mark the Day-29 reminder (and with it the Day-27 one) as sent for many subscriptions."""
+    try:
+        return len(_update_subscriptions_where_in(
+            {"reminder_sent": True, "tomorrow_reminder_sent": True}, "id", subscription_ids
+        ))
+    except Exception as e:
+        logger.error(f"Error marking tomorrow reminders sent (bulk): {e}")
+        return 0
+
+
+def mark_subscriptions_expired_many(subscription_ids: Iterable[int], status: str = None) -> List[int]:
+    """
+    Mark many specific subscription rows as expired; with `status`, only rows still
+    in that status. Returns the ids that were expired.
+    """
+    try:
+        return _update_subscriptions_where_in({"status": "expired"}, "id", subscription_ids, status=status)
+    except Exception as e:
+        logger.error(f"Error marking subscriptions expired (bulk): {e}")
+        return []
+
+
 # ============================================
 # CAMPAIGN TARGETING
 # ============================================
@@ -628,6 +897,290 @@ def get_sent_campaign_messages(campaign_id: str) -> Set[str]:
         return set()
 
 
+# ============================================
+# CAMPAIGN DELIVERY LEDGER
+# ============================================
+
+def get_campaign_deliveries(campaign_id: str, message_id: str) -> Dict[int, str]:
+    """Get {user_id: status} for every recipient already attempted for a campaign message."""
+    client = get_client()
+    if not client:
+        return {}
+    deliveries = {}
+    try:
+        offset = 0
+        while True:
+            result = client.table("club_campaign_deliveries") \
+                .select("user_id,status") \
+                .eq("campaign_id", campaign_id) \
+                .eq("message_id", message_id) \
+                .order("user_id") \
+                .range(offset, offset + PAGE_SIZE - 1) \
+                .execute()
+            rows = result.data or []
+            deliveries.update({r["user_id"]: r["status"] for r in rows})
+            if len(rows) < PAGE_SIZE:
+                return deliveries
+            offset += PAGE_SIZE
+    except Exception as e:
+        logger.error(f"Error getting campaign deliveries: {e}")
+        return deliveries
+
+
+def record_campaign_deliveries(rows: List[Dict]) -> bool:
+    """Upsert a batch of {campaign_id, message_id, user_id, status, error} ledger rows."""
+    client = get_client()
+    if not client or not rows:
+        return False
+    try:
+        now = datetime.now().isoformat()
+        client.table("club_campaign_deliveries").upsert(
+            [{**row, "attempted_at": now} for row in rows],
+            on_conflict="campaign_id,message_id,user_id",
+        ).execute()
+        return True
+    except Exception as e:
+        logger.error(f"Error recording {len(rows)} campaign deliveries: {e}")
+        return False
+
+
+def count_campaign_deliveries(campaign_id: str, message_id: str, status: str = "sent") -> int:
+    """Exact number of ledger rows with the given status for a campaign message."""
+    client = get_client()
+    if not client:
+        return 0
+    try:
+        result = client.table("club_campaign_deliveries") \
+            .select("user_id", count="exact") \
+            .eq("campaign_id", campaign_id) \
+            .eq("message_id", message_id) \
+            .eq("status", status) \
+            .limit(1) \
+            .execute()
+        return result.count or 0
+    except Exception as e:
+        logger.error(f"Error counting campaign deliveries: {e}")
+        return 0
+
+
+# ============================================
+# GETCOURSE SYNC STATE (incremental reconciliation)
+# ============================================
+
+def get_sync_fingerprints(scope: str, row_keys: Iterable[str]) -> Dict[str, Dict]:
+    """Get {row_key: {fingerprint, user_id}} for the purchase rows already reconciled in `scope`."""
+    client = get_client()
+    keys = list(dict.fromkeys(row_keys))
+    if not client or not keys:
+        return {}
+    stored = {}
+    try:
+        for chunk in _chunks(keys):
+            result = client.table("club_gc_sync_rows") \
+                .select("row_key,fingerprint,user_id") \
+                .eq("scope", scope) \
+                .in_("row_key", chunk) \
+                .execute()
+            stored.update({r["row_key"]: r for r in (result.data or [])})
+        return stored
+    except Exception as e:
+        logger.error(f"Error getting sync fingerprints ({scope}): {e}")
+        return stored
+
+
+def save_sync_fingerprints(scope: str, rows: List[Dict]) -> bool:
+    """Upsert {row_key, fingerprint, user_id} rows for `scope`."""
+    client = get_client()
+    if not client or not rows:
+        return False
+    try:
+        now = datetime.now().isoformat()
+        for chunk in _chunks(rows):
+            client.table("club_gc_sync_rows").upsert(
+                [{**row, "scope": scope, "synced_at": now} for row in chunk],
+                on_conflict="scope,row_key",
+            ).execute()
+        return True
+    except Exception as e:
+        logger.error(f"Error saving {len(rows)} sync fingerprints ({scope}): {e}")
+        return False
+
+
+def get_sync_state(scope: str) -> Optional[Dict]:
+    """Get the watermark (export_at, export_sha256, ...) of the last sync in `scope`."""
+    client = get_client()
+    if not client:
+        return None
+    try:
+        result = client.table("club_gc_sync_state").select("*").eq("scope", scope).execute()
+        return result.data[0] if result.data else None
+    except Exception as e:
+        logger.error(f"Error getting sync state ({scope}): {e}")
+        return None
+
+
+def set_sync_state(scope: str, state: Dict) -> bool:
+    """Record the watermark of a finished sync in `scope`."""
+    client = get_client()
+    if not client:
+        return False
+    try:
+        client.table("club_gc_sync_state").upsert(
+            {**state, "scope": scope, "synced_at": datetime.now().isoformat()},
+            on_conflict="scope",
+        ).execute()
+        return True
+    except Exception as e:
+        logger.error(f"Error setting sync state ({scope}): {e}")
+        return False
+
+
+def get_access_emails_among(emails: Iterable[str]) -> Set[str]:
+    """Subset of `emails` (normalized) that belong to a subscription with channel access."""
+    client = get_client()
+    wanted = sorted({e for e in map(normalize_email, emails)
+                     if e and not any(c in e for c in ',()"')})
+    if not client or not wanted:
+        return set()
+    found = set()
+    try:
+        for chunk in _chunks(wanted):
+            result = client.table("club_subscriptions") \
+                .select("email_lower") \
+                .in_("email_lower", chunk) \
+                .in_("status", ["active", "grace_period"]) \
+                .execute()
+            found.update(r["email_lower"] for r in (result.data or []) if r.get("email_lower"))
+        return found
+    except Exception as e:
+        logger.error(f"Error checking access for {len(wanted)} emails: {e}")
+        return found
+
+
+# ============================================
+# RECOVERY CLAIMS (paid on GetCourse, lost channel access)
+# ============================================
+
+RECOVERY_CLAIMED = "claimed"        # entry consumed, subscription granted
+RECOVERY_HAS_ACCESS = "has_access"  # entry left alone: the user or email already has access
+
+
+def claim_recovery(email: str, user_id: int, name: str = None) -> Optional[Dict]:
+    """
+    Claim the recovery entry for `email` and grant `user_id` a subscription, atomically
+    (club_claim_recovery RPC). Returns the entry with result RECOVERY_CLAIMED, or
+    {result: RECOVERY_HAS_ACCESS, email_lower} if the user or email already has an
+    active or grace subscription, or None if there was nothing to claim.
+    """
+    client = get_client()
+    if not client or not normalize_email(email):
+        return None
+    try:
+        result = client.rpc("club_claim_recovery", {
+            "p_email": email,
+            "p_user_id": user_id,
+            "p_name": name,
+            "p_expiry_days": EXPIRY_DAYS,
+        }).execute()
+        claim = result.data[0] if isinstance(result.data, list) and result.data else result.data
+        if not isinstance(claim, dict):
+            return None
+        if claim.get("result") == RECOVERY_CLAIMED:
+            invalidate_access(user_id)
+            logger.info(f"✨ Recovery claimed: {claim['email_lower']} → user {user_id}")
+        return claim
+    except Exception as e:
+        logger.error(f"Error claiming recovery for {user_id}: {e}")
+        return None
+
+
+def add_recovery_entries(entries: List[Dict]) -> int:
+    """
+    Upsert {email, name, expires} recovery entries. Already claimed entries keep
+    their claim (only name/expires are refreshed). Returns rows written.
+    """
+    client = get_client()
+    rows = [
+        {"email_lower": normalize_email(e["email"]), "name": e.get("name"), "expires": e.get("expires")}
+        for e in entries if normalize_email(e.get("email"))
+    ]
+    if not client or not rows:
+        return 0
+    written = 0
+    try:
+        for chunk in _chunks(rows):
+            result = client.table("club_recovery_claims").upsert(chunk, on_conflict="email_lower").execute()
+            written += len(result.data or [])
+        return written
+    except Exception as e:
+        logger.error(f"Error adding recovery entries: {e}")
+        return written
+
+
+def remove_recovery_entries(emails: Iterable[str]) -> int:
+    """Delete unclaimed recovery entries for `emails`. Returns rows deleted."""
+    client = get_client()
+    wanted = sorted({e for e in map(normalize_email, emails)
+                     if e and not any(c in e for c in ',()"')})
+    if not client or not wanted:
+        return 0
+    removed = 0
+    try:
+        for chunk in _chunks(wanted):
+            result = client.table("club_recovery_claims") \
+                .delete() \
+                .in_("email_lower", chunk) \
+                .is_("claimed_by", "null") \
+                .execute()
+            removed += len(result.data or [])
+        return removed
+    except Exception as e:
+        logger.error(f"Error removing recovery entries: {e}")
+        return removed
+
+
+def get_unclaimed_recovery_emails() -> Set[str]:
+    """Emails of every recovery entry nobody has claimed yet."""
+    client = get_client()
+    if not client:
+        return set()
+    emails = set()
+    try:
+        offset = 0
+        while True:
+            result = client.table("club_recovery_claims") \
+                .select("email_lower") \
+                .is_("claimed_by", "null") \
+                .order("email_lower") \
+                .range(offset, offset + PAGE_SIZE - 1) \
+                .execute()
+            rows = result.data or []
+            emails.update(r["email_lower"] for r in rows)
+            if len(rows) < PAGE_SIZE:
+                return emails
+            offset += PAGE_SIZE
+    except Exception as e:
+        logger.error(f"Error getting recovery entries: {e}")
+        return emails
+
+
+def count_unclaimed_recovery_entries() -> int:
+    """Number of recovery entries nobody has claimed yet."""
+    client = get_client()
+    if not client:
+        return 0
+    try:
+        result = client.table("club_recovery_claims") \
+            .select("email_lower", count="exact") \
+            .is_("claimed_by", "null") \
+            .limit(1) \
+            .execute()
+        return result.count or 0
+    except Exception as e:
+        logger.error(f"Error counting recovery entries: {e}")
+        return 0
+
+
 # ============================================
 # WEBHOOK PARSER (unchanged from subscription_manager)
 # ============================================
@@ -0,0 +1,136 @@
+"""
+Async Database Layer — non-blocking wrapper around db.py
+The Supabase client used in db.py is synchronous, so every call made directly
+from a handler freezes the polling event loop for a full HTTP round-trip.
+Each function here runs its db.py counterpart on a small thread pool and can
+be awaited, so concurrent handlers overlap their I/O instead of queueing.
+"""
+
+import os
+import asyncio
+import functools
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+import db
+
+logger = logging.getLogger(__name__)
+
+# Number of Supabase requests allowed in flight at once
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "8"))
+
+_executor = ThreadPoolExecutor(max_workers=DB_POOL_SIZE, thread_name_prefix="db")
+
+
+async def run(func, *args, **kwargs):
+    """Run any blocking callable on the database thread pool."""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_executor, functools.partial(func, *args, **kwargs))
+
+
+def _wrap(func):
+    """Turn a blocking db.py function into an awaitable one."""
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        return await run(func, *args, **kwargs)
+    return wrapper
+
+
+# ============================================
+# USER OPERATIONS
+# ============================================
+
+upsert_user = _wrap(db.upsert_user)
+get_user = _wrap(db.get_user)
+get_user_by_email = _wrap(db.get_user_by_email)
+get_users_by_emails = _wrap(db.get_users_by_emails)
+get_user_context = _wrap(db.get_user_context)
+get_all_users = _wrap(db.get_all_users)
+
+
+# ============================================
+# SUBSCRIPTION OPERATIONS
+# ============================================
+
+add_subscription = _wrap(db.add_subscription)
+add_subscriptions_many = _wrap(db.add_subscriptions_many)
+get_active_subscription = _wrap(db.get_active_subscription)
+get_access_subscription = _wrap(db.get_access_subscription)
+get_all_subscriptions_for_user = _wrap(db.get_all_subscriptions_for_user)
+is_active_subscriber = _wrap(db.is_active_subscriber)
+has_channel_access = _wrap(db.has_channel_access)
+get_lifecycle_candidates = _wrap(db.get_lifecycle_candidates)
+get_subscriptions_by_ids = _wrap(db.get_subscriptions_by_ids)
+extend_subscription = _wrap(db.extend_subscription)
+mark_expired = _wrap(db.mark_expired)
+get_all_active_subscribers = _wrap(db.get_all_active_subscribers)
+get_all_access_subscribers = _wrap(db.get_all_access_subscribers)
+get_active_subscriber_ids = _wrap(db.get_active_subscriber_ids)
+get_access_subscriber_ids = _wrap(db.get_access_subscriber_ids)
+get_access_subscription_emails = _wrap(db.get_access_subscription_emails)
+
+
+# ============================================
+# BULK STATE TRANSITIONS
+# ============================================
+
+set_grace_period_many = _wrap(db.set_grace_period_many)
+restore_grace_period_many = _wrap(db.restore_grace_period_many)
+mark_reminders_sent_many = _wrap(db.mark_reminders_sent_many)
+mark_tomorrow_reminders_sent_many = _wrap(db.mark_tomorrow_reminders_sent_many)
+mark_subscriptions_expired_many = _wrap(db.mark_subscriptions_expired_many)
+
+
+# ============================================
+# CAMPAIGN TARGETING
+# ============================================
+
+get_non_subscriber_ids = _wrap(db.get_non_subscriber_ids)
+get_reminded_user_ids = _wrap(db.get_reminded_user_ids)
+get_subscribers_not_renewed = _wrap(db.get_subscribers_not_renewed)
+
+
+# ============================================
+# CAMPAIGN STATE
+# ============================================
+
+is_campaign_message_sent = _wrap(db.is_campaign_message_sent)
+mark_campaign_message_sent = _wrap(db.mark_campaign_message_sent)
+get_sent_campaign_messages = _wrap(db.get_sent_campaign_messages)
+
+
+# ============================================
+# CAMPAIGN DELIVERY LEDGER
+# ============================================
+
+get_campaign_deliveries = _wrap(db.get_campaign_deliveries)
+record_campaign_deliveries = _wrap(db.record_campaign_deliveries)
+count_campaign_deliveries = _wrap(db.count_campaign_deliveries)
+
+
+# ============================================
+# GETCOURSE SYNC STATE
+# ============================================
+
+get_sync_fingerprints = _wrap(db.get_sync_fingerprints)
+save_sync_fingerprints = _wrap(db.save_sync_fingerprints)
+get_sync_state = _wrap(db.get_sync_state)
+set_sync_state = _wrap(db.set_sync_state)
+get_access_emails_among = _wrap(db.get_access_emails_among)
+
+
+# ============================================
+# RECOVERY CLAIMS
+# ============================================
+
+claim_recovery = _wrap(db.claim_recovery)
+add_recovery_entries = _wrap(db.add_recovery_entries)
+remove_recovery_entries = _wrap(db.remove_recovery_entries)
+count_unclaimed_recovery_entries = _wrap(db.count_unclaimed_recovery_entries)
+
+
+# ============================================
+# WEBHOOK PARSER
+# ============================================
+
+parse_getcourse_webhook = _wrap(db.parse_getcourse_webhook)
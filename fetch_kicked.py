@@ -43,8 +43,8 @@ async def main():
                 f.write(f"{u.id},{u.first_name},{u.last_name}\n")
                 
         # Now, unban access-valid users and send invite links
-        from telegram import Bot
-        bot = Bot(token=BOT_TOKEN)
+        import telegram_client
+        bot = telegram_client.get_bot()
 
         success = 0
         failed = 0
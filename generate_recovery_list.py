@@ -1,45 +1,99 @@
-import csv
-import db
+"""
+Recovery List: active GetCourse buyers who have no channel access in Supabase.
+Entries go to the club_recovery_claims table; bot.py claims one atomically
+(and grants a subscription) when the buyer enters their email.
+
+Incremental: only purchase rows that are new or changed since the last run are
+checked against Supabase. Every listed entry is still rechecked on each run, so
+a buyer who has since regained access drops off the list. Run with --full to
+recheck the whole export.
+
+Usage:
+  python3 generate_recovery_list.py [export.csv] [--full]
+"""
+
 import os
+import sys
 import json
 
 from dotenv import load_dotenv
 load_dotenv()
 
+import db
+from getcourse_export import PurchaseExport, IncrementalSync
+
+DEFAULT_CSV = "/Users/annaromeo/Downloads/userproduct_export_2026-03-05_10-51-43.csv"
+LEGACY_RECOVERY_FILE = "recovery_list.json"  # imported once, then renamed
+RECOVERY_SCOPE = "recovery"
+
+
+def import_legacy_recovery_list() -> int:
+    """Move entries from the old recovery_list.json into club_recovery_claims."""
+    if not os.path.exists(LEGACY_RECOVERY_FILE):
+        return 0
+    with open(LEGACY_RECOVERY_FILE, 'r', encoding='utf-8') as f:
+        entries = list(json.load(f).values())
+    imported = db.add_recovery_entries(entries)
+    if imported == len(entries):
+        os.replace(LEGACY_RECOVERY_FILE, LEGACY_RECOVERY_FILE + ".imported")
+    print(f"📦 Imported {imported} entries from {LEGACY_RECOVERY_FILE}")
+    return imported
+
+
 def main():
-    csv_path = "/Users/annaromeo/Downloads/userproduct_export_2026-03-05_10-51-43.csv"
-    
+    args = [a for a in sys.argv[1:] if not a.startswith('--')]
+    full = '--full' in sys.argv
+    csv_path = args[0] if args else DEFAULT_CSV
+
     if not os.path.exists(csv_path):
         print(f"File not found: {csv_path}")
         return
-        
-    access_emails = db.get_access_subscription_emails()
-    
-    getcourse_active = []
-    
-    with open(csv_path, 'r', encoding='utf-8-sig') as f:
-        reader = csv.DictReader(f, delimiter=';')
-        for row in reader:
-            if row.get('Статус') == 'Активна':
-                getcourse_active.append({
-                    'email': row.get('Эл. адрес', '').lower().strip(),
-                    'name': row.get('Пользователь', ''),
-                    'expires': row.get('Заканчивается', '') 
-                    # Note: We need a real expiry date, but for now we'll give them 30 days from recovery
-                })
-                
-    lost_users = []
-    for gc_user in getcourse_active:
-        email = gc_user['email']
-        if email not in access_emails:
-            lost_users.append(gc_user)
-            
-    # Write to recovery JSON
-    recovery_dict = {user['email']: user for user in lost_users}
-    with open('recovery_list.json', 'w', encoding='utf-8') as f:
-        json.dump(recovery_dict, f, ensure_ascii=False, indent=2)
-        
-    print(f"✅ Generated recovery_list.json with {len(recovery_dict)} lost users.")
+
+    export = PurchaseExport(csv_path)
+    if 'email' not in export.columns:
+        print(f"Could not find email column. Available: {export.headers}")
+        return
+
+    sync = IncrementalSync(RECOVERY_SCOPE, export, full=full)
+    refusal = sync.check_watermark()
+    if refusal:
+        print(f"❌ Not updating: {refusal}")
+        return
+
+    import_legacy_recovery_list()
+
+    active_emails = set()
+    ended_emails = set()
+    added = removed = 0
+
+    for chunk in export.chunks():
+        active_emails.update(e['email'] for e in chunk if e['active'])
+        changed, _ = sync.split(chunk)
+        if not changed:
+            continue
+
+        active = {e['email']: e for e in changed if e['active']}
+        has_access = db.get_access_emails_among(active)
+        lost = [
+            {'email': email, 'name': gc_user['name'] or '', 'expires': gc_user['ends'] or ''}
+            # Note: We need a real expiry date, but for now we'll give them 30 days from recovery
+            for email, gc_user in active.items() if email not in has_access
+        ]
+        added += db.add_recovery_entries(lost)
+        removed += db.remove_recovery_entries(has_access)
+        ended_emails.update(e['email'] for e in changed if not e['active'])
+        for entry in changed:
+            sync.done(entry)
+
+    # A purchase that ended no longer earns recovery, unless the same email has another active one
+    removed += db.remove_recovery_entries(ended_emails - active_emails)
+    # Unchanged rows were not checked above: drop listed buyers who have access again
+    removed += db.remove_recovery_entries(db.get_access_emails_among(db.get_unclaimed_recovery_emails()))
+
+    sync.finish()
+
+    print(f"✅ Recovery list has {db.count_unclaimed_recovery_entries()} lost users "
+          f"({sync.rows_changed} of {sync.rows_total} rows new or changed: +{added} / -{removed}).")
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,226 @@
+"""
+GetCourse Export Reader — streaming parser for purchase CSV exports
+GetCourse exports (Покупки → export) are semicolon-separated, in UTF-8 or
+cp1251, with Russian headers. Rows are yielded one at a time (or in chunks)
+so arbitrarily large exports are processed in constant memory.
+
+IncrementalSync adds per-row fingerprints and an export watermark stored in
+Supabase (supabase_migration_gc_sync_state.sql), so a rerun on a newer export
+only does database work for purchase rows that are new or changed.
+"""
+
+import os
+import re
+import csv
+import hashlib
+from datetime import datetime, timezone
+from itertools import islice
+from typing import Dict, Iterator, List, Optional, Tuple
+
+ACTIVE_STATUSES = {"активна", "active"}
+
+
+def detect_encoding(path: str) -> str:
+    """First encoding that decodes the whole file (checked block by block, not loaded at once)."""
+    for encoding in ["utf-8-sig", "cp1251"]:
+        try:
+            with open(path, "r", encoding=encoding) as f:
+                for _ in iter(lambda: f.read(1 << 16), ""):
+                    pass
+            return encoding
+        except UnicodeDecodeError:
+            continue
+    return "latin-1"
+
+
+def file_sha256(path: str) -> str:
+    sha = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            sha.update(block)
+    return sha.hexdigest()
+
+
+_EXPORT_NAME_TIME = re.compile(r"(\d{4}-\d{2}-\d{2})_(\d{2})-(\d{2})-(\d{2})")
+
+
+def export_timestamp(path: str) -> datetime:
+    """When GetCourse produced the export: from its file name (…_2026-03-05_10-51-43.csv), else the file mtime."""
+    match = _EXPORT_NAME_TIME.search(os.path.basename(path))
+    if match:
+        date, hh, mm, ss = match.groups()
+        return datetime.fromisoformat(f"{date}T{hh}:{mm}:{ss}").replace(tzinfo=timezone.utc)
+    return datetime.fromtimestamp(os.path.getmtime(path), timezone.utc)
+
+
+def map_columns(headers: List[str]) -> Dict[str, int]:
+    """Map the columns we use to their indexes (case-insensitive, supports Russian headers)."""
+    col_map = {}
+    for i, h in enumerate(headers):
+        h_clean = h.lower().strip()
+        if 'адрес' in h_clean or 'email' in h_clean or 'mail' in h_clean:
+            col_map['email'] = i
+        elif h_clean in ['пользователь', 'имя', 'name']:
+            col_map['name'] = i
+        elif h_clean in ['статус', 'status']:
+            col_map['status'] = i
+        elif h_clean in ['продукт', 'предложение', 'product', 'тариф']:
+            col_map['product'] = i
+        elif h_clean in ['начинается', 'начало', 'starts', 'дата начала']:
+            col_map['starts'] = i
+        elif h_clean in ['заканчивается', 'окончание', 'ends', 'дата окончания']:
+            col_map['ends'] = i
+    return col_map
+
+
+def _cell(row: List[str], col_map: Dict[str, int], key: str) -> Optional[str]:
+    i = col_map.get(key)
+    if i is None or i >= len(row):
+        return None
+    return row[i].strip().strip('"') or None
+
+
+def row_key(entry: Dict) -> str:
+    """Identity of a purchase: email + product + period start."""
+    raw = "|".join([entry["email"], entry.get("product") or "", entry.get("starts") or ""])
+    return hashlib.sha1(raw.encode("utf-8")).hexdigest()
+
+
+def row_fingerprint(entry: Dict) -> str:
+    """Hash of everything reconciliation depends on; changes when the purchase does."""
+    raw = "|".join([entry["email"], entry.get("product") or "", entry.get("starts") or "",
+                    entry.get("ends") or "", entry["gc_status"].lower()])
+    return hashlib.sha1(raw.encode("utf-8")).hexdigest()
+
+
+class PurchaseExport:
+    """A GetCourse purchase export opened for streaming."""
+
+    def __init__(self, path: str):
+        self.path = path
+        self.encoding = detect_encoding(path)
+        with open(path, "r", encoding=self.encoding, newline="") as f:
+            self.headers = [h.strip().strip('"') for h in next(csv.reader(f, delimiter=';'), [])]
+        self.columns = map_columns(self.headers)
+
+    def purchases(self) -> Iterator[Dict]:
+        """
+        Yield {email, name, gc_status, active, product, starts, ends} per purchase row.
+        Rows without a usable email are skipped.
+        """
+        with open(self.path, "r", encoding=self.encoding, newline="") as f:
+            reader = csv.reader(f, delimiter=';')
+            next(reader, None)  # header
+            for row in reader:
+                email = (_cell(row, self.columns, 'email') or "").lower()
+                if not email or '@' not in email:
+                    continue
+                status = _cell(row, self.columns, 'status') if 'status' in self.columns else 'Активна'
+                status = status or ''
+                yield {
+                    "email": email,
+                    "name": _cell(row, self.columns, 'name'),
+                    "gc_status": status,
+                    "active": status.lower() in ACTIVE_STATUSES,
+                    "product": _cell(row, self.columns, 'product'),
+                    "starts": _cell(row, self.columns, 'starts'),
+                    "ends": _cell(row, self.columns, 'ends'),
+                }
+
+    def chunks(self, size: int = 500) -> Iterator[List[Dict]]:
+        """purchases() grouped into lists of at most `size` rows."""
+        rows = self.purchases()
+        while True:
+            chunk = list(islice(rows, size))
+            if not chunk:
+                return
+            yield chunk
+
+
+class IncrementalSync:
+    """
+    Fingerprints of reconciled rows plus an export watermark for one `scope`.
+    split() separates a chunk into rows that need work and rows unchanged since
+    the last sync; done() queues a row's fingerprint, written in batches.
+    With full=True every row is treated as changed; with dry_run nothing is saved.
+    """
+
+    def __init__(self, scope: str, export: PurchaseExport, full: bool = False,
+                 dry_run: bool = False, batch_size: int = 500):
+        import db  # deferred so plain CSV parsing doesn't need Supabase settings
+        self._db = db
+        self.scope = scope
+        self.export = export
+        self.full = full
+        self.dry_run = dry_run
+        self.batch_size = batch_size
+        self.export_at = export_timestamp(export.path)
+        self.export_sha256 = file_sha256(export.path)
+        self.previous = None if full else db.get_sync_state(scope)
+        self.rows_total = 0
+        self.rows_changed = 0
+        self._pending = []
+
+    def check_watermark(self) -> Optional[str]:
+        """Reason to refuse this export (older than the last one synced), or None."""
+        if not self.previous or not self.previous.get("export_at"):
+            return None
+        last = datetime.fromisoformat(self.previous["export_at"])
+        if last.tzinfo is None:
+            last = last.replace(tzinfo=timezone.utc)
+        if self.export_at < last and self.export_sha256 != self.previous.get("export_sha256"):
+            return (f"export from {self.export_at.isoformat()} is older than the last synced one "
+                    f"({last.isoformat()}); rerun with --full to apply it anyway")
+        return None
+
+    @property
+    def identical_export(self) -> bool:
+        return bool(self.previous) and self.previous.get("export_sha256") == self.export_sha256
+
+    def split(self, chunk: List[Dict]) -> Tuple[List[Dict], List[Dict]]:
+        """
+        (changed, unchanged) rows of a chunk. Every row gets "row_key" and "fingerprint";
+        unchanged rows also get "stored_user_id" (the Telegram ID matched last time).
+        """
+        for entry in chunk:
+            entry["row_key"] = row_key(entry)
+            entry["fingerprint"] = row_fingerprint(entry)
+        self.rows_total += len(chunk)
+        if self.full:
+            self.rows_changed += len(chunk)
+            return list(chunk), []
+
+        stored = self._db.get_sync_fingerprints(self.scope, [e["row_key"] for e in chunk])
+        changed, unchanged = [], []
+        for entry in chunk:
+            previous = stored.get(entry["row_key"])
+            if previous and previous["fingerprint"] == entry["fingerprint"]:
+                unchanged.append({**entry, "stored_user_id": previous.get("user_id")})
+            else:
+                changed.append(entry)
+        self.rows_changed += len(changed)
+        return changed, unchanged
+
+    def done(self, entry: Dict, user_id: int = None) -> None:
+        """Mark a row as reconciled; it is skipped by later syncs until it changes."""
+        self._pending.append({"row_key": entry["row_key"], "fingerprint": entry["fingerprint"],
+                              "user_id": user_id})
+        if len(self._pending) >= self.batch_size:
+            self.flush()
+
+    def flush(self) -> None:
+        rows, self._pending = self._pending, []
+        if rows and not self.dry_run:
+            self._db.save_sync_fingerprints(self.scope, rows)
+
+    def finish(self) -> None:
+        """Write the remaining fingerprints and move the watermark to this export."""
+        self.flush()
+        if self.dry_run:
+            return
+        self._db.set_sync_state(self.scope, {
+            "export_at": self.export_at.isoformat(),
+            "export_sha256": self.export_sha256,
+            "rows_total": self.rows_total,
+            "rows_changed": self.rows_changed,
+        })
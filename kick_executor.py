@@ -0,0 +1,161 @@
+"""
+Kick Executor — remove a batch of users from the channel
+Every place that kicks (lifecycle timers, /kickexpired, the admin "kick"
+button, GetCourse cancellation webhooks, kick_expired.py) goes through
+kick_many(): an optional final message, then ban + unban, with bounded
+concurrency under the shared flood-control token bucket. Each user gets a
+KickResult with a classified outcome, and the caller sends one summary
+(format_summary) instead of one admin message per user.
+"""
+import html
+import logging
+from collections import Counter
+from typing import Awaitable, Callable, Dict, Iterable, List, NamedTuple, Optional
+
+from telegram.error import BadRequest, Forbidden, NetworkError, RetryAfter, TimedOut
+
+from bulk_sender import TokenBucket, call_with_retry, run_bounded
+
+logger = logging.getLogger(__name__)
+
+KICK_CONCURRENCY = 5  # ban+unban pairs in flight; well under the bucket's rate
+
+# Outcomes
+KICKED = "kicked"              # removed from the channel
+ALREADY_GONE = "already_gone"  # was not (or no longer) a member
+SKIPPED = "skipped"            # no channel configured
+SENT = "sent"                  # final message delivered
+UNCONFIRMED = "unconfirmed"    # final message timed out and may have been delivered (never resent)
+BLOCKED_BOT = "blocked_bot"    # user blocked the bot / deleted the account
+TRANSIENT = "transient"        # network or flood error that outlasted the retries; try again later
+FAILED = "failed"              # anything else (bot not admin, chat not found, ...)
+
+# Fragments of Telegram's error descriptions, lowercased
+_GONE_ERRORS = ("user not found", "not a member", "participant_id_invalid", "user_not_participant",
+                "member not found")
+_BLOCKED_ERRORS = ("blocked by the user", "user is deactivated", "chat not found", "bot can't initiate")
+
+NoticeFactory = Callable[[Dict], Awaitable[Optional[Dict]]]
+
+
+class KickResult(NamedTuple):
+    user_id: int
+    name: str
+    outcome: str                 # KICKED, ALREADY_GONE, SKIPPED, TRANSIENT or FAILED
+    notice: Optional[str]        # SENT, UNCONFIRMED, BLOCKED_BOT, TRANSIENT, FAILED, or None if no message was due
+    error: Optional[str] = None
+    target: Optional[Dict] = None
+
+    @property
+    def removed(self) -> bool:
+        """The user no longer has channel access, so their subscription can be closed."""
+        return self.outcome in (KICKED, ALREADY_GONE, SKIPPED)
+
+
+def classify_error(error: Exception) -> str:
+    """Outcome of a failed Telegram call."""
+    text = str(error).lower()
+    if isinstance(error, (RetryAfter, TimedOut)) or (
+            isinstance(error, NetworkError) and not isinstance(error, BadRequest)):
+        return TRANSIENT
+    if any(fragment in text for fragment in _GONE_ERRORS):
+        return ALREADY_GONE
+    if isinstance(error, Forbidden) or any(fragment in text for fragment in _BLOCKED_ERRORS):
+        return BLOCKED_BOT
+    return FAILED
+
+
+async def _send_notice(bot, target: Dict, make_notice: NoticeFactory, bucket: TokenBucket) -> Optional[str]:
+    notice = await make_notice(target) if make_notice else None
+    if not notice:
+        return None
+    try:
+        await call_with_retry(lambda: bot.send_message(chat_id=target['user_id'], **notice), bucket,
+                              idempotent=False)
+        return SENT
+    except TimedOut:
+        return UNCONFIRMED
+    except Exception as e:
+        outcome = classify_error(e)
+        # "User not found" from a private chat means the user can't be messaged
+        return BLOCKED_BOT if outcome == ALREADY_GONE else outcome
+
+
+async def kick_one(bot, channel_id, target: Dict, make_notice: NoticeFactory = None,
+                   bucket: TokenBucket = None) -> KickResult:
+    """Final message (best effort), then ban + unban. target: {'user_id', 'name'?, ...}."""
+    user_id = target['user_id']
+    name = target.get('name') or target.get('email') or str(user_id)
+    notice = await _send_notice(bot, target, make_notice, bucket)
+
+    if not channel_id:
+        return KickResult(user_id, name, SKIPPED, notice, target=target)
+    try:
+        await call_with_retry(lambda: bot.ban_chat_member(chat_id=channel_id, user_id=user_id), bucket)
+        await call_with_retry(lambda: bot.unban_chat_member(chat_id=channel_id, user_id=user_id), bucket)
+    except Exception as e:
+        outcome = classify_error(e)
+        if outcome == BLOCKED_BOT:
+            outcome = FAILED  # Forbidden on ban means the bot lacks rights in the channel
+        if outcome != ALREADY_GONE:
+            logger.error(f"Failed to kick {user_id} from channel ({outcome}): {e}")
+        return KickResult(user_id, name, outcome, notice, str(e)[:200], target)
+
+    logger.info(f"🚫 Kicked {user_id} from channel")
+    return KickResult(user_id, name, KICKED, notice, target=target)
+
+
+async def kick_many(bot, channel_id, targets: Iterable[Dict], make_notice: NoticeFactory = None,
+                    bucket: TokenBucket = None, concurrency: int = KICK_CONCURRENCY) -> List[KickResult]:
+    """kick_one() for every target with at most `concurrency` in flight. Results keep input order."""
+    targets = list(targets)
+    bucket = bucket or TokenBucket()
+    results: List[Optional[KickResult]] = [None] * len(targets)
+
+    async def work(index: int) -> None:
+        try:
+            results[index] = await kick_one(bot, channel_id, targets[index], make_notice, bucket)
+        except Exception as e:
+            target = targets[index]
+            results[index] = KickResult(target['user_id'], str(target['user_id']), FAILED, None, str(e)[:200], target)
+            raise
+
+    await run_bounded(range(len(targets)), work, concurrency)
+    return results
+
+
+def count_outcomes(results: Iterable[KickResult]) -> Counter:
+    """{outcome: n} over kick outcomes, plus 'notice_<outcome>' for the final messages."""
+    counts = Counter()
+    for result in results:
+        counts[result.outcome] += 1
+        if result.notice:
+            counts[f"notice_{result.notice}"] += 1
+    return counts
+
+
+def format_summary(results: List[KickResult], title: str, max_names: int = 30) -> str:
+    """One HTML admin message describing a whole batch."""
+    counts = count_outcomes(results)
+    lines = [
+        f"🚫 <b>{title}</b>\n",
+        f"Удалено из канала: {counts[KICKED] + counts[SKIPPED]}",
+        f"Уже не в канале: {counts[ALREADY_GONE]}",
+        f"Заблокировали бота (сообщение не доставлено): {counts['notice_' + BLOCKED_BOT]}",
+    ]
+    if counts[TRANSIENT]:
+        lines.append(f"⏳ Временные ошибки (повтор позже): {counts[TRANSIENT]}")
+    if counts[FAILED]:
+        lines.append(f"❌ Ошибки: {counts[FAILED]}")
+
+    removed = [r for r in results if r.removed]
+    if removed:
+        lines.append("")
+        lines.extend(f"👤 {html.escape(r.name)} (ID: <code>{r.user_id}</code>)" for r in removed[:max_names])
+        if len(removed) > max_names:
+            lines.append(f"… и ещё {len(removed) - max_names}")
+    failed = [r for r in results if r.outcome in (TRANSIENT, FAILED)]
+    if failed:
+        lines.append("\n<b>Не удалось удалить:</b>")
+        lines.extend(f"⚠️ {html.escape(r.name)} (ID: <code>{r.user_id}</code>): {r.outcome}" for r in failed[:max_names])
+    return "\n".join(lines)
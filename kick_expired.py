@@ -1,6 +1,8 @@
 """
 Standalone Mass-Kick Script
 Run this locally to kick ALL expired subscribers from the Telegram channel.
+Uses the lifecycle planner with no grace period: every active or grace_period
+subscription past its expiry is kicked now (through kick_executor).
 
 Usage: 
   export $(grep -v '^#' .env | xargs)
@@ -23,6 +25,8 @@ CHANNEL_ID = os.getenv("CHANNEL_ID")
 PAYMENT_LINK = os.getenv("PAYMENT_LINK")
 
 import db
+import lifecycle
+import kick_executor
 
 
 def _build_payment_url(user_id: int):
@@ -34,11 +38,13 @@ def _build_payment_url(user_id: int):
 
 
 async def mass_kick():
-    from telegram import Bot, InlineKeyboardButton, InlineKeyboardMarkup
+    from telegram import InlineKeyboardButton, InlineKeyboardMarkup
+    import telegram_client
     
-    bot = Bot(token=BOT_TOKEN)
+    bot = telegram_client.get_bot()
     
-    expired = db.get_all_expired_and_overdue()
+    plan = lifecycle.plan_transitions(db.get_lifecycle_candidates(lifecycle.LOOKAHEAD_HOURS), grace_days=0)
+    expired = lifecycle.group_by_action(plan)[lifecycle.KICK]
     
     if not expired:
         print("✅ No expired subscriptions found. All good!")
@@ -46,55 +52,32 @@ async def mass_kick():
     
     print(f"🔍 Found {len(expired)} expired subscriptions. Starting kick process...\n")
     
-    kicked = 0
-    failed = 0
-    already_gone = 0
-
-    for sub in expired:
-        user_id = sub['user_id']
-        name = sub.get('name') or sub.get('email') or str(user_id)
-
+    async def expiry_notice(sub):
         renew_markup = None
-        renew_url = _build_payment_url(user_id)
+        renew_url = _build_payment_url(sub['user_id'])
         if renew_url:
             renew_markup = InlineKeyboardMarkup(
                 [[InlineKeyboardButton("✅ ПРОДЛИТЬ ПОДПИСКУ", url=renew_url)]]
             )
+        return {"text": db.EXPIRY_WARNING_TEXT, "reply_markup": renew_markup}
 
-        # Send expiry notice
-        try:
-            await bot.send_message(
-                chat_id=user_id,
-                text=db.EXPIRY_WARNING_TEXT,
-                reply_markup=renew_markup
-            )
-        except Exception:
-            pass  # User may have blocked the bot
-        
-        # Kick from channel
-        if CHANNEL_ID:
-            try:
-                await bot.ban_chat_member(chat_id=CHANNEL_ID, user_id=user_id)
-                await bot.unban_chat_member(chat_id=CHANNEL_ID, user_id=user_id)
-                kicked += 1
-                print(f"  🚫 Kicked: {name} (ID: {user_id})")
-            except Exception as e:
-                err_str = str(e).lower()
-                if 'user not found' in err_str or 'not a member' in err_str or 'participant_id_invalid' in err_str:
-                    already_gone += 1
-                    print(f"  👻 Already gone: {name} (ID: {user_id})")
-                else:
-                    failed += 1
-                    print(f"  ❌ Failed: {name} (ID: {user_id}) — {e}")
-        
-        # Mark expired in DB
-        db.mark_expired(user_id)
-    
+    results = await kick_executor.kick_many(bot, CHANNEL_ID, expired, expiry_notice)
+
+    for r in results:
+        icon = {kick_executor.KICKED: "🚫", kick_executor.ALREADY_GONE: "👻"}.get(r.outcome, "❌")
+        print(f"  {icon} {r.outcome}: {r.name} (ID: {r.user_id})" + (f" — {r.error}" if r.error else ""))
+
+    # Mark expired in DB (failed kicks stay as they are, so the next run retries them)
+    db.mark_subscriptions_expired_many([r.target['id'] for r in results if r.removed])
+    await telegram_client.close()
+
+    counts = kick_executor.count_outcomes(results)
     print(f"\n{'='*40}")
-    print(f"✅ DONE")
-    print(f"🚫 Kicked from channel: {kicked}")
-    print(f"👻 Already not in channel: {already_gone}")
-    print(f"❌ Errors: {failed}")
+    print("✅ DONE")
+    print(f"🚫 Kicked from channel: {counts[kick_executor.KICKED]}")
+    print(f"👻 Already not in channel: {counts[kick_executor.ALREADY_GONE]}")
+    print(f"📵 Blocked the bot (no notice): {counts['notice_' + kick_executor.BLOCKED_BOT]}")
+    print(f"❌ Errors: {counts[kick_executor.TRANSIENT] + counts[kick_executor.FAILED]}")
     print(f"📊 Total processed: {len(expired)}")
 
 if __name__ == "__main__":
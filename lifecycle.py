@@ -0,0 +1,96 @@
+"""
+Subscription Lifecycle — one state machine for reminders, grace period and kicks
+Replaces four jobs that each scanned club_subscriptions with their own filter.
+next_transition() gives a subscription's next state change and the moment it
+is due; lifecycle_timers.py arms one timer per upcoming transition and the
+caller applies what is due with batched writes.
+
+    active ── paid_at + REMINDER_DAY ──────────▶ REMIND_3D  (reminder_sent = true)
+    active ── expires_at - 48h … expires_at - 24h ▶ REMIND_1D  (tomorrow_reminder_sent = true)
+    active ── expires_at ──────────────────────▶ GRACE      (status = grace_period)
+    grace_period ── expires_at + GRACE_DAYS ───▶ KICK       (status = expired)
+
+The planner takes plain dicts and a clock, so it is testable without a database.
+"""
+
+from datetime import datetime, timedelta, timezone
+from typing import Dict, Iterable, List, NamedTuple, Optional
+
+from db import REMINDER_DAY, GRACE_DAYS
+
+REMIND_3D = "remind_3d"
+REMIND_1D = "remind_1d"
+GRACE = "grace"
+KICK = "kick"
+ACTIONS = (REMIND_3D, REMIND_1D, GRACE, KICK)
+
+TOMORROW_WINDOW = (timedelta(hours=48), timedelta(hours=24))  # Day-29 reminder: this far before expiry
+LOOKAHEAD_HOURS = 48  # rows expiring further out than this can only have REMIND_3D due
+
+
+class Transition(NamedTuple):
+    action: str
+    due_at: datetime
+    sub: Dict
+
+
+def parse_ts(value) -> Optional[datetime]:
+    """Supabase timestamp (or datetime) as an aware UTC datetime; naive values are taken as UTC."""
+    if not value:
+        return None
+    dt = value if isinstance(value, datetime) else datetime.fromisoformat(str(value).replace("Z", "+00:00"))
+    return dt.replace(tzinfo=timezone.utc) if dt.tzinfo is None else dt.astimezone(timezone.utc)
+
+
+def next_transition(sub: Dict, now: datetime, grace_days: int = GRACE_DAYS) -> Optional[Transition]:
+    """
+    The next transition of one subscription, whether it is due yet or not.
+    With grace_days=0 an expired active row goes straight to KICK.
+    """
+    status = sub.get("status")
+    expires_at = parse_ts(sub.get("expires_at"))
+    if not expires_at:
+        return None
+
+    if status == "grace_period":
+        return Transition(KICK, expires_at + timedelta(days=grace_days), sub)
+    if status != "active":
+        return None
+
+    if expires_at <= now:
+        return Transition(KICK if grace_days <= 0 else GRACE, expires_at, sub)
+
+    window_start, window_end = expires_at - TOMORROW_WINDOW[0], expires_at - TOMORROW_WINDOW[1]
+    if sub.get("tomorrow_reminder_sent"):
+        return Transition(GRACE, expires_at, sub)
+    if now >= window_start:
+        if now <= window_end:
+            return Transition(REMIND_1D, window_start, sub)
+        return Transition(GRACE, expires_at, sub)  # the Day-29 window has passed
+
+    paid_at = parse_ts(sub.get("paid_at"))
+    if not sub.get("reminder_sent") and paid_at:
+        remind_at = paid_at + timedelta(days=REMINDER_DAY)
+        if remind_at < window_start:
+            return Transition(REMIND_3D, remind_at, sub)
+    return Transition(REMIND_1D, window_start, sub)
+
+
+def plan_transitions(subs: Iterable[Dict], now: datetime = None,
+                     grace_days: int = GRACE_DAYS) -> List[Transition]:
+    """Every transition due at `now`, at most one per subscription."""
+    now = now or datetime.now(timezone.utc)
+    plan = []
+    for sub in subs:
+        transition = next_transition(sub, now, grace_days)
+        if transition and transition.due_at <= now:
+            plan.append(transition)
+    return plan
+
+
+def group_by_action(plan: Iterable[Transition]) -> Dict[str, List[Dict]]:
+    """{action: [subscription, ...]} for every action (empty lists included)."""
+    grouped = {action: [] for action in ACTIONS}
+    for transition in plan:
+        grouped[transition.action].append(transition.sub)
+    return grouped
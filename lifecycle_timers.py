@@ -0,0 +1,155 @@
+"""
+Lifecycle Timers — fire each subscription transition at the moment it is due
+Instead of polling club_subscriptions every few hours, the bot keeps a heap of
+(due_at, subscription) timers in its event loop, one per upcoming transition
+(lifecycle.next_transition). The database is only touched when a timer fires,
+when a user renews (refresh_user) and on a periodic resync that rebuilds the
+heap and catches changes made by other processes (GetCourse syncs, scripts).
+
+Before a due batch is applied its rows are re-read, so a renewal that happened
+since the timer was armed is never kicked.
+"""
+import heapq
+import asyncio
+import logging
+from datetime import datetime, timedelta, timezone
+from typing import Awaitable, Callable, Dict, List, Tuple
+
+import db_async
+import lifecycle
+
+logger = logging.getLogger(__name__)
+
+RESYNC_INTERVAL = timedelta(hours=12)  # full rebuild from the database
+RETRY_DELAY = timedelta(hours=1)       # a transition that did not go through is retried this much later
+MAX_SLEEP = 3600.0                     # seconds; bounds clock drift between wake-ups
+
+Apply = Callable[[List[lifecycle.Transition]], Awaitable]
+
+
+def _now() -> datetime:
+    return datetime.now(timezone.utc)
+
+
+class LifecycleTimers:
+    """Priority queue of upcoming lifecycle transitions, drained inside the bot's event loop."""
+
+    def __init__(self, resync_interval: timedelta = RESYNC_INTERVAL):
+        self.resync_interval = resync_interval
+        self._heap: List[Tuple[datetime, int, int]] = []  # (due_at, seq, subscription id)
+        self._armed: Dict[int, Tuple[int, Dict]] = {}      # subscription id -> (seq, row)
+        self._seq = 0
+        self._next_resync = None
+        self._wakeup = None
+        self.lock = asyncio.Lock()  # held while a batch is read and applied (see bot.run_lifecycle_pass)
+
+    def __len__(self) -> int:
+        return len(self._armed)
+
+    def arm(self, sub: Dict, not_before: datetime = None) -> None:
+        """(Re)arm the timer of one subscription for its next transition, replacing any older one."""
+        self._armed.pop(sub['id'], None)  # an older heap entry becomes stale
+        transition = lifecycle.next_transition(sub, _now())
+        if not transition:
+            return
+        due_at = max(transition.due_at, not_before) if not_before else transition.due_at
+        self._seq += 1
+        self._armed[sub['id']] = (self._seq, sub)
+        heapq.heappush(self._heap, (due_at, self._seq, sub['id']))
+        if self._wakeup and self._heap[0][1] == self._seq:
+            self._wakeup.set()  # new earliest timer
+
+    def disarm_user(self, user_id: int) -> None:
+        for sub_id in [i for i, (_, sub) in self._armed.items() if sub['user_id'] == user_id]:
+            del self._armed[sub_id]
+
+    async def refresh_user(self, user_id: int) -> None:
+        """Re-arm a user's timers from the database (after a payment, renewal or extension)."""
+        if self._wakeup is None:
+            return  # not running (scripts, tests)
+        subs = await db_async.get_all_subscriptions_for_user(user_id)
+        self.disarm_user(user_id)
+        for sub in subs:
+            if sub.get('status') in ('active', 'grace_period'):
+                self.arm(sub)
+
+    def request_resync(self) -> None:
+        """Rebuild the heap from the database as soon as possible."""
+        if self._wakeup is not None:
+            self._next_resync = _now()
+            self._wakeup.set()
+
+    async def resync(self) -> None:
+        """Rebuild the heap with every transition that can fall due before the next resync."""
+        hours = int(self.resync_interval.total_seconds() // 3600) + 1
+        subs = await db_async.get_lifecycle_candidates(lifecycle.LOOKAHEAD_HOURS + hours, hours)
+        if not subs and self._armed:
+            # Most likely a failed query: keep the timers we have and try again soon
+            self._next_resync = _now() + RETRY_DELAY
+            logger.warning(f"⏱️ Lifecycle timers: resync returned nothing, keeping {len(self)} timers")
+            return
+        self._heap.clear()
+        self._armed.clear()
+        for sub in subs:
+            self.arm(sub)
+        self._next_resync = _now() + self.resync_interval
+        logger.info(f"⏱️ Lifecycle timers: {len(self)} armed after resync")
+
+    def _pop_due(self, now: datetime) -> List[int]:
+        due = []
+        while self._heap and self._heap[0][0] <= now:
+            _, seq, sub_id = heapq.heappop(self._heap)
+            armed = self._armed.get(sub_id)
+            if armed and armed[0] == seq:
+                del self._armed[sub_id]
+                due.append(sub_id)
+        return due
+
+    async def _fire(self, sub_ids: List[int], apply: Apply) -> None:
+        async with self.lock:
+            now = _now()
+            fresh = await db_async.get_subscriptions_by_ids(sub_ids)  # renewals since arming win
+            plan = lifecycle.plan_transitions(fresh, now)
+            attempted = {t.sub['id']: t.action for t in plan}
+            if plan:
+                logger.info(f"⏱️ Lifecycle timers: {len(plan)} transitions due")
+                try:
+                    await apply(plan)
+                except Exception as e:
+                    logger.error(f"Lifecycle transitions failed: {e}")
+        # Arm the next step of every row; a transition that did not go through is retried later
+        for sub in await db_async.get_subscriptions_by_ids(sub_ids):
+            if sub.get('status') not in ('active', 'grace_period'):
+                continue
+            transition = lifecycle.next_transition(sub, _now())
+            retry = transition and attempted.get(sub['id']) == transition.action
+            self.arm(sub, not_before=now + RETRY_DELAY if retry else None)
+
+    async def run(self, apply: Apply) -> None:
+        """Fire due transitions through `apply` until cancelled."""
+        self._wakeup = asyncio.Event()
+        await self.resync()
+        logger.info("⏱️ Lifecycle timers started")
+        try:
+            while True:
+                self._wakeup.clear()
+                now = _now()
+                if now >= self._next_resync:
+                    await self.resync()
+                    continue
+                due = self._pop_due(now)
+                if due:
+                    await self._fire(due, apply)
+                    continue
+
+                wake_at = min(self._heap[0][0], self._next_resync) if self._heap else self._next_resync
+                timeout = min(max((wake_at - now).total_seconds(), 0.05), MAX_SLEEP)
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=timeout)
+                except asyncio.TimeoutError:
+                    pass
+        finally:
+            self._wakeup = None
+
+
+timers = LifecycleTimers()
@@ -0,0 +1,142 @@
+"""
+Media Cache — upload each campaign file to Telegram once, then reuse its file_id
+Telegram keeps every uploaded file and returns a file_id for it. Sending by
+file_id costs no upload bandwidth, so a broadcast uploads each video/voice file
+once instead of once per recipient. The index is keyed by path and content
+hash, so editing a media file triggers a fresh upload automatically.
+"""
+import os
+import json
+import asyncio
+import hashlib
+import logging
+import threading
+import weakref
+from typing import Optional
+
+from telegram.error import BadRequest
+
+logger = logging.getLogger(__name__)
+
+# Use persistent storage on Render
+if os.path.exists("/var/data"):
+    DATA_DIR = "/var/data"
+else:
+    DATA_DIR = "."
+
+INDEX_FILE = os.path.join(DATA_DIR, "media_file_ids.json")
+
+_index = None
+_index_lock = threading.Lock()
+_digests = {}  # path -> (mtime, size, sha256), avoids re-hashing unchanged files
+_upload_locks = weakref.WeakKeyDictionary()  # event loop -> {path: asyncio.Lock}
+
+
+def _load_index() -> dict:
+    global _index
+    if _index is None:
+        try:
+            with open(INDEX_FILE, "r", encoding="utf-8") as f:
+                _index = json.load(f)
+        except FileNotFoundError:
+            _index = {}
+        except Exception as e:
+            logger.error(f"Error loading media index: {e}")
+            _index = {}
+    return _index
+
+
+def _save_index() -> None:
+    try:
+        tmp = INDEX_FILE + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(_index, f, indent=2)
+        os.replace(tmp, INDEX_FILE)
+    except Exception as e:
+        logger.error(f"Error saving media index: {e}")
+
+
+def file_digest(path: str) -> str:
+    """SHA-256 of a file's contents (recomputed only when mtime/size change)."""
+    stat = os.stat(path)
+    cached = _digests.get(path)
+    if cached and cached[0] == stat.st_mtime and cached[1] == stat.st_size:
+        return cached[2]
+    sha = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            sha.update(block)
+    digest = sha.hexdigest()
+    _digests[path] = (stat.st_mtime, stat.st_size, digest)
+    return digest
+
+
+def get_file_id(path: str) -> Optional[str]:
+    """Cached Telegram file_id for the current contents of `path`, if any."""
+    digest = file_digest(path)
+    with _index_lock:
+        entry = _load_index().get(path)
+    if entry and entry.get("sha256") == digest:
+        return entry.get("file_id")
+    return None
+
+
+def remember_file_id(path: str, file_id: str) -> None:
+    with _index_lock:
+        _load_index()[path] = {"sha256": file_digest(path), "file_id": file_id}
+        _save_index()
+    logger.info(f"📎 Cached Telegram file_id for {path}")
+
+
+def forget_file_id(path: str) -> None:
+    with _index_lock:
+        if _load_index().pop(path, None) is not None:
+            _save_index()
+
+
+def _upload_lock(path: str) -> asyncio.Lock:
+    locks = _upload_locks.setdefault(asyncio.get_running_loop(), {})
+    if path not in locks:
+        locks[path] = asyncio.Lock()
+    return locks[path]
+
+
+def _extract_file_id(message, kind: str) -> Optional[str]:
+    media = getattr(message, kind, None) or message.document or message.voice
+    return media.file_id if media else None
+
+
+async def _send(bot, kind: str, chat_id: int, path: str, **kwargs):
+    send = bot.send_video if kind == "video" else bot.send_audio
+
+    file_id = get_file_id(path)
+    if file_id:
+        try:
+            return await send(chat_id=chat_id, **{kind: file_id}, **kwargs)
+        except BadRequest as e:
+            if "file" not in str(e).lower():
+                raise
+            logger.warning(f"Cached file_id for {path} rejected ({e}); re-uploading")
+            forget_file_id(path)
+
+    # Only one upload per file: concurrent senders wait here, then reuse the new file_id
+    async with _upload_lock(path):
+        file_id = get_file_id(path)
+        if file_id:
+            return await send(chat_id=chat_id, **{kind: file_id}, **kwargs)
+        with open(path, "rb") as f:
+            message = await send(chat_id=chat_id, **{kind: f}, **kwargs)
+        file_id = _extract_file_id(message, kind)
+        if file_id:
+            remember_file_id(path, file_id)
+        return message
+
+
+async def send_video(bot, chat_id: int, path: str, **kwargs):
+    """send_video that uploads `path` at most once and reuses its file_id afterwards."""
+    return await _send(bot, "video", chat_id, path, **kwargs)
+
+
+async def send_audio(bot, chat_id: int, path: str, **kwargs):
+    """send_audio that uploads `path` at most once and reuses its file_id afterwards."""
+    return await _send(bot, "audio", chat_id, path, **kwargs)
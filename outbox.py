@@ -0,0 +1,250 @@
+"""
+Outbox — durable queue for side effects of payment webhooks
+The webhook records the payment, enqueues jobs (send_invite, kick, notify_admin)
+and returns 200 at once. A worker in the bot's event loop drains the queue with
+a concurrency limit and retries failed jobs with exponential backoff, so a slow
+Telegram API or a restart never loses a paying user's invite.
+
+Jobs live in a SQLite file under DATA_DIR (the persistent disk on Render).
+Each job has an idempotency key: enqueueing the same key twice is a no-op.
+Delivery is at-least-once — a crash between the Telegram call and marking the
+job done means it runs again after the restart.
+"""
+import os
+import json
+import time
+import random
+import sqlite3
+import asyncio
+import logging
+import threading
+from datetime import datetime, timedelta
+from typing import Awaitable, Callable, Dict, List, Optional
+
+from telegram.error import Forbidden, BadRequest, RetryAfter
+
+from bulk_sender import retry_after_seconds
+
+logger = logging.getLogger(__name__)
+
+# Use persistent storage on Render
+if os.path.exists("/var/data"):
+    DATA_DIR = "/var/data"
+else:
+    DATA_DIR = "."
+
+OUTBOX_DB = os.path.join(DATA_DIR, "outbox.sqlite3")
+
+OUTBOX_CONCURRENCY = int(os.getenv("OUTBOX_CONCURRENCY", "4"))
+MAX_ATTEMPTS = 8
+BACKOFF_BASE = 5.0       # seconds before the first retry, doubled per attempt
+BACKOFF_MAX = 15 * 60
+IDLE_POLL = 30.0         # seconds between queue checks when nobody wakes the worker
+KEEP_DONE_DAYS = 7       # finished jobs are kept this long for their idempotency keys
+
+Handler = Callable[[Dict], Awaitable[None]]
+
+_local = threading.local()
+_schema_lock = threading.Lock()
+_schema_ready = False
+_handlers: Dict[str, Handler] = {}
+
+
+def _connect() -> sqlite3.Connection:
+    """Per-thread connection (sqlite3 connections must not be shared across threads)."""
+    conn = getattr(_local, "conn", None)
+    if conn is None:
+        conn = sqlite3.connect(OUTBOX_DB, timeout=10, isolation_level=None)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        _local.conn = conn
+        _ensure_schema(conn)
+    return conn
+
+
+def _ensure_schema(conn: sqlite3.Connection) -> None:
+    global _schema_ready
+    with _schema_lock:
+        if _schema_ready:
+            return
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS outbox (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                kind TEXT NOT NULL,
+                payload TEXT NOT NULL,
+                idempotency_key TEXT NOT NULL UNIQUE,
+                status TEXT NOT NULL DEFAULT 'pending',
+                attempts INTEGER NOT NULL DEFAULT 0,
+                next_attempt_at REAL NOT NULL,
+                last_error TEXT,
+                created_at TEXT NOT NULL,
+                updated_at TEXT
+            )
+        """)
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_outbox_due ON outbox(status, next_attempt_at)")
+        _schema_ready = True
+
+
+# ============================================
+# PRODUCER SIDE
+# ============================================
+
+def handler(kind: str):
+    """Decorator registering the coroutine that performs jobs of `kind`. It receives the payload dict."""
+    def register(func: Handler) -> Handler:
+        _handlers[kind] = func
+        return func
+    return register
+
+
+def enqueue(kind: str, payload: Dict, idempotency_key: str) -> bool:
+    """Add a job. Returns False if a job with this key already exists (then nothing changes)."""
+    now = datetime.now().isoformat()
+    inserted = _connect().execute(
+        "INSERT OR IGNORE INTO outbox (kind, payload, idempotency_key, next_attempt_at, created_at) "
+        "VALUES (?, ?, ?, ?, ?)",
+        (kind, json.dumps(payload, ensure_ascii=False), idempotency_key, time.time(), now),
+    ).rowcount
+    if inserted:
+        logger.info(f"📮 Outbox: queued {kind} ({idempotency_key})")
+        worker.wake()
+    else:
+        logger.info(f"📮 Outbox: {idempotency_key} already queued, skipping")
+    return bool(inserted)
+
+
+# ============================================
+# WORKER SIDE
+# ============================================
+
+def _claim_due(limit: int) -> List[Dict]:
+    """Atomically move up to `limit` due pending jobs to 'running'."""
+    conn = _connect()
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        rows = conn.execute(
+            "SELECT id, kind, payload, idempotency_key, attempts FROM outbox "
+            "WHERE status = 'pending' AND next_attempt_at <= ? ORDER BY next_attempt_at LIMIT ?",
+            (time.time(), limit),
+        ).fetchall()
+        conn.executemany(
+            "UPDATE outbox SET status = 'running', attempts = attempts + 1, updated_at = ? WHERE id = ?",
+            [(datetime.now().isoformat(), row[0]) for row in rows],
+        )
+        conn.execute("COMMIT")
+    except Exception:
+        conn.execute("ROLLBACK")
+        raise
+    return [
+        {"id": r[0], "kind": r[1], "payload": json.loads(r[2]), "key": r[3], "attempts": r[4] + 1}
+        for r in rows
+    ]
+
+
+def _finish(job_id: int, status: str, error: str = None, retry_in: float = None) -> None:
+    if retry_in is not None:
+        _connect().execute(
+            "UPDATE outbox SET status = 'pending', next_attempt_at = ?, last_error = ?, updated_at = ? WHERE id = ?",
+            (time.time() + retry_in, error, datetime.now().isoformat(), job_id),
+        )
+    else:
+        _connect().execute(
+            "UPDATE outbox SET status = ?, last_error = ?, updated_at = ? WHERE id = ?",
+            (status, error, datetime.now().isoformat(), job_id),
+        )
+
+
+def _next_due_in() -> Optional[float]:
+    row = _connect().execute(
+        "SELECT MIN(next_attempt_at) FROM outbox WHERE status = 'pending'"
+    ).fetchone()
+    return max(0.0, row[0] - time.time()) if row and row[0] is not None else None
+
+
+def _recover_and_purge(keep_days: int = KEEP_DONE_DAYS) -> None:
+    """Requeue jobs left 'running' by a crash; drop finished jobs older than `keep_days`."""
+    conn = _connect()
+    requeued = conn.execute("UPDATE outbox SET status = 'pending' WHERE status = 'running'").rowcount
+    if requeued:
+        logger.warning(f"📮 Outbox: requeued {requeued} jobs interrupted by a restart")
+    cutoff = (datetime.now() - timedelta(days=keep_days)).isoformat()
+    conn.execute("DELETE FROM outbox WHERE status IN ('done', 'dead') AND updated_at < ?", (cutoff,))
+
+
+def backoff_seconds(attempts: int) -> float:
+    """Delay before retry number `attempts` (exponential, capped, with jitter)."""
+    return min(BACKOFF_MAX, BACKOFF_BASE * 2 ** (attempts - 1)) * random.uniform(0.8, 1.2)
+
+
+class OutboxWorker:
+    """Drains the outbox inside the bot's event loop."""
+
+    def __init__(self, concurrency: int = OUTBOX_CONCURRENCY, max_attempts: int = MAX_ATTEMPTS):
+        self.concurrency = concurrency
+        self.max_attempts = max_attempts
+        self._loop = None
+        self._wakeup = None
+
+    def wake(self) -> None:
+        """Make the worker look at the queue now (safe to call from any thread)."""
+        if self._loop and self._wakeup:
+            self._loop.call_soon_threadsafe(self._wakeup.set)
+
+    async def _execute(self, job: Dict) -> None:
+        func = _handlers.get(job["kind"])
+        if not func:
+            logger.error(f"📮 Outbox: no handler for {job['kind']} ({job['key']})")
+            await asyncio.to_thread(_finish, job["id"], "dead", "no handler")
+            return
+        try:
+            await func(job["payload"])
+        except (Forbidden, BadRequest) as e:
+            # Retrying won't help (user blocked the bot, chat not found, ...)
+            logger.error(f"📮 Outbox: {job['kind']} ({job['key']}) failed permanently: {e}")
+            await asyncio.to_thread(_finish, job["id"], "dead", str(e)[:500])
+            return
+        except Exception as e:
+            if job["attempts"] >= self.max_attempts:
+                logger.error(f"📮 Outbox: {job['kind']} ({job['key']}) gave up after {job['attempts']} attempts: {e}")
+                await asyncio.to_thread(_finish, job["id"], "dead", str(e)[:500])
+                return
+            delay = retry_after_seconds(e) if isinstance(e, RetryAfter) else backoff_seconds(job["attempts"])
+            logger.warning(f"📮 Outbox: {job['kind']} ({job['key']}) attempt {job['attempts']} failed, "
+                           f"retrying in {delay:.0f}s: {e}")
+            await asyncio.to_thread(_finish, job["id"], "pending", str(e)[:500], delay)
+            return
+        await asyncio.to_thread(_finish, job["id"], "done")
+
+    async def run(self) -> None:
+        """Process jobs until cancelled."""
+        self._loop = asyncio.get_running_loop()
+        self._wakeup = asyncio.Event()
+        await asyncio.to_thread(_recover_and_purge)
+        logger.info(f"📮 Outbox worker started (concurrency {self.concurrency})")
+
+        running = set()
+        try:
+            while True:
+                self._wakeup.clear()
+                free = self.concurrency - len(running)
+                for job in (await asyncio.to_thread(_claim_due, free) if free > 0 else []):
+                    task = asyncio.create_task(self._execute(job))
+                    running.add(task)
+                    task.add_done_callback(running.discard)
+                    task.add_done_callback(lambda _: self._wakeup.set())  # a slot freed up
+
+                if len(running) >= self.concurrency:
+                    timeout = None  # all slots busy: wait until one frees up
+                else:
+                    due_in = await asyncio.to_thread(_next_due_in)
+                    timeout = IDLE_POLL if due_in is None else min(max(due_in, 0.05), IDLE_POLL)
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=timeout)
+                except asyncio.TimeoutError:
+                    pass
+        finally:
+            for task in running:
+                task.cancel()
+
+
+worker = OutboxWorker()
@@ -2,11 +2,20 @@
 Payment Token Manager
 Generates unique tokens for payment links and stores the mapping to Telegram user IDs.
 This allows us to bypass GetCourse's inability to substitute template variables.
+
+Tokens live in a SQLite file under DATA_DIR (primary-key lookups, O(1) inserts,
+safe across the bot and webhook threads). Expired tokens are purged by a
+background thread instead of rewriting a JSON file.
 """
 import os
 import json
+import time
+import hmac
+import hashlib
+import sqlite3
 import secrets
 import logging
+import threading
 from datetime import datetime, timedelta
 from typing import Optional
 
@@ -18,25 +27,75 @@ if os.path.exists("/var/data"):
 else:
     DATA_DIR = "."
 
-TOKENS_FILE = os.path.join(DATA_DIR, "payment_tokens.json")
+TOKENS_DB = os.path.join(DATA_DIR, "payment_tokens.sqlite3")
+LEGACY_TOKENS_FILE = os.path.join(DATA_DIR, "payment_tokens.json")  # imported once, then renamed
+
+# Key for signing user IDs in deferred /pay/<signed id> links
+LINK_SECRET = os.getenv("PAYMENT_LINK_SECRET") or os.getenv("BOT_TOKEN") or ""
+
+TOKEN_TTL_DAYS = 30  # links in old reminders stay resolvable for a month
+EXPIRY_INTERVAL_SECONDS = 6 * 3600
+
+_local = threading.local()
+_schema_lock = threading.Lock()
+_schema_ready = False
+_expiry_thread = None
+
+
+def _connect() -> sqlite3.Connection:
+    """Per-thread connection (sqlite3 connections must not be shared across threads)."""
+    conn = getattr(_local, "conn", None)
+    if conn is None:
+        conn = sqlite3.connect(TOKENS_DB, timeout=10, isolation_level=None)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        _local.conn = conn
+        _ensure_schema(conn)
+    return conn
 
-def load_tokens() -> dict:
-    """Load tokens from file."""
-    if not os.path.exists(TOKENS_FILE):
-        return {}
-    try:
-        with open(TOKENS_FILE, "r") as f:
-            return json.load(f)
-    except:
-        return {}
 
-def save_tokens(tokens: dict) -> None:
-    """Save tokens to file."""
+def _ensure_schema(conn: sqlite3.Connection) -> None:
+    global _schema_ready
+    with _schema_lock:
+        if _schema_ready:
+            return
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS payment_tokens (
+                token TEXT PRIMARY KEY,
+                tg_id INTEGER NOT NULL,
+                name TEXT,
+                created_at TEXT NOT NULL,
+                used INTEGER NOT NULL DEFAULT 0,
+                used_at TEXT
+            )
+        """)
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_payment_tokens_created ON payment_tokens(created_at)")
+        _import_legacy_json(conn)
+        _schema_ready = True
+
+
+def _import_legacy_json(conn: sqlite3.Connection) -> None:
+    """One-time import of the old payment_tokens.json so links already sent keep working."""
+    if not os.path.exists(LEGACY_TOKENS_FILE):
+        return
     try:
-        with open(TOKENS_FILE, "w") as f:
-            json.dump(tokens, f, indent=2, default=str)
+        with open(LEGACY_TOKENS_FILE, "r") as f:
+            tokens = json.load(f)
+        conn.executemany(
+            "INSERT OR IGNORE INTO payment_tokens (token, tg_id, name, created_at, used, used_at) "
+            "VALUES (?, ?, ?, ?, ?, ?)",
+            [
+                (token, data.get("tg_id"), data.get("name"), data.get("created_at") or datetime.now().isoformat(),
+                 1 if data.get("used") else 0, data.get("used_at"))
+                for token, data in tokens.items()
+                if data.get("tg_id") is not None
+            ],
+        )
+        os.replace(LEGACY_TOKENS_FILE, LEGACY_TOKENS_FILE + ".imported")
+        logger.info(f"📦 Imported {len(tokens)} payment tokens from {LEGACY_TOKENS_FILE}")
     except Exception as e:
-        logger.error(f"Error saving tokens: {e}")
+        logger.error(f"Error importing legacy payment tokens: {e}")
+
 
 def generate_token(tg_id: int, name: str = None) -> str:
     """
@@ -44,62 +103,86 @@ def generate_token(tg_id: int, name: str = None) -> str:
     Token format: tok_XXXXXXXXXX (10 random chars)
     """
     token = f"tok_{secrets.token_hex(5)}"  # 10 hex chars
-    
-    tokens = load_tokens()
-    tokens[token] = {
-        "tg_id": tg_id,
-        "name": name,
-        "created_at": datetime.now().isoformat(),
-        "used": False
-    }
-    save_tokens(tokens)
-    
+
+    _connect().execute(
+        "INSERT INTO payment_tokens (token, tg_id, name, created_at) VALUES (?, ?, ?, ?)",
+        (token, tg_id, name, datetime.now().isoformat()),
+    )
+
     logger.info(f"🎫 Generated payment token {token} for user {tg_id}")
     return token
 
 def lookup_token(token: str) -> Optional[int]:
     """
     Look up a token and return the associated Telegram user ID.
-    Returns None if token not found or already used.
+    Marks the token as used atomically. Returns None if the token is unknown.
     """
-    tokens = load_tokens()
-    
-    if token not in tokens:
+    conn = _connect()
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        row = conn.execute("SELECT tg_id, used FROM payment_tokens WHERE token = ?", (token,)).fetchone()
+        if row:
+            conn.execute(
+                "UPDATE payment_tokens SET used = 1, used_at = COALESCE(used_at, ?) WHERE token = ?",
+                (datetime.now().isoformat(), token),
+            )
+        conn.execute("COMMIT")
+    except Exception:
+        conn.execute("ROLLBACK")
+        raise
+
+    if not row:
         logger.warning(f"⚠️ Token not found: {token}")
         return None
-    
-    token_data = tokens[token]
-    
+
+    tg_id, used = row
+
     # Check if token was already used
-    if token_data.get("used"):
+    if used:
         logger.warning(f"⚠️ Token already used: {token}")
         # Still return the ID - allow reprocessing
-    
-    # Mark as used
-    tokens[token]["used"] = True
-    tokens[token]["used_at"] = datetime.now().isoformat()
-    save_tokens(tokens)
-    
-    tg_id = token_data.get("tg_id")
+
     logger.info(f"✅ Token {token} resolved to user {tg_id}")
     return tg_id
 
-def cleanup_old_tokens(days: int = 7) -> int:
-    """Remove tokens older than specified days."""
-    tokens = load_tokens()
-    cutoff = datetime.now() - timedelta(days=days)
-    
-    old_tokens = []
-    for token, data in tokens.items():
-        created = datetime.fromisoformat(data["created_at"])
-        if created < cutoff:
-            old_tokens.append(token)
-    
-    for token in old_tokens:
-        del tokens[token]
-    
-    if old_tokens:
-        save_tokens(tokens)
-        logger.info(f"🧹 Cleaned up {len(old_tokens)} old tokens")
-    
-    return len(old_tokens)
+def expire_tokens(days: int = TOKEN_TTL_DAYS) -> int:
+    """Delete tokens older than `days` (uses the created_at index)."""
+    cutoff = (datetime.now() - timedelta(days=days)).isoformat()
+    deleted = _connect().execute("DELETE FROM payment_tokens WHERE created_at < ?", (cutoff,)).rowcount
+    if deleted:
+        logger.info(f"🧹 Expired {deleted} old payment tokens")
+    return deleted
+
+def start_expiry_thread(interval: float = EXPIRY_INTERVAL_SECONDS, days: int = TOKEN_TTL_DAYS) -> None:
+    """Purge expired tokens in a daemon thread every `interval` seconds (idempotent)."""
+    global _expiry_thread
+    if _expiry_thread and _expiry_thread.is_alive():
+        return
+
+    def loop():
+        while True:
+            try:
+                expire_tokens(days)
+            except Exception as e:
+                logger.error(f"Error expiring payment tokens: {e}")
+            time.sleep(interval)
+
+    _expiry_thread = threading.Thread(target=loop, name="payment-token-expiry", daemon=True)
+    _expiry_thread.start()
+
+
+def _signature(tg_id: int) -> str:
+    return hmac.new(LINK_SECRET.encode(), str(tg_id).encode(), hashlib.sha256).hexdigest()[:16]
+
+def sign_user_id(tg_id: int) -> str:
+    """Tamper-proof URL segment for a user ID: '<id>.<hmac>'."""
+    return f"{tg_id}.{_signature(tg_id)}"
+
+def verify_signed_user_id(signed: str) -> Optional[int]:
+    """Return the user ID from sign_user_id() output, or None if the signature is wrong."""
+    tg_id, _, signature = (signed or "").partition(".")
+    if not tg_id.isdigit() or not LINK_SECRET:
+        return None
+    if not hmac.compare_digest(signature, _signature(int(tg_id))):
+        return None
+    return int(tg_id)
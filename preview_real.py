@@ -2,8 +2,10 @@
 import asyncio
 import os
 import json
-from telegram import Bot, InlineKeyboardButton, InlineKeyboardMarkup
+from telegram import InlineKeyboardButton, InlineKeyboardMarkup
 from dotenv import load_dotenv
+import media_cache
+import telegram_client
 
 load_dotenv()
 BOT_TOKEN = os.getenv("BOT_TOKEN")
@@ -11,7 +13,7 @@ TEST_USER_ID = 1873528397
 CONFIG_FILE = "campaign_config.json"
 
 async def preview_broadcast():
-    bot = Bot(token=BOT_TOKEN)
+    bot = telegram_client.get_bot()
     
     with open(CONFIG_FILE, "r") as f:
         config = json.load(f)["messages"]
@@ -47,11 +49,9 @@ async def preview_broadcast():
             # Send
             try:
                 if "video_file" in msg:
-                    with open(msg["video_file"], "rb") as f:
-                        await bot.send_video(chat_id=TEST_USER_ID, video=f, caption=text_content, parse_mode="HTML", reply_markup=reply_markup)
+                    await media_cache.send_video(bot, TEST_USER_ID, msg["video_file"], caption=text_content, parse_mode="HTML", reply_markup=reply_markup)
                 elif "audio_file" in msg:
-                    with open(msg["audio_file"], "rb") as f:
-                        await bot.send_audio(chat_id=TEST_USER_ID, audio=f, caption=text_content, parse_mode="HTML", reply_markup=reply_markup)
+                    await media_cache.send_audio(bot, TEST_USER_ID, msg["audio_file"], caption=text_content, parse_mode="HTML", reply_markup=reply_markup)
                 else:
                     await bot.send_message(chat_id=TEST_USER_ID, text=text_content, parse_mode="HTML", reply_markup=reply_markup)
                 
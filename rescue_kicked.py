@@ -57,8 +57,8 @@ async def main():
 
     # Phase 2: Use bot to send them invite links
     print("Using Bot to send rescue links...")
-    from telegram import Bot
-    bot = Bot(token=BOT_TOKEN)
+    import telegram_client
+    bot = telegram_client.get_bot()
     
     success = 0
     failed = 0
@@ -0,0 +1,55 @@
+-- ============================================
+-- Migration: Atomic add_subscription RPC
+-- Run this AFTER supabase_migration.sql
+-- Safe to run multiple times (CREATE OR REPLACE)
+-- ============================================
+
+-- Renews a user's subscription in one transaction:
+--   1. upsert the user row (keeps the existing email when none is passed)
+--   2. expire any access-bearing rows (active / grace_period)
+--   3. insert the new active row with the correct renewed_count
+-- A per-user advisory lock serialises concurrent calls, so duplicate
+-- GetCourse webhooks can never leave two active rows or a wrong count.
+CREATE OR REPLACE FUNCTION club_add_subscription(
+  p_user_id BIGINT,
+  p_email TEXT DEFAULT NULL,
+  p_name TEXT DEFAULT NULL,
+  p_source TEXT DEFAULT 'getcourse',
+  p_expiry_days INT DEFAULT 30
+) RETURNS club_subscriptions
+LANGUAGE plpgsql
+AS $$
+DECLARE
+  v_now TIMESTAMPTZ := NOW();
+  v_renewed_count INT;
+  v_row club_subscriptions;
+BEGIN
+  PERFORM pg_advisory_xact_lock(p_user_id);
+
+  INSERT INTO club_users (id, status, email)
+  VALUES (p_user_id, 'lead', p_email)
+  ON CONFLICT (id) DO UPDATE
+    SET status = EXCLUDED.status,
+        email = COALESCE(EXCLUDED.email, club_users.email);
+
+  UPDATE club_subscriptions
+     SET status = 'expired'
+   WHERE user_id = p_user_id
+     AND status IN ('active', 'grace_period');
+
+  SELECT COUNT(*) + 1 INTO v_renewed_count
+    FROM club_subscriptions
+   WHERE user_id = p_user_id;
+
+  INSERT INTO club_subscriptions (
+    user_id, paid_at, expires_at, status, reminder_sent,
+    payment_source, renewed_count, email, name
+  ) VALUES (
+    p_user_id, v_now, v_now + make_interval(days => p_expiry_days), 'active', FALSE,
+    p_source, v_renewed_count, p_email, p_name
+  )
+  RETURNING * INTO v_row;
+
+  RETURN v_row;
+END;
+$$;
@@ -0,0 +1,32 @@
+-- ============================================
+-- Migration: Bulk add_subscriptions RPC
+-- Run this AFTER supabase_migration_add_subscription_rpc.sql
+-- Safe to run multiple times (CREATE OR REPLACE)
+-- ============================================
+
+-- Renews many subscriptions in one request, used by sync_getcourse.py.
+-- p_entries is a JSON array of {"user_id": ..., "email": ..., "name": ...}.
+-- Each entry goes through club_add_subscription, so the per-user advisory
+-- lock and renewed_count logic are exactly the same as for a webhook.
+CREATE OR REPLACE FUNCTION club_add_subscriptions(
+  p_entries JSONB,
+  p_source TEXT DEFAULT 'getcourse_sync',
+  p_expiry_days INT DEFAULT 30
+) RETURNS SETOF club_subscriptions
+LANGUAGE plpgsql
+AS $$
+DECLARE
+  v_entry JSONB;
+BEGIN
+  FOR v_entry IN SELECT * FROM jsonb_array_elements(p_entries)
+  LOOP
+    RETURN NEXT club_add_subscription(
+      (v_entry->>'user_id')::BIGINT,
+      NULLIF(v_entry->>'email', ''),
+      NULLIF(v_entry->>'name', ''),
+      p_source,
+      p_expiry_days
+    );
+  END LOOP;
+END;
+$$;
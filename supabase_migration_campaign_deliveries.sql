@@ -0,0 +1,27 @@
+-- ============================================
+-- Migration: Per-recipient campaign delivery ledger
+-- Run this AFTER supabase_migration.sql
+-- Safe to run multiple times (uses IF NOT EXISTS)
+-- ============================================
+
+-- One row per (campaign message, recipient). Written in batches while a
+-- broadcast runs, so an interrupted broadcast resumes from the first
+-- recipient without a row instead of starting over.
+CREATE TABLE IF NOT EXISTS club_campaign_deliveries (
+  campaign_id TEXT NOT NULL,
+  message_id TEXT NOT NULL,
+  user_id BIGINT NOT NULL,
+  status TEXT NOT NULL,                       -- sent, unconfirmed (timed out), blocked, failed
+  error TEXT,
+  attempted_at TIMESTAMPTZ DEFAULT NOW(),
+  PRIMARY KEY (campaign_id, message_id, user_id)
+);
+
+CREATE INDEX IF NOT EXISTS idx_club_deliveries_status
+  ON club_campaign_deliveries(campaign_id, message_id, status);
+
+ALTER TABLE club_campaign_deliveries ENABLE ROW LEVEL SECURITY;
+
+DROP POLICY IF EXISTS "Service role access" ON club_campaign_deliveries;
+CREATE POLICY "Service role access" ON club_campaign_deliveries FOR ALL
+  USING (true) WITH CHECK (true);
@@ -0,0 +1,29 @@
+-- ============================================
+-- Migration: Normalized, indexed email columns
+-- Run this AFTER supabase_migration.sql
+-- Safe to run multiple times (uses IF NOT EXISTS)
+-- ============================================
+
+-- GetCourse matching looks users up by email. ilike() on a raw column can't
+-- use an index, so every lookup was a sequential scan. email_lower is kept in
+-- sync by Postgres itself and queried with plain equality.
+
+ALTER TABLE club_users
+  ADD COLUMN IF NOT EXISTS email_lower TEXT
+  GENERATED ALWAYS AS (NULLIF(lower(btrim(email)), '')) STORED;
+
+-- Plain index: the same email can belong to several Telegram accounts (a payer
+-- resolved by token or utm_tg_id keeps the email GetCourse sends), and a unique
+-- index would make those payments and email updates fail.
+-- Replaces the unique index an earlier version of this migration created.
+DROP INDEX IF EXISTS idx_club_users_email_lower;
+CREATE INDEX idx_club_users_email_lower
+  ON club_users(email_lower);
+
+-- Subscriptions keep one row per payment, so several rows share an email too.
+ALTER TABLE club_subscriptions
+  ADD COLUMN IF NOT EXISTS email_lower TEXT
+  GENERATED ALWAYS AS (NULLIF(lower(btrim(email)), '')) STORED;
+
+CREATE INDEX IF NOT EXISTS idx_club_subs_email_lower
+  ON club_subscriptions(email_lower);
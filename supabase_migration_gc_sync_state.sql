@@ -0,0 +1,41 @@
+-- ============================================
+-- Migration: Incremental GetCourse sync state
+-- Run this AFTER supabase_migration.sql
+-- Safe to run multiple times (uses IF NOT EXISTS)
+-- ============================================
+
+-- One fingerprint per reconciled GetCourse purchase row, per scope
+-- ('sync' for sync_getcourse.py, 'recovery' for generate_recovery_list.py).
+-- row_key identifies the purchase (email + product + period start); the
+-- fingerprint also covers status and period end, so a row is only
+-- reprocessed when it is new or changed in a later export.
+CREATE TABLE IF NOT EXISTS club_gc_sync_rows (
+  scope TEXT NOT NULL,
+  row_key TEXT NOT NULL,
+  fingerprint TEXT NOT NULL,
+  user_id BIGINT,                             -- Telegram ID the row matched, if any
+  synced_at TIMESTAMPTZ DEFAULT NOW(),
+  PRIMARY KEY (scope, row_key)
+);
+
+-- Watermark: the newest export applied per scope. Older exports are refused,
+-- an identical export (same sha256) is reported as a no-op.
+CREATE TABLE IF NOT EXISTS club_gc_sync_state (
+  scope TEXT PRIMARY KEY,
+  export_at TIMESTAMPTZ,                      -- when GetCourse produced the export
+  export_sha256 TEXT,
+  rows_total INT,
+  rows_changed INT,
+  synced_at TIMESTAMPTZ DEFAULT NOW()
+);
+
+ALTER TABLE club_gc_sync_rows ENABLE ROW LEVEL SECURITY;
+ALTER TABLE club_gc_sync_state ENABLE ROW LEVEL SECURITY;
+
+DROP POLICY IF EXISTS "Service role access" ON club_gc_sync_rows;
+CREATE POLICY "Service role access" ON club_gc_sync_rows FOR ALL
+  USING (true) WITH CHECK (true);
+
+DROP POLICY IF EXISTS "Service role access" ON club_gc_sync_state;
+CREATE POLICY "Service role access" ON club_gc_sync_state FOR ALL
+  USING (true) WITH CHECK (true);
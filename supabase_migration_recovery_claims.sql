@@ -0,0 +1,78 @@
+-- ============================================
+-- Migration: Recovery claims (replaces recovery_list.json)
+-- Run this AFTER supabase_migration_add_subscription_rpc.sql
+-- Safe to run multiple times (IF NOT EXISTS / CREATE OR REPLACE)
+-- ============================================
+
+-- GetCourse buyers who paid but have no channel access. Filled by
+-- generate_recovery_list.py; consumed by the bot when the buyer enters
+-- their email. A claimed row is kept (claimed_by set) so it can't be reused.
+CREATE TABLE IF NOT EXISTS club_recovery_claims (
+  email_lower TEXT PRIMARY KEY,
+  name TEXT,
+  expires TEXT,                               -- "Заканчивается" as exported by GetCourse
+  created_at TIMESTAMPTZ DEFAULT NOW(),
+  claimed_by BIGINT,
+  claimed_at TIMESTAMPTZ,
+  subscription_id BIGINT
+);
+
+ALTER TABLE club_recovery_claims ENABLE ROW LEVEL SECURITY;
+
+DROP POLICY IF EXISTS "Service role access" ON club_recovery_claims;
+CREATE POLICY "Service role access" ON club_recovery_claims FOR ALL
+  USING (true) WITH CHECK (true);
+
+-- Check, consume and grant in one transaction. The conditional UPDATE means
+-- two users submitting the same email at once can't both claim it, and a user
+-- (or email) that already has an active or grace subscription can't claim a
+-- free extra month. Returns the claimed row plus result = 'claimed',
+-- {result: 'has_access', email_lower} when the entry was left unclaimed for
+-- that reason, or NULL when there is nothing to claim.
+DROP FUNCTION IF EXISTS club_claim_recovery(TEXT, BIGINT, TEXT, INT);
+
+CREATE OR REPLACE FUNCTION club_claim_recovery(
+  p_email TEXT,
+  p_user_id BIGINT,
+  p_name TEXT DEFAULT NULL,
+  p_expiry_days INT DEFAULT 30
+) RETURNS JSONB
+LANGUAGE plpgsql
+AS $$
+DECLARE
+  v_email TEXT := NULLIF(lower(btrim(p_email)), '');
+  v_claim club_recovery_claims;
+  v_sub club_subscriptions;
+BEGIN
+  UPDATE club_recovery_claims c
+     SET claimed_by = p_user_id,
+         claimed_at = NOW()
+   WHERE c.email_lower = v_email
+     AND c.claimed_by IS NULL
+     AND NOT EXISTS (
+       SELECT 1 FROM club_subscriptions s
+        WHERE (s.user_id = p_user_id OR s.email_lower = v_email)
+          AND s.status IN ('active', 'grace_period')
+     )
+  RETURNING c.* INTO v_claim;
+
+  IF NOT FOUND THEN
+    IF EXISTS (SELECT 1 FROM club_recovery_claims
+                WHERE email_lower = v_email AND claimed_by IS NULL) THEN
+      RETURN jsonb_build_object('result', 'has_access', 'email_lower', v_email);
+    END IF;
+    RETURN NULL;
+  END IF;
+
+  v_sub := club_add_subscription(
+    p_user_id, v_email, COALESCE(NULLIF(v_claim.name, ''), p_name), 'auto_recovery', p_expiry_days
+  );
+
+  UPDATE club_recovery_claims
+     SET subscription_id = v_sub.id
+   WHERE email_lower = v_email
+  RETURNING * INTO v_claim;
+
+  RETURN to_jsonb(v_claim) || jsonb_build_object('result', 'claimed');
+END;
+$$;
@@ -0,0 +1,23 @@
+-- ============================================
+-- Migration: Day-29 reminder flag
+-- The Day-29 ("expires tomorrow") reminder used to be sent to everyone in a
+-- 24-48h window on every check, so it could arrive several times. The bot
+-- now sets this flag when it sends the reminder and never sends it again.
+-- Safe to run multiple times (uses IF NOT EXISTS)
+-- ============================================
+
+ALTER TABLE club_subscriptions
+  ADD COLUMN IF NOT EXISTS tomorrow_reminder_sent BOOLEAN NOT NULL DEFAULT FALSE;
+
+-- Rows already inside (or past) the window were reminded by the old polling job
+UPDATE club_subscriptions
+  SET tomorrow_reminder_sent = TRUE
+  WHERE status = 'active'
+    AND tomorrow_reminder_sent = FALSE
+    AND expires_at <= NOW() + INTERVAL '44 hours';
+
+-- Lifecycle candidates: access rows ordered by expiry
+CREATE INDEX IF NOT EXISTS idx_club_subscriptions_status_expires
+  ON club_subscriptions (status, expires_at);
+
+COMMENT ON COLUMN club_subscriptions.tomorrow_reminder_sent IS 'Day-29 reminder sent (see lifecycle.py)';
@@ -6,194 +6,226 @@ Takes a CSV exported from GetCourse (Покупки → Активна) and:
 2. Creates/renews subscriptions for matched users
 3. Reports unmatched emails (paid but bot doesn't know their Telegram ID)
 
-CSV format expected: at minimum an 'email' column. 
+CSV format expected: at minimum an 'email' column.
 GetCourse export usually has columns like: Номер, Продукт, Имя, Статус, Период, Email, etc.
 
+The CSV is streamed in chunks: each chunk's emails are resolved with one bulk
+query and diffed against the access map (loaded once), and renewals are written
+with one batched RPC per chunk instead of several requests per row.
+
+Syncs are incremental: rows reconciled by an earlier run (same fingerprint, and
+the user still has access) are skipped without touching the database. Active rows
+nobody could be matched to are retried every run. Use --full to reprocess everything.
+
 Usage:
   python3 sync_getcourse.py active_purchases.csv
+  python3 sync_getcourse.py export.csv --dry-run     # report only, write nothing
+  python3 sync_getcourse.py export.csv --expire      # also expire access of ended purchases
+  python3 sync_getcourse.py export.csv --full        # ignore fingerprints from earlier runs
 """
 
-import csv
 import sys
 import os
+import time
 import logging
-from datetime import datetime
+import argparse
 from dotenv import load_dotenv
 
 load_dotenv()
 logging.basicConfig(level=logging.INFO, format="%(message)s")
 
 import db
+from getcourse_export import PurchaseExport, IncrementalSync
+
+DEFAULT_CHUNK_SIZE = 500
+SYNC_SCOPE = "sync"
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Sync a GetCourse purchases export with Supabase")
+    parser.add_argument("csv_path", help="GetCourse CSV export (semicolon-separated)")
+    parser.add_argument("--dry-run", action="store_true",
+                        help="match and report, but don't write anything to Supabase")
+    parser.add_argument("--expire", action="store_true",
+                        help="expire channel access for matched users whose purchases all ended")
+    parser.add_argument("--chunk-size", type=int, default=DEFAULT_CHUNK_SIZE,
+                        help=f"CSV rows per bulk lookup (default {DEFAULT_CHUNK_SIZE})")
+    parser.add_argument("--full", action="store_true",
+                        help="reprocess every row, ignoring fingerprints and the watermark")
+    return parser.parse_args()
 
-def find_email_column(headers):
-    """Find the email column in CSV headers (case-insensitive, supports Russian)."""
-    for i, h in enumerate(headers):
-        h_lower = h.lower().strip()
-        if h_lower in ['email', 'e-mail', 'почта', 'отображаемое имя']:
-            return i
-        if 'email' in h_lower or 'mail' in h_lower:
-            return i
-    return None
-
-def find_name_column(headers):
-    """Find the name column."""
-    for i, h in enumerate(headers):
-        h_lower = h.lower().strip()
-        if h_lower in ['имя', 'отображаемое имя', 'name', 'фио']:
-            return i
-    return None
 
 def main():
-    if len(sys.argv) < 2:
-        print("Usage: python3 sync_getcourse.py <path_to_csv>")
-        sys.exit(1)
-    
-    csv_path = sys.argv[1]
-    
+    args = parse_args()
+    csv_path = args.csv_path
+
     if not os.path.exists(csv_path):
         print(f"❌ File not found: {csv_path}")
         sys.exit(1)
-    
-    # Read CSV — GetCourse uses semicolons and utf-8
-    rows = []
-    headers = []
-    
-    for encoding in ['utf-8', 'cp1251', 'latin-1']:
-        try:
-            with open(csv_path, 'r', encoding=encoding) as f:
-                reader = csv.reader(f, delimiter=';')
-                headers = [h.strip().strip('"') for h in next(reader)]
-                rows = list(reader)
-                if len(headers) > 1:
-                    break
-        except Exception:
-            continue
-    
-    if not rows:
-        print("❌ Could not parse CSV.")
-        sys.exit(1)
-    
-    print(f"📄 Read {len(rows)} rows from CSV")
+
+    export = PurchaseExport(csv_path)
+    headers, col_map = export.headers, export.columns
+
+    print(f"📄 Reading {csv_path} ({export.encoding})")
     print(f"   Columns: {headers}\n")
-    
-    # Map columns by name
-    col_map = {}
-    for i, h in enumerate(headers):
-        h_clean = h.lower().strip()
-        if 'адрес' in h_clean or 'email' in h_clean or 'mail' in h_clean:
-            col_map['email'] = i
-        elif h_clean in ['пользователь', 'имя', 'name']:
-            col_map['name'] = i
-        elif h_clean in ['статус', 'status']:
-            col_map['status'] = i
-    
+
     if 'email' not in col_map:
         print(f"❌ Could not find email column. Available: {headers}")
         sys.exit(1)
-    
+
     print(f"   Email column: '{headers[col_map['email']]}'")
     if 'name' in col_map:
         print(f"   Name column: '{headers[col_map['name']]}'")
     if 'status' in col_map:
         print(f"   Status column: '{headers[col_map['status']]}'")
+    if args.dry_run:
+        print("   🧪 DRY RUN — nothing will be written")
     print()
-    
-    # Separate active vs ended
-    active_emails = []
-    ended_emails = []
-    
-    for row in rows:
-        if len(row) <= col_map['email']:
-            continue
-        
-        email = row[col_map['email']].strip().strip('"')
-        name = row[col_map.get('name', 0)].strip().strip('"') if 'name' in col_map else None
-        status = row[col_map.get('status', 0)].strip().strip('"') if 'status' in col_map else 'Активна'
-        
-        if not email or '@' not in email:
-            continue
-        
-        entry = {"email": email, "name": name, "gc_status": status}
-        
-        if status.lower() in ['активна', 'active']:
-            active_emails.append(entry)
-        else:
-            ended_emails.append(entry)
-    
-    print(f"📊 GetCourse totals: {len(active_emails)} active, {len(ended_emails)} ended\n")
-    
-    # Process ACTIVE ones — match with Supabase
+
+    started = time.monotonic()
+
+    sync = IncrementalSync(SYNC_SCOPE, export, full=args.full, dry_run=args.dry_run)
+    refusal = sync.check_watermark()
+    if refusal:
+        print(f"❌ Not syncing: {refusal}")
+        sys.exit(1)
+    if sync.previous:
+        print(f"🔖 Last sync: export of {sync.previous.get('export_at')}"
+              + (" (identical file)" if sync.identical_export else "") + "\n")
+
+    # Who has channel access right now: {user_id: subscription}, fetched once for the whole sync.
+    # A failed query must abort: an empty map would renew every subscriber.
+    try:
+        access_map = {sub['user_id']: sub for sub in db.get_all_access_subscribers(strict=True)}
+    except Exception as e:
+        print(f"❌ Not syncing: could not load current subscribers ({e})")
+        sys.exit(1)
+
+    active_seen = set()   # emails with at least one active purchase
     matched_active = []
     unmatched_active = []
+    unchanged_ids = set() # users whose active rows were reconciled by an earlier run
     renewed = 0
-    
-    for entry in active_emails:
-        email = entry['email']
-        name = entry['name']
-        
-        user = db.get_user_by_email(email)
-        
-        if user:
+    ended = {}            # email -> entry; resolved at the end, once all active emails are known
+
+    for chunk in export.chunks(args.chunk_size):
+        changed, unchanged = sync.split(chunk)
+        for entry in unchanged:
+            if entry['active'] and entry['stored_user_id'] in access_map:
+                active_seen.add(entry['email'])
+                unchanged_ids.add(entry['stored_user_id'])
+            elif entry['active']:
+                changed.append(entry)  # reconciled before, but access has lapsed since: look again
+        if not changed:
+            continue
+
+        users = db.get_users_by_emails({entry['email'] for entry in changed})
+
+        to_renew = []
+        for entry in changed:
+            email = entry['email']
+            user = users.get(email)
+
+            if not entry['active']:
+                if email not in ended:
+                    ended[email] = {**entry, "tg_id": user['id'] if user else None, "rows": []}
+                ended[email]["rows"].append(entry)
+                continue
+
+            # Several active purchases for one email count once
+            if email in active_seen:
+                sync.done(entry, user['id'] if user else None)
+                continue
+            active_seen.add(email)
+
+            if not user:
+                unmatched_active.append(entry)  # no fingerprint: retried next run
+                continue
+
             user_id = user['id']
-            access_sub = db.get_access_subscription(user_id)
-            if access_sub:
+            sync.done(entry, user_id)
+            if user_id in access_map:
                 matched_active.append({**entry, "tg_id": user_id, "action": "already_active"})
             else:
-                db.add_subscription(user_id=user_id, email=email, name=name, source='getcourse_sync')
-                renewed += 1
+                to_renew.append({"user_id": user_id, "email": email, "name": entry['name']})
+                access_map[user_id] = None  # a second email for the same user must not renew twice
                 matched_active.append({**entry, "tg_id": user_id, "action": "renewed"})
-        else:
-            unmatched_active.append(entry)
-    
-    # Process ENDED ones — match with Supabase to mark expired
+
+        if to_renew:
+            if not args.dry_run:
+                for row in db.add_subscriptions_many(to_renew, source='getcourse_sync'):
+                    access_map[row['user_id']] = row
+            renewed += len(to_renew)
+
+    # An ended purchase only matters if the same email has no active one
+    active_ids = {m['tg_id'] for m in matched_active} | unchanged_ids
     matched_ended = []
     unmatched_ended = []
-    
-    for entry in ended_emails:
-        email = entry['email']
-        user = db.get_user_by_email(email)
-        
-        if user:
-            user_id = user['id']
-            matched_ended.append({**entry, "tg_id": user_id})
+    for email, entry in ended.items():
+        if email in active_seen or entry['tg_id'] in active_ids:
+            pass
+        elif entry['tg_id']:
+            matched_ended.append(entry)
+            # Without --expire the user keeps access, so keep the rows pending for a later run
+            if access_map.get(entry['tg_id']) and not args.expire:
+                continue
         else:
             unmatched_ended.append(entry)
-    
+        for row in entry['rows']:
+            sync.done(row, entry['tg_id'])
+
+    expired = 0
+    if args.expire:
+        to_expire = [access_map[m['tg_id']]['id'] for m in matched_ended if access_map.get(m['tg_id'])]
+        if to_expire and not args.dry_run:
+            expired = len(db.mark_subscriptions_expired_many(to_expire))
+        else:
+            expired = len(to_expire)
+
+    sync.finish()
+
+    elapsed = time.monotonic() - started
+
     # === REPORT ===
     print("=" * 55)
     print(f"\n✅ ACTIVE & MATCHED (paid, bot knows them): {len(matched_active)}")
     for m in matched_active:
         icon = "🔄" if m['action'] == 'renewed' else "✅"
         print(f"   {icon} {m['name'] or m['email']} (TG: {m['tg_id']})")
-    
+
     print(f"\n⚠️  ACTIVE but UNMATCHED (paid, bot DOESN'T know): {len(unmatched_active)}")
     for u in unmatched_active:
         print(f"   ❓ {u['name'] or '—'} ({u['email']})")
-    
+
     print(f"\n🔴 ENDED & MATCHED (didn't renew, bot knows → CAN KICK): {len(matched_ended)}")
     for m in matched_ended:
         print(f"   🚫 {m['name'] or m['email']} (TG: {m['tg_id']})")
-    
+
     print(f"\n⬜ ENDED & UNMATCHED (ended, bot doesn't know): {len(unmatched_ended)}")
-    
+
+    rate = sync.rows_total / elapsed if elapsed > 0 else 0.0
     print(f"\n{'='*55}")
-    print(f"📊 SUMMARY:")
-    print(f"   Total in CSV:           {len(active_emails) + len(ended_emails)}")
+    print(f"📊 SUMMARY{' (dry run)' if args.dry_run else ''}:")
+    print(f"   Total in CSV:           {sync.rows_total} ({sync.rows_changed} new or changed)")
+    print(f"   Unchanged & active:     {len(unchanged_ids)} users (skipped)")
     print(f"   Active & synced:        {len(matched_active)} (of which {renewed} renewed)")
     print(f"   Active & unmatched:     {len(unmatched_active)} ← DO NOT KICK these!")
     print(f"   Ended & can kick:       {len(matched_ended)}")
     print(f"   Ended & unknown:        {len(unmatched_ended)}")
-    
+    if args.expire:
+        print(f"   Access expired:         {expired}")
+    print(f"   Time:                   {elapsed:.1f}s ({rate:.0f} rows/s)")
+
     if unmatched_active:
         with open("unmatched_paid_users.txt", "w", encoding="utf-8") as f:
             f.write("# These users PAID on GetCourse but bot doesn't know their Telegram ID\n")
             f.write("# DO NOT remove them from the channel\n\n")
             for u in unmatched_active:
                 f.write(f"{u['email']} — {u['name'] or 'no name'}\n")
-        print(f"\n   → Saved unmatched list to unmatched_paid_users.txt")
-    
+        print("\n   → Saved unmatched list to unmatched_paid_users.txt")
+
     # Save whitelist
-    whitelist_ids = [m['tg_id'] for m in matched_active]
+    whitelist_ids = sorted(active_ids)
     with open("whitelist_ids.txt", "w") as f:
         for tid in whitelist_ids:
             f.write(f"{tid}\n")
@@ -0,0 +1,60 @@
+"""
+Telegram Client — one long-lived Bot per process
+Every Bot owns an HTTP connection pool. Creating a Bot per broadcast or per
+webhook throws that pool away and pays TCP+TLS setup again on the next call.
+The bot process registers its Application's bot here (set_bot); broadcasts,
+scheduler jobs, webhook side effects and one-off scripts all call get_bot().
+
+The pool belongs to the event loop that first uses it, so the shared bot must
+only be used from that loop (in bot.py everything runs on the Application's loop).
+"""
+import os
+import logging
+from typing import Optional
+
+from telegram import Bot
+from telegram.request import HTTPXRequest
+
+from bulk_sender import BROADCAST_CONCURRENCY
+
+logger = logging.getLogger(__name__)
+
+# Broadcast senders + outbox workers + update handlers all share this pool
+TELEGRAM_POOL_SIZE = int(os.getenv("TELEGRAM_POOL_SIZE", str(max(16, BROADCAST_CONCURRENCY + 8))))
+TELEGRAM_POOL_TIMEOUT = float(os.getenv("TELEGRAM_POOL_TIMEOUT", "10"))  # seconds to wait for a free connection
+
+_bot: Optional[Bot] = None
+
+
+def build_request() -> HTTPXRequest:
+    """HTTP transport sized for concurrent sends (the library default is a single connection)."""
+    return HTTPXRequest(connection_pool_size=TELEGRAM_POOL_SIZE, pool_timeout=TELEGRAM_POOL_TIMEOUT)
+
+
+def set_bot(bot: Bot) -> None:
+    """Make `bot` (normally Application.bot) the shared client of this process."""
+    global _bot
+    _bot = bot
+
+
+def get_bot() -> Bot:
+    """The shared Bot, created on first use if the process has no Application."""
+    global _bot
+    if _bot is None:
+        token = os.getenv("BOT_TOKEN")
+        if not token:
+            raise RuntimeError("BOT_TOKEN is not set")
+        _bot = Bot(token=token, request=build_request())
+        logger.info(f"🤖 Telegram client created (pool size {TELEGRAM_POOL_SIZE})")
+    return _bot
+
+
+async def close() -> None:
+    """Close the shared client's connections (for scripts, before their event loop ends)."""
+    global _bot
+    if _bot is not None:
+        await _bot.shutdown()
+        # Bot.shutdown() does nothing for a Bot that was never initialize()d (get_bot() never
+        # does), so close the HTTP transport directly; closing it twice is harmless
+        await _bot.request.shutdown()
+        _bot = None
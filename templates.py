@@ -0,0 +1,164 @@
+"""
+Message Templates — in-memory registry for everything under messages/
+All message files are read once at startup and served from memory, so /start
+and broadcasts never touch the disk. Every file is checked against Telegram's
+HTML subset when loaded: a broken tag fails the deploy instead of a campaign.
+Files edited while the bot runs are picked up via an mtime check that runs at
+most once per RELOAD_INTERVAL seconds.
+"""
+import os
+import re
+import time
+import logging
+import threading
+from html.parser import HTMLParser
+from typing import Optional
+
+logger = logging.getLogger(__name__)
+
+TEMPLATES_DIR = "messages"
+RELOAD_INTERVAL = 30  # seconds between mtime scans
+
+# https://core.telegram.org/bots/api#html-style
+ALLOWED_TAGS = {
+    "b", "strong", "i", "em", "u", "ins", "s", "strike", "del",
+    "a", "code", "pre", "span", "tg-spoiler", "tg-emoji", "blockquote",
+}
+_BAD_AMPERSAND = re.compile(r"&(?!(?:lt|gt|amp|quot|#\d+|#x[0-9a-fA-F]+);)")
+
+
+class TemplateError(ValueError):
+    """A message file is not valid Telegram HTML."""
+
+
+class _TelegramHTMLValidator(HTMLParser):
+    def __init__(self):
+        super().__init__(convert_charrefs=False)
+        self.stack = []
+        self.errors = []
+
+    def handle_starttag(self, tag, attrs):
+        attrs = dict(attrs)
+        if tag not in ALLOWED_TAGS:
+            self.errors.append(f"unsupported tag <{tag}> at line {self.getpos()[0]}")
+        elif tag == "a" and not attrs.get("href"):
+            self.errors.append(f"<a> without href at line {self.getpos()[0]}")
+        elif tag == "span" and attrs.get("class") != "tg-spoiler":
+            self.errors.append(f"<span> without class=\"tg-spoiler\" at line {self.getpos()[0]}")
+        self.stack.append(tag)
+
+    def handle_startendtag(self, tag, attrs):
+        self.errors.append(f"self-closing tag <{tag}/> at line {self.getpos()[0]}")
+
+    def handle_endtag(self, tag):
+        if not self.stack or self.stack[-1] != tag:
+            expected = f"</{self.stack[-1]}>" if self.stack else "no closing tag"
+            self.errors.append(f"unexpected </{tag}> at line {self.getpos()[0]} (expected {expected})")
+            if tag in self.stack:
+                del self.stack[len(self.stack) - 1 - self.stack[::-1].index(tag):]
+            return
+        self.stack.pop()
+
+    def handle_data(self, data):
+        if "<" in data or ">" in data:
+            self.errors.append(f"unescaped '<' or '>' at line {self.getpos()[0]} (use &lt; / &gt;)")
+
+
+def validate_telegram_html(text: str) -> None:
+    """Raise TemplateError if `text` would be rejected by Telegram's HTML parse mode."""
+    validator = _TelegramHTMLValidator()
+    validator.feed(text)
+    validator.close()
+    errors = validator.errors
+    if validator.stack:
+        errors.append("unclosed " + ", ".join(f"<{t}>" for t in validator.stack))
+    if _BAD_AMPERSAND.search(text):
+        errors.append("unescaped '&' (use &amp;)")
+    if errors:
+        raise TemplateError("; ".join(errors))
+
+
+class TemplateRegistry:
+    """Preloaded, validated message files keyed by their relative path (e.g. messages/msg_01.txt)."""
+
+    def __init__(self, root: str = TEMPLATES_DIR, reload_interval: float = RELOAD_INTERVAL):
+        self.root = root
+        self.reload_interval = reload_interval
+        self._texts = {}   # path -> text
+        self._mtimes = {}  # path -> mtime the text was read at
+        self._checked_at = 0.0
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _key(path: str) -> str:
+        return os.path.normpath(path)
+
+    def _read(self, key: str) -> str:
+        with open(key, "r", encoding="utf-8") as f:
+            text = f.read()
+        validate_telegram_html(text)
+        return text
+
+    def load_all(self) -> int:
+        """Read and validate every file under the root. Raises TemplateError listing all bad files."""
+        problems = []
+        with self._lock:
+            for name in sorted(os.listdir(self.root)) if os.path.isdir(self.root) else []:
+                if not name.endswith(".txt"):
+                    continue
+                key = self._key(os.path.join(self.root, name))
+                try:
+                    mtime = os.path.getmtime(key)
+                    self._texts[key] = self._read(key)
+                    self._mtimes[key] = mtime
+                except (OSError, TemplateError) as e:
+                    problems.append(f"{key}: {e}")
+            self._checked_at = time.monotonic()
+        if problems:
+            raise TemplateError("Invalid message templates:\n" + "\n".join(problems))
+        logger.info(f"📝 Loaded {len(self._texts)} message templates from {self.root}/")
+        return len(self._texts)
+
+    def _reload_changed(self) -> None:
+        """Re-read files whose mtime changed. A bad edit keeps the last good version."""
+        for key, old_mtime in list(self._mtimes.items()):
+            try:
+                mtime = os.path.getmtime(key)
+            except OSError:
+                continue
+            if mtime == old_mtime:
+                continue
+            try:
+                self._texts[key] = self._read(key)
+                logger.info(f"🔄 Reloaded template {key}")
+            except (OSError, TemplateError) as e:
+                logger.error(f"Keeping previous version of {key}, new one is invalid: {e}")
+            self._mtimes[key] = mtime
+
+    def get(self, path: str) -> Optional[str]:
+        """Template text for `path`, or None if it doesn't exist or is invalid."""
+        key = self._key(path)
+        with self._lock:
+            if time.monotonic() - self._checked_at >= self.reload_interval:
+                self._checked_at = time.monotonic()
+                self._reload_changed()
+            if key in self._texts:
+                return self._texts[key]
+            # Not preloaded (e.g. a file outside messages/): load once, then serve from memory
+            try:
+                mtime = os.path.getmtime(key)
+                self._texts[key] = self._read(key)
+                self._mtimes[key] = mtime
+                return self._texts[key]
+            except (OSError, TemplateError) as e:
+                logger.error(f"Error loading text file {path}: {e}")
+                return None
+
+
+registry = TemplateRegistry()
+
+
+def get_text(path: str, default: str = "") -> str:
+    """Convenience accessor on the shared registry."""
+    text = registry.get(path)
+    return text if text is not None else default
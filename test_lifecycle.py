@@ -0,0 +1,104 @@
+"""
+Table tests for the lifecycle planner (lifecycle.py): plain dicts and a fixed clock, no database.
+
+Run: python -m pytest -q test_lifecycle.py
+"""
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+import lifecycle
+from lifecycle import REMIND_3D, REMIND_1D, GRACE, KICK
+
+NOW = datetime(2026, 3, 10, 12, 0, tzinfo=timezone.utc)
+
+
+def sub(id=1, status="active", expires=None, paid=None, reminder_sent=False, tomorrow_reminder_sent=False):
+    """A club_subscriptions row; `expires` and `paid` are offsets from NOW."""
+    return {
+        "id": id,
+        "user_id": 1000 + id,
+        "status": status,
+        "expires_at": (NOW + expires).isoformat() if expires is not None else None,
+        "paid_at": (NOW + paid).isoformat() if paid is not None else None,
+        "reminder_sent": reminder_sent,
+        "tomorrow_reminder_sent": tomorrow_reminder_sent,
+    }
+
+
+# (case, row, grace_days, expected action, expected due_at offset from NOW, due now)
+CASES = [
+    ("day 27 reminder due",
+     sub(paid=-timedelta(days=27, hours=1), expires=timedelta(days=3, hours=-1)),
+     3, REMIND_3D, -timedelta(hours=1), True),
+    ("day 27 reminder not yet",
+     sub(paid=-timedelta(days=10), expires=timedelta(days=20)),
+     3, REMIND_3D, timedelta(days=17), False),
+    ("day 27 reminder sent, day 29 reminder next",
+     sub(paid=-timedelta(days=25), expires=timedelta(days=5), reminder_sent=True),
+     3, REMIND_1D, timedelta(days=3), False),
+    ("day 29 reminder inside its window",
+     sub(paid=-timedelta(days=28, hours=12), expires=timedelta(hours=36), reminder_sent=True),
+     3, REMIND_1D, -timedelta(hours=12), True),
+    ("day 29 window passed, grace next",
+     sub(paid=-timedelta(days=29, hours=12), expires=timedelta(hours=12)),
+     3, GRACE, timedelta(hours=12), False),
+    ("expired active row goes to grace",
+     sub(paid=-timedelta(days=30, hours=1), expires=-timedelta(hours=1),
+         reminder_sent=True, tomorrow_reminder_sent=True),
+     3, GRACE, -timedelta(hours=1), True),
+    ("expired active row is kicked without grace",
+     sub(expires=-timedelta(hours=1)),
+     0, KICK, -timedelta(hours=1), True),
+    ("grace period over",
+     sub(status="grace_period", expires=-timedelta(days=4)),
+     3, KICK, -timedelta(days=1), True),
+    ("grace period still running",
+     sub(status="grace_period", expires=-timedelta(days=1)),
+     3, KICK, timedelta(days=2), False),
+    ("renewed row starts over",
+     sub(paid=timedelta(0), expires=timedelta(days=30)),
+     3, REMIND_3D, timedelta(days=27), False),
+]
+
+
+@pytest.mark.parametrize("case,row,grace_days,action,due_in,due_now", CASES, ids=[c[0] for c in CASES])
+def test_next_transition(case, row, grace_days, action, due_in, due_now):
+    transition = lifecycle.next_transition(row, NOW, grace_days)
+    assert transition.action == action
+    assert transition.due_at == NOW + due_in
+    assert transition.sub is row
+    assert bool(lifecycle.plan_transitions([row], NOW, grace_days)) == due_now
+
+
+@pytest.mark.parametrize("row", [
+    sub(status="expired", expires=-timedelta(days=10)),
+    sub(status="active", expires=None),
+], ids=["expired row", "no expiry"])
+def test_no_transition(row):
+    assert lifecycle.next_transition(row, NOW) is None
+    assert lifecycle.plan_transitions([row], NOW) == []
+
+
+def test_naive_timestamps_are_utc():
+    row = sub(status="grace_period")
+    row["expires_at"] = (NOW - timedelta(days=4)).replace(tzinfo=None).isoformat()
+    assert lifecycle.next_transition(row, NOW).due_at == NOW - timedelta(days=1)
+
+
+def test_plan_keeps_only_due_rows_and_groups_them():
+    cases = [c for c in CASES if c[2] == 3]
+    rows = [dict(row, id=i) for i, (_, row, *_) in enumerate(cases)]
+    plan = lifecycle.plan_transitions(rows, NOW)
+    assert [t.sub["id"] for t in plan] == [i for i, c in enumerate(cases) if c[5]]
+
+    grouped = lifecycle.group_by_action(plan)
+    assert set(grouped) == set(lifecycle.ACTIONS)
+    assert [s["id"] for s in grouped[REMIND_3D]] == [0]
+    assert [s["id"] for s in grouped[REMIND_1D]] == [3]
+    assert [s["id"] for s in grouped[GRACE]] == [5]
+    assert [s["id"] for s in grouped[KICK]] == [6]
+
+
+def test_group_by_action_empty():
+    assert lifecycle.group_by_action([]) == {action: [] for action in lifecycle.ACTIONS}
@@ -0,0 +1,149 @@
+"""
+Webhook Dedup — drop repeated GetCourse callbacks for the same order event
+GetCourse retries callbacks and sometimes sends both a GET and a POST for one
+order. Each event is reduced to a key (order identifiers + status class); the
+first request claims it as 'pending' and marks it 'done' once its changes are
+recorded (complete), copies are answered without touching Supabase or Telegram.
+A key left pending by a crash is handed to the next retry after PENDING_TIMEOUT.
+Done keys are checked in an in-memory cache first and persisted in a SQLite
+table under DATA_DIR, so duplicates are still caught after a restart.
+"""
+import os
+import time
+import sqlite3
+import hashlib
+import logging
+import threading
+from datetime import datetime, timedelta
+from typing import Dict
+
+from ttl_cache import TTLCache
+
+logger = logging.getLogger(__name__)
+
+# Use persistent storage on Render
+if os.path.exists("/var/data"):
+    DATA_DIR = "/var/data"
+else:
+    DATA_DIR = "."
+
+EVENTS_DB = os.path.join(DATA_DIR, "webhook_events.sqlite3")
+
+KEEP_DAYS = 14           # GetCourse stops retrying long before this
+PURGE_INTERVAL = 3600    # seconds between purges of old keys
+PENDING_TIMEOUT = timedelta(minutes=5)  # a claim not completed by then was abandoned
+CACHE_SIZE = 4096
+
+# Fields that identify a GetCourse order/payment, and (when none is present) the buyer
+ORDER_FIELDS = ('order_id', 'order_number', 'deal_id', 'deal_number', 'number',
+                'payment_id', 'object_id')
+IDENTITY_FIELDS = ('token', 'tg_id', 'utm_tg_id', 'telegram_id', 'user_id',
+                   'create_session_utm_tg_id', 'email', 'user_email', 'mail', 'object_user_email')
+
+_local = threading.local()
+_schema_lock = threading.Lock()
+_schema_ready = False
+_recent = TTLCache(maxsize=CACHE_SIZE, ttl=KEEP_DAYS * 86400)
+_last_purge = 0.0
+
+
+def _connect() -> sqlite3.Connection:
+    """Per-thread connection (sqlite3 connections must not be shared across threads)."""
+    conn = getattr(_local, "conn", None)
+    if conn is None:
+        conn = sqlite3.connect(EVENTS_DB, timeout=10, isolation_level=None)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        _local.conn = conn
+        _ensure_schema(conn)
+    return conn
+
+
+def _ensure_schema(conn: sqlite3.Connection) -> None:
+    global _schema_ready
+    with _schema_lock:
+        if _schema_ready:
+            return
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS webhook_events (
+                event_key TEXT PRIMARY KEY,
+                received_at TEXT NOT NULL,
+                status TEXT NOT NULL DEFAULT 'done'
+            )
+        """)
+        try:
+            # Tables created before claims had a state: their keys were all processed
+            conn.execute("ALTER TABLE webhook_events ADD COLUMN status TEXT NOT NULL DEFAULT 'done'")
+        except sqlite3.OperationalError:
+            pass  # column already exists
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_webhook_events_received ON webhook_events(received_at)")
+        _schema_ready = True
+
+
+def _clean(value) -> str:
+    text = str(value).strip() if value is not None else ""
+    if "{{" in text and "}}" in text:
+        return ""  # unsubstituted GetCourse template
+    return text.lower()
+
+
+def event_key(data: Dict, status_class: str) -> str:
+    """
+    Key of a webhook event: its order identifiers and status class ('paid', 'ended', ...).
+    Without any order identifier the buyer's identity and the date are used instead.
+    """
+    parts = [f"{k}={_clean(data.get(k))}" for k in ORDER_FIELDS if _clean(data.get(k))]
+    if not parts:
+        parts = [f"{k}={_clean(data.get(k))}" for k in IDENTITY_FIELDS if _clean(data.get(k))]
+        parts.append(f"date={datetime.now():%Y-%m-%d}")
+    raw = "|".join([status_class] + parts)
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()[:32]
+
+
+def claim(key: str) -> bool:
+    """
+    True if this request should process the event: the key is new, or its claim went
+    stale. False for duplicates: the key is done, or another request is processing it.
+    """
+    if _recent.get(key):
+        return False
+    conn = _connect()
+    now = datetime.now()
+    inserted = conn.execute(
+        "INSERT OR IGNORE INTO webhook_events (event_key, received_at, status) VALUES (?, ?, 'pending')",
+        (key, now.isoformat())
+    ).rowcount
+    _maybe_purge()
+    if inserted:
+        return True
+    reclaimed = conn.execute(
+        "UPDATE webhook_events SET received_at = ? "
+        "WHERE event_key = ? AND status = 'pending' AND received_at < ?",
+        (now.isoformat(), key, (now - PENDING_TIMEOUT).isoformat())
+    ).rowcount
+    if reclaimed:
+        logger.warning(f"♻️ Webhook event {key} was claimed but never completed; processing it again")
+    return bool(reclaimed)
+
+
+def complete(key: str) -> None:
+    """Mark a claimed key done (its changes are recorded): from now on copies are duplicates."""
+    _connect().execute("UPDATE webhook_events SET status = 'done' WHERE event_key = ?", (key,))
+    _recent.set(key, True)
+
+
+def release(key: str) -> None:
+    """Forget a claimed key (processing failed, so GetCourse's retry must go through)."""
+    _recent.invalidate(key)
+    _connect().execute("DELETE FROM webhook_events WHERE event_key = ?", (key,))
+
+
+def _maybe_purge(days: int = KEEP_DAYS) -> None:
+    global _last_purge
+    if time.monotonic() - _last_purge < PURGE_INTERVAL:
+        return
+    _last_purge = time.monotonic()
+    cutoff = (datetime.now() - timedelta(days=days)).isoformat()
+    deleted = _connect().execute("DELETE FROM webhook_events WHERE received_at < ?", (cutoff,)).rowcount
+    if deleted:
+        logger.info(f"🧹 Purged {deleted} old webhook event keys")